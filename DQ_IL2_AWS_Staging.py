@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_AWS_Staging.py
+
+DESCRIPTION:
+
+Stages the batch zipfiles into the AWS data feed folder (AWS_FILE_DIR) for DQ_IL2_Seq_Check, on a bounded pool of
+threads, as soon as the sequences have been checked (i.e. while the xmls are being parsed).
+
+Each zipfile is:
+- hardlinked into AWS_FILE_DIR/tmp (or copied, in chunks, if AWS_FILE_DIR is on another volume - see DQ_IL2_Fanout.py)
+- read back to record its size and sha1
+- moved into AWS_FILE_DIR. From then on the batch zipfile is no longer needed and can be archived (see
+  AWSStagingBatch.wait_staged) - a zipfile which fails at any step is removed from the tmp folder and left in the batch folder
+
+Once every zipfile of a batch is in place, a manifest (AWS_MANIFEST_<yyyymmddhhmissfff>.csv - filename,size,sha1) is written
+to AWS_FILE_DIR, via the tmp folder, so a downstream consumer which finds the manifest knows every zipfile it lists is
+complete.
+
+Zipfiles staged by an interrupted run (recorded in the checkpoint journal - see DQ_IL2_Checkpoint.py) are not staged again,
+but are passed in as staged_entries, so they are listed in the manifest of the resumed batch.
+"""
+
+import os
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+from DQ_IL2_Fanout import link_or_copy
+from DQ_IL2_Sharded_Dir import make_dirs
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def file_sha1(filename, buffer_size=HASH_BUFFER_SIZE):
+    """
+    Returns the sha1 of a file, read in chunks
+    :param filename:
+    :param buffer_size:
+    :returns: string
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(buffer_size)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+class AWSStager(object):
+    """
+    The bounded thread pool used to stage batches (see the module description)
+    """
+
+    def __init__(self, aws_file_dir, logger, no_of_threads=4):
+        """
+        :param aws_file_dir:
+        :param logger:
+        :param no_of_threads:
+        """
+        self.aws_file_dir = aws_file_dir
+        self.logger = logger
+        make_dirs(os.path.join(aws_file_dir, 'tmp'))
+        self.pool = ThreadPool(no_of_threads)
+        self.batches = []
+
+    def stage_batch(self, source_dir_list, source_file_dir, on_staged=None, on_entry=None, on_manifest=None, staged_entries=None):
+        """
+        Starts staging the zipfiles of a batch and returns without waiting
+        :param source_dir_list:
+        :param source_file_dir:
+        :param on_staged: optional callable, called with each filename and whether it was staged (from a staging thread) once
+                          it is in the AWS folder or has failed, i.e. once the batch zipfile can be archived
+        :param on_entry: optional callable, called with the (filename, size, sha1) of each zipfile once it is in the AWS folder
+        :param on_manifest: optional callable, called with the manifest filename and its entries once it has been written
+        :param staged_entries: (filename, size, sha1) of zipfiles already in the AWS folder, to be listed in the manifest
+        :returns: AWSStagingBatch
+        """
+        self.batches = [batch for batch in self.batches if not batch.done_event.is_set()]
+        batch = AWSStagingBatch(self, source_dir_list, source_file_dir, on_staged, on_entry, on_manifest, staged_entries)
+        self.batches.append(batch)
+        return batch
+
+    def close(self):
+        """
+        Waits for every batch (and its manifest) to complete, then stops the threads
+        :returns: None
+        """
+        for batch in self.batches:
+            batch.wait()
+        self.batches = []
+        self.pool.close()
+        self.pool.join()
+
+
+class AWSStagingBatch(object):
+    """
+    The staging of one batch of zipfiles
+    """
+
+    def __init__(self, stager, source_dir_list, source_file_dir, on_staged=None, on_entry=None, on_manifest=None, staged_entries=None):
+        self.stager = stager
+        self.logger = stager.logger
+        self.aws_file_dir = stager.aws_file_dir
+        self.source_file_dir = source_file_dir
+        self.on_staged = on_staged
+        self.on_entry = on_entry
+        self.on_manifest = on_manifest
+        self.staged_events = dict([(fname, threading.Event()) for fname in source_dir_list])
+        self.failed = set()
+        self.methods = {'link': 0, 'copy': 0}
+        self.count_lock = threading.Lock()
+        self.starttime = time.time()
+        self.entries = list(staged_entries or [])
+        self.remaining = len(source_dir_list)
+        self.manifest_filename = None
+        self.elapsed_secs = 0.0
+        self.done_event = threading.Event()
+        if not source_dir_list:
+            self._finish()
+        for fname in source_dir_list:
+            stager.pool.apply_async(self._stage_task, (fname,))
+
+    def _stage_task(self, fname):
+        """
+        Stages a zipfile - the last task of the batch to finish writes the manifest
+        :param fname:
+        :returns: None
+        """
+        entry = self._stage_file(fname)
+        if entry is not None and self.on_entry is not None:
+            self.on_entry(entry)
+        with self.count_lock:
+            if entry is not None:
+                self.entries.append(entry)
+            self.remaining -= 1
+            last_task = (self.remaining == 0)
+        if last_task:
+            self._finish()
+
+    def _finish(self):
+        """
+        Writes the manifest and marks the batch as done
+        :returns: None
+        """
+        try:
+            entries = sorted(self.entries)
+            self.manifest_filename = self._write_manifest(entries)
+            if self.manifest_filename is not None and self.on_manifest is not None:
+                self.on_manifest(self.manifest_filename, entries)
+        except Exception:
+            self.logger.exception('Error writing the AWS manifest')
+        finally:
+            self.elapsed_secs = time.time() - self.starttime
+            self.done_event.set()
+
+    def _stage_file(self, fname):
+        """
+        Hardlinks/copies a zipfile into the tmp folder, records its size and sha1, then moves it into the AWS folder
+        :param fname:
+        :returns: tuple (filename, size, sha1) or None on error
+        """
+        tmp_filename = os.path.join(self.aws_file_dir, 'tmp', fname)
+        try:
+            method = link_or_copy(os.path.join(self.source_file_dir, fname), tmp_filename)
+            size = os.stat(tmp_filename).st_size
+            sha1 = file_sha1(tmp_filename)
+            aws_filename = os.path.join(self.aws_file_dir, fname)
+            if os.path.exists(aws_filename):
+                os.remove(aws_filename)
+            os.rename(tmp_filename, aws_filename)
+        except Exception:
+            self._failed(fname)
+            self._remove_tmp_file(tmp_filename)
+            self._staged(fname, False)
+            return None
+        with self.count_lock:
+            self.methods[method] += 1
+        # Only now is the batch zipfile no longer needed, i.e. a zipfile is never archived without its copy in the AWS folder
+        self._staged(fname, True)
+        return fname, size, sha1
+
+    def _remove_tmp_file(self, tmp_filename):
+        # A partial copy (or a hardlink which could not be moved) would otherwise be left in the tmp folder
+        try:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        except OSError:
+            self.logger.exception('Error removing %s' % (tmp_filename))
+
+    def _staged(self, fname, success):
+        # The callback is made before the event is set, so it has been made for every zipfile once wait_staged() returns
+        if self.on_staged is not None:
+            self.on_staged(fname, success)
+        self.staged_events[fname].set()
+
+    def _failed(self, fname):
+        with self.count_lock:
+            self.failed.add(fname)
+        self.logger.exception('Error staging %s to %s' % (fname, self.aws_file_dir))
+
+    def wait_staged(self, fname=None):
+        """
+        Waits until a zipfile (or every zipfile) of the batch is in the AWS folder (or has failed), i.e. can be archived
+        :param fname: None for every zipfile
+        :returns: set (the zipfiles which could not be staged)
+        """
+        for event in ([self.staged_events[fname]] if fname is not None else self.staged_events.values()):
+            event.wait()
+        return self.failed
+
+    def wait(self):
+        """
+        Waits until every zipfile has been staged and the manifest has been written
+        :returns: string (the manifest filename, or None if nothing was staged)
+        """
+        self.done_event.wait()
+        return self.manifest_filename
+
+    def stats(self):
+        """
+        Returns the staging time and the no. of files/bytes staged (complete once the batch is done)
+        :returns: tuple (secs, file count, byte count)
+        """
+        with self.count_lock:
+            return self.elapsed_secs, len(self.entries), sum([entry[1] for entry in self.entries])
+
+    def _write_manifest(self, entries):
+        """
+        Writes the manifest to the tmp folder, then moves it into the AWS folder
+        :param entries: list of (filename, size, sha1)
+        :returns: string (the manifest filename, or None if nothing was staged)
+        """
+        if not entries:
+            return None
+        manifest_basename = 'AWS_MANIFEST_%s%03d.csv' % (time.strftime('%Y%m%d%H%M%S', time.localtime(self.starttime)), int(self.starttime * 1000) % 1000)
+        tmp_filename = os.path.join(self.aws_file_dir, 'tmp', manifest_basename)
+        with open(tmp_filename, 'wb') as f:
+            f.write('filename,size,sha1\r\n')
+            f.write(''.join(['%s,%s,%s\r\n' % entry for entry in entries]))
+        manifest_filename = os.path.join(self.aws_file_dir, manifest_basename)
+        if os.path.exists(manifest_filename):
+            os.remove(manifest_filename)
+        os.rename(tmp_filename, manifest_filename)
+
+        self.logger.info('AWS staging: %s file(s) staged (%s hardlink(s), %s copy(ies)), %s byte(s), %s failed, manifest %s (%.3f sec(s))'
+                         % (len(entries), self.methods['link'], self.methods['copy'], sum([entry[1] for entry in entries]),
+                            len(self.failed), manifest_basename, time.time() - self.starttime))
+        return manifest_filename
@@ -13,6 +13,8 @@
 
 ### IMPORT PYTHON MODULES ####################################################################################################
 import os, re, time, sys, shutil, fileinput, getopt, datetime
+import DQ_IL2_Sharded_Dir
+import DQ_IL2_Parse_Index
 #from datetime import datetime
 
 ### GLOBAL VARIABLES #########################################################################################################
@@ -71,16 +73,24 @@ def main(argv):
     # Cleanup xml files
     ##############################################################################################################################
     print '\n*** Cleanup xml files'
-    xml_dir_list = [f for f in os.listdir(XML_DIR) if f.endswith('.xml')]
+    xml_dir_list = DQ_IL2_Sharded_Dir.list_files(XML_DIR, '.xml')
     if xml_dir_list:
 
        for file in xml_dir_list:
-           os.remove(XML_DIR + file)
+           os.remove(os.path.join(XML_DIR, file))
            FILE_COUNTER+=1
        add_log_entry(LOGFILE,'CLEANUP XML FILES', str(FILE_COUNTER) + ' files cleaned up')
     else:
        add_log_entry(LOGFILE,'CLEANUP XML FILES', 'No source files')
 
+    # The parse indexes of the xml folder list the files just removed (see DQ_IL2_Parse_Index.py)
+    REMOVED_INDEXES = DQ_IL2_Parse_Index.remove_indexes(XML_DIR)
+    if REMOVED_INDEXES:
+       add_log_entry(LOGFILE,'CLEANUP PARSE INDEXES', str(REMOVED_INDEXES) + ' index(es) removed')
+    REMOVED_SHARDS = DQ_IL2_Sharded_Dir.remove_empty_shards(XML_DIR)
+    if REMOVED_SHARDS:
+       add_log_entry(LOGFILE,'CLEANUP SHARD FOLDERS', str(REMOVED_SHARDS) + ' empty folder(s) removed')
+
     
 
 
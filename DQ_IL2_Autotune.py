@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Autotune.py
+
+DESCRIPTION:
+
+Adaptive concurrency for the multiprocessing phases of the DQ_IL2 scripts (unzip, parse, move, concat...), whose CPU/IO
+profiles differ too much for a single NO_OF_PROCESSES to suit them all.
+
+The pool is created with MAX_PROCESSES workers, and an AutotuningExecutor runs each phase on it with a window of at most
+<concurrency> tasks in flight:
+- the window starts at the configured NO_OF_PROCESSES
+- each task is timed in the worker - its CPU time against its wall time gives the CPU utilisation of the phase (close to
+  100% for CPU-bound work, low for IO-bound work)
+- after each sample (at least SAMPLE_TASKS tasks, and twice the window), the throughput (items/sec) is compared with the
+  previous sample: the window keeps moving in the same direction (one process at a time) while the throughput improves, is
+  turned back when it gets worse, and is reduced when it stays flat (the extra processes are not helping)
+- the window is not grown while the phase is CPU-bound and the busy workers already use every CPU
+- the window stays between MIN_PROCESSES and MAX_PROCESSES
+
+With MIN_PROCESSES = MAX_PROCESSES = NO_OF_PROCESSES (the default when they are not set) the concurrency is fixed.
+
+When the no. of items of a phase is known (imap_unordered total), the items are sent in chunks which shrink as the end of
+the phase nears (guided self-scheduling - each chunk is at most 1/GUIDED_CHUNK_FACTOR of the remaining items per process),
+so the workers finish together rather than one of them working through a last full chunk while the others are idle. The
+callers send the largest items first where their sizes are known. The spread of the workers' finish times (from the first
+worker to finish its last task to the last one) is returned by stats() with the concurrency.
+
+The pool can also be a SupervisedPool (see DQ_IL2_Supervisor.py), which enforces a time budget on each item.
+
+The chosen sizes (initial, final, min/max/mean) and the CPU utilisation are returned by stats() and recorded with the
+stage in the run metrics (see DQ_IL2_Metrics.py).
+"""
+
+import os
+import math
+import time
+import traceback
+import Queue
+import multiprocessing
+
+SAMPLE_TASKS = 8
+THROUGHPUT_TOLERANCE = 0.05
+CPU_SATURATION = 0.9
+GUIDED_CHUNK_FACTOR = 2
+
+
+def task_cpu_secs():
+    process_times = os.times()
+    return process_times[0] + process_times[1]
+
+
+def cpu_utilisation(cpu_secs, wall_secs):
+    # The CPU times have a coarse resolution (e.g. 10ms), so very short tasks can appear to use more than one CPU
+    return min(cpu_secs / wall_secs, 1.0) if wall_secs > 0 else 0.0
+
+
+def run_timed_task(task):
+    """
+    Runs a task (a chunk of items) in a worker, timing it
+    :param task: tuple (func, list of items)
+    :returns: tuple (list of results, cpu secs, wall secs, error, worker pid) - error is the formatted exception if the
+              task raised
+    """
+    func, items = task
+    start_wall = time.time()
+    start_cpu = task_cpu_secs()
+    try:
+        results = [func(item) for item in items]
+        error = None
+    except Exception:
+        results = []
+        error = traceback.format_exc()
+    return results, task_cpu_secs() - start_cpu, time.time() - start_wall, error, os.getpid()
+
+
+class AutotuningExecutor(object):
+    """
+    Runs the tasks of a phase on a pool with an adaptive no. of tasks in flight (see the module description)
+    """
+
+    def __init__(self, pool, phase, initial, min_size=None, max_size=None, logger=None, cpu_count=None):
+        """
+        :param pool: multiprocessing.Pool with at least max_size workers
+        :param phase: the phase name, used in the log messages
+        :param initial: the starting concurrency (e.g. NO_OF_PROCESSES)
+        :param min_size: defaults to initial
+        :param max_size: defaults to initial
+        :param logger: optional logger for the concurrency changes
+        :param cpu_count: defaults to multiprocessing.cpu_count()
+        """
+        self.pool = pool
+        self.phase = phase
+        self.min_size = initial if min_size is None else min_size
+        self.max_size = initial if max_size is None else max_size
+        self.initial = min(max(initial, self.min_size), self.max_size)
+        self.window = self.initial
+        self.logger = logger
+        self.cpu_count = cpu_count or multiprocessing.cpu_count()
+        self.direction = 1
+        self.previous_throughput = None
+        self.sizes = []
+        self.finish_times = {}
+        self.cpu_secs = 0.0
+        self.wall_secs = 0.0
+        self._reset_sample()
+
+    def _reset_sample(self):
+        self.sample_tasks = 0
+        self.sample_items = 0
+        self.sample_cpu_secs = 0.0
+        self.sample_wall_secs = 0.0
+        self.sample_start = time.time()
+
+    def tuning(self):
+        return self.min_size < self.max_size
+
+    def imap_unordered(self, func, iterable, chunksize=1, total=None):
+        """
+        Applies func to each item, yielding the results as they complete (in any order). Items are sent to the workers in
+        chunks of chunksize, or smaller chunks towards the end of the phase if total is given
+        :param func: a module level function (it is pickled by reference)
+        :param iterable:
+        :param chunksize:
+        :param total: the no. of items (an estimate will do), or None
+        :returns: generator
+        """
+        completed = Queue.Queue()
+        handles = []
+        tasks = self._chunks(iterable, max(chunksize, 1), total)
+        in_flight = 0
+        exhausted = False
+        while True:
+            while not exhausted and in_flight < self.window:
+                try:
+                    chunk = tasks.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                handle = self._submit(func, chunk, completed.put)
+                if handle is not None:
+                    handles.append(handle)
+                in_flight += 1
+            if not in_flight:
+                break
+            results, cpu_secs, wall_secs, error, pid = self._next_completed(completed, handles)
+            in_flight -= 1
+            if error is not None:
+                raise RuntimeError('%s task failed in a worker:\n%s' % (self.phase, error))
+            self.finish_times[pid] = time.time()
+            self._record(len(results), cpu_secs, wall_secs)
+            for result in results:
+                yield result
+
+    def _chunks(self, iterable, chunksize, total):
+        """
+        Yields the items in chunks of chunksize or, if total is given, of at most 1/GUIDED_CHUNK_FACTOR of the remaining
+        items per process (and at least one item). If total turns out to be too low, the chunks go back to chunksize
+        :param iterable:
+        :param chunksize:
+        :param total:
+        :returns: generator
+        """
+        remaining = total
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= self._chunk_size(chunksize, remaining):
+                yield chunk
+                if remaining is not None:
+                    remaining -= len(chunk)
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _chunk_size(self, chunksize, remaining):
+        if remaining is None or remaining <= 0:
+            return chunksize
+        return max(1, min(chunksize, int(math.ceil(float(remaining) / (GUIDED_CHUNK_FACTOR * self.window)))))
+
+    def _submit(self, func, chunk, callback):
+        """
+        Submits a chunk to the pool
+        :param func:
+        :param chunk:
+        :param callback: called with the result of run_timed_task
+        :returns: multiprocessing.pool.AsyncResult, or None for a SupervisedPool
+        """
+        if hasattr(self.pool, 'apply_chunk'):
+            # A SupervisedPool runs and times the items itself, and calls back on every outcome (see DQ_IL2_Supervisor.py)
+            self.pool.apply_chunk(func, chunk, callback)
+            return None
+        return self.pool.apply_async(run_timed_task, ((func, chunk),), callback=callback)
+
+    def _next_completed(self, completed, handles):
+        """
+        Waits for the next task to complete. The wait has a timeout, as a blocking get cannot be interrupted by signals (e.g.
+        SIGTERM in watch mode) on python 2, and the task handles are checked on each timeout - the pool never calls back
+        for a task which failed outside run_timed_task (e.g. its chunk or its results could not be pickled)
+        :param completed: the Queue the callbacks put the results on
+        :param handles: list of the AsyncResults of the tasks submitted - the completed ones are removed
+        :returns: tuple (see run_timed_task)
+        """
+        while True:
+            try:
+                return completed.get(True, 1.0)
+            except Queue.Empty:
+                pass
+            for handle in handles:
+                if handle.ready() and not handle.successful():
+                    try:
+                        handle.get(0)
+                    except Exception, e:
+                        raise RuntimeError('%s task failed in the pool: %s: %s' % (self.phase, e.__class__.__name__, e))
+            handles[:] = [handle for handle in handles if not handle.ready()]
+
+    def _record(self, item_count, cpu_secs, wall_secs):
+        self.sizes.append(self.window)
+        self.cpu_secs += cpu_secs
+        self.wall_secs += wall_secs
+        self.sample_tasks += 1
+        self.sample_items += item_count
+        self.sample_cpu_secs += cpu_secs
+        self.sample_wall_secs += wall_secs
+        if self.tuning() and self.sample_tasks >= max(SAMPLE_TASKS, 2 * self.window):
+            self._adjust()
+
+    def _adjust(self):
+        """
+        Moves the window one process up or down from the throughput and CPU utilisation of the last sample
+        :returns: None
+        """
+        elapsed = time.time() - self.sample_start
+        throughput = self.sample_items / elapsed if elapsed > 0 else 0.0
+        cpu_util = cpu_utilisation(self.sample_cpu_secs, self.sample_wall_secs)
+
+        if self.previous_throughput is not None:
+            if throughput < self.previous_throughput * (1 - THROUGHPUT_TOLERANCE):
+                self.direction = -self.direction
+            elif throughput <= self.previous_throughput * (1 + THROUGHPUT_TOLERANCE):
+                self.direction = -1
+        if self.direction > 0 and cpu_util * self.window >= self.cpu_count * CPU_SATURATION:
+            self.direction = -1 if cpu_util * (self.window - 1) >= self.cpu_count * CPU_SATURATION else 0
+
+        window = min(max(self.window + self.direction, self.min_size), self.max_size)
+        if window != self.window and self.logger is not None:
+            self.logger.info('%s: concurrency %s -> %s (%.1f item(s)/sec, CPU utilisation %.0f%%)' % (self.phase, self.window, window, throughput, cpu_util * 100))
+        if self.direction == 0:
+            self.direction = 1
+        self.window = window
+        self.previous_throughput = throughput
+        self._reset_sample()
+
+    def stats(self):
+        """
+        Returns the concurrency used by the phase, for the run metrics
+        :returns: dict (initial, final, min, max, mean, cpu_util, workers, finish_spread) - finish_spread is the secs
+                  between the first and the last of the workers to finish their last task
+        """
+        sizes = self.sizes or [self.window]
+        finish_times = self.finish_times.values()
+        return {'initial': self.initial, 'final': self.window, 'min': min(sizes), 'max': max(sizes),
+                'mean': round(float(sum(sizes)) / len(sizes), 2),
+                'cpu_util': round(cpu_utilisation(self.cpu_secs, self.wall_secs), 3) if self.wall_secs > 0 else None,
+                'workers': len(finish_times),
+                'finish_spread': round(max(finish_times) - min(finish_times), 3) if finish_times else None}
+
+
+def format_stats(stats):
+    """
+    Returns the concurrency stats as a log message, e.g. 'concurrency 4 -> 6 (mean 5.1, CPU utilisation 35%, finish spread
+    0.120 sec(s))'
+    :param stats:
+    :returns: string
+    """
+    return 'concurrency %s -> %s (mean %s, CPU utilisation %s, finish spread %s)' % (
+        stats['initial'], stats['final'], stats['mean'], 'unknown' if stats['cpu_util'] is None else '%.0f%%' % (stats['cpu_util'] * 100),
+        'unknown' if stats.get('finish_spread') is None else '%.3f sec(s)' % (stats['finish_spread']))
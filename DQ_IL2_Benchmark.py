@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Benchmark.py
+
+DESCRIPTION:
+
+Offline benchmarks for the DQ_IL2 pipeline. Usage:
+
+    python DQ_IL2_Benchmark.py -t <benchmark> [-n <no. of items>] [-s <random seed>] [-d <root dir>] [-o <OPTION=value> ...]
+
+Benchmarks:
+
+    xml_classifier      compares the legacy ElementTree full parse (ET.parse + findall) with DQ_IL2_XML_Classifier on
+                        generated commonAPI messages (default: 2000 messages)
+    flight_router       compares the legacy list scan + re.match GA check with DQ_IL2_Flight_Router on generated
+                        flightIds and MDS carrier codes (default: 1000000 flightIds)
+    pipeline            end-to-end: generates a synthetic workload (see DQ_IL2_Synthetic_Workload.py) in a temporary
+                        ROOT_DIR (or -d <root dir>, which is kept), runs DQ_IL2_Seq_Check, DQ_IL2_Prep_XML_files and
+                        DQ_IL2_PreProcess_XML_Files against it and reports the throughput of each stage from the run history
+                        (default: 10 zipfiles per filetype). DQ_IL2_Config.ini settings can be overridden with -o, e.g.
+                        -o NO_OF_PROCESSES=8 -o PIPELINE_MODE=True
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import time
+import getopt
+import re
+import random
+import string
+import xml.etree.ElementTree as ET
+
+from DQ_IL2_XML_Classifier import classify_xml_string, _tree_classify, PARSER_BACKEND
+from DQ_IL2_Flight_Router import FlightRouter, GA
+from DQ_IL2_Synthetic_Workload import PARSED_NS, build_api_message, build_pnr_message, random_passenger_count, random_carrier_codes, generate_workload
+from DQ_IL2_Metrics import read_run_history, run_history_file
+from DQ_IL2_Sharded_Dir import count_files
+
+# The ROOT_DIR used throughout DQ_IL2_Config.ini, replaced with the benchmark ROOT_DIR
+CONFIG_ROOT_DIR = 'E:/dq/nrt/s4_file_ingest'
+
+PIPELINE_DIRS = ['FTP_landingzone/done', 'batch', 'aws', 'ga', 'ga_inprocess', 'tmp', 'archive/parsed', 'archive/stored',
+                 'archive/failed', 'out', 'log', 'raw_inprocess', 'mds', 'reject', 'xml', 'xml_inprocess', 'scripts']
+
+PIPELINE_SCRIPTS = ['DQ_IL2_Seq_Check.py', 'DQ_IL2_Prep_XML_files.py', 'DQ_IL2_PreProcess_XML_Files.py']
+
+
+def legacy_classify(data):
+    """
+    The pre-DQ_IL2_XML_Classifier path from DQ_IL2_Seq_Check.mp_parse_xml: full parse with the pure python parser
+    :param data:
+    :returns: bool, list
+    """
+    return _tree_classify(ET.parse(io.BytesIO(data)).getroot(), PARSED_NS)
+
+
+def time_function(function, items, repeat=3):
+    """
+    Runs function over all items, repeat times, and returns the best elapsed time in seconds and the last results
+    :param function:
+    :param items:
+    :param repeat:
+    :returns: float, list
+    """
+    best = None
+    results = None
+    for i in range(repeat):
+        start = time.time()
+        results = [function(item) for item in items]
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def benchmark_xml_classifier(no_of_items=2000, seed=1):
+    rnd = random.Random(seed)
+    messages = []
+    for n in range(no_of_items):
+        if rnd.random() < 0.1:
+            messages.append(build_pnr_message(n, random_passenger_count(rnd)))
+        else:
+            flight_id = rnd.choice(['BA%04d' % rnd.randint(1, 9999), 'BAW%03d' % rnd.randint(1, 999), '_GA%s' % n, 'ZZ%03d' % n])
+            messages.append(build_api_message(n, flight_id, random_passenger_count(rnd)))
+
+    total_bytes = sum([len(m) for m in messages])
+    print 'Messages: %s (%.1f MB, parser backend: %s)' % (no_of_items, total_bytes / 1048576.0, PARSER_BACKEND)
+
+    legacy_secs, legacy_results = time_function(legacy_classify, messages)
+    classifier_secs, classifier_results = time_function(lambda data: classify_xml_string(data, PARSED_NS), messages)
+
+    for name, secs in [('ET.parse (legacy)', legacy_secs), ('DQ_IL2_XML_Classifier', classifier_secs)]:
+        print '%-24s %8.3f sec(s) %10.0f msgs/sec %8.1f MB/sec' % (name, secs, no_of_items / secs, total_bytes / 1048576.0 / secs)
+    print 'Speedup: %.1fx' % (legacy_secs / classifier_secs)
+    print 'Results match: %s' % (legacy_results == classifier_results)
+
+
+def legacy_is_executive_flight(flight_id, executive_carriers, expected_length):
+    """
+    The pre-DQ_IL2_Flight_Router GA carrier check from DQ_IL2_Seq_Check
+    """
+    if (len(flight_id) > expected_length and re.match('[0-9]', flight_id[expected_length])):
+        return flight_id[:expected_length] in executive_carriers
+    return False
+
+
+def legacy_is_ga_flight(flight_id, iata_executive_carriers, icao_executive_carriers):
+    """
+    The pre-DQ_IL2_Flight_Router GA check from DQ_IL2_Seq_Check.mp_parse_xml (GA carriers held as lists)
+    """
+    return bool(re.search('^_GA.*$', flight_id) or legacy_is_executive_flight(flight_id, iata_executive_carriers, 2) or legacy_is_executive_flight(flight_id, icao_executive_carriers, 3))
+
+
+def benchmark_flight_router(no_of_items=1000000, seed=1):
+    rnd = random.Random(seed)
+
+    # Roughly the size of the MDS carriers view
+    iata_codes = random_carrier_codes(rnd, 2, 600)
+    icao_codes = random_carrier_codes(rnd, 3, 4000)
+    carriers = {'IATA': iata_codes[:150], 'COMMERCIAL_IATA': iata_codes[150:],
+                'ICAO': icao_codes[:2500], 'COMMERCIAL_ICAO': icao_codes[2500:]}
+
+    flight_ids = []
+    for n in xrange(no_of_items):
+        r = rnd.random()
+        if r < 0.02:
+            flight_ids.append('_GA%s' % (n))
+        elif r < 0.6:
+            flight_ids.append('%s%s' % (rnd.choice(iata_codes), rnd.randint(1, 9999)))
+        elif r < 0.95:
+            flight_ids.append('%s%s' % (rnd.choice(icao_codes), rnd.randint(1, 999)))
+        else:
+            flight_ids.append('%s%s' % (''.join([rnd.choice(string.ascii_uppercase) for i in range(3)]), rnd.randint(1, 999)))
+
+    print 'FlightIds: %s, carriers: %s' % (no_of_items, ', '.join(['%s %s' % (len(codes), code_standard) for code_standard, codes in sorted(carriers.items())]))
+
+    start = time.time()
+    flight_router = FlightRouter(carriers)
+    print 'Router build time: %.3f sec(s)' % (time.time() - start)
+
+    iata_executive_carriers = carriers['IATA']
+    icao_executive_carriers = carriers['ICAO']
+    legacy_secs, legacy_results = time_function(lambda flight_id: legacy_is_ga_flight(flight_id, iata_executive_carriers, icao_executive_carriers), flight_ids, repeat=1)
+    router_secs, router_results = time_function(flight_router.classify, flight_ids)
+
+    for name, secs in [('Lists + re.match (GA only)', legacy_secs), ('DQ_IL2_Flight_Router', router_secs)]:
+        print '%-28s %8.3f sec(s) %12.0f flightIds/sec' % (name, secs, no_of_items / secs)
+    print 'Speedup: %.1fx' % (legacy_secs / router_secs)
+    print 'GA results match: %s' % (legacy_results == [flight_class == GA for flight_class in router_results])
+    print 'Classes: %s' % (', '.join(['%s %s' % (router_results.count(flight_class), flight_class) for flight_class in sorted(set(router_results))]))
+
+
+def write_benchmark_config(config_file, target_config_file, root_dir, overrides):
+    """
+    Writes a copy of DQ_IL2_Config.ini with every folder under the benchmark ROOT_DIR, and the given options overridden (in
+    every section which has them)
+    :param config_file:
+    :param target_config_file:
+    :param root_dir:
+    :param overrides: list of (option, value)
+    :returns: None
+    """
+    with open(config_file, 'rb') as f:
+        config = f.read().replace(CONFIG_ROOT_DIR, root_dir.replace('\\', '/'))
+    for option, value in overrides:
+        config, count = re.subn(r'(?mi)^%s[ \t]*=.*$' % (re.escape(option)), '%s = %s' % (option, value), config)
+        if not count:
+            raise ValueError('Unknown option: %s' % (option))
+    with open(target_config_file, 'wb') as f:
+        f.write(config)
+
+
+def benchmark_pipeline(no_of_items=10, seed=1, root_dir=None, overrides=None):
+    keep_root_dir = root_dir is not None
+    if root_dir is None:
+        root_dir = tempfile.mkdtemp(prefix='dq_il2_benchmark_')
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+    try:
+        for folder in PIPELINE_DIRS:
+            if not os.path.isdir(os.path.join(root_dir, folder)):
+                os.makedirs(os.path.join(root_dir, folder))
+        for filename in os.listdir(scripts_dir):
+            if filename.startswith('DQ_IL2_') and filename.endswith('.py'):
+                shutil.copy(os.path.join(scripts_dir, filename), os.path.join(root_dir, 'scripts', filename))
+        config_overrides = [('MAX_BATCH_SIZE', max(720, no_of_items)), ('DEBUG', 0)] + list(overrides or [])
+        write_benchmark_config(os.path.join(scripts_dir, 'DQ_IL2_Config.ini'), os.path.join(root_dir, 'scripts', 'DQ_IL2_Config.ini'),
+                               root_dir, config_overrides)
+
+        start = time.time()
+        workload = generate_workload(root_dir, {'zipfiles_per_filetype': no_of_items, 'seed': seed})
+        print 'Workload: %s zipfile(s) (%.1f MB), %s PARSED message(s): %s (generated in %.3f sec(s), ROOT_DIR: %s)' % (
+            workload['zipfiles'], workload['bytes'] / 1048576.0, workload['messages'],
+            ', '.join(['%s %s' % (workload[message_class], message_class) for message_class in ['GA', 'COMMERCIAL', 'UNKNOWN', 'PNR', 'MALFORMED']]),
+            time.time() - start, root_dir)
+        if overrides:
+            print 'Overrides: %s' % (', '.join(['%s=%s' % (option, value) for option, value in overrides]))
+        print
+
+        for script in PIPELINE_SCRIPTS:
+            with open(os.path.join(root_dir, 'log', '%s.out' % (script)), 'wb') as output:
+                start = time.time()
+                return_code = subprocess.call([sys.executable, script], cwd=os.path.join(root_dir, 'scripts'), stdout=output, stderr=subprocess.STDOUT)
+            print '%-34s %8.3f sec(s)%s' % (script, time.time() - start, '' if return_code == 0 else '  FAILED (return code %s, see log/%s.out)' % (return_code, script))
+        print
+
+        history_file = run_history_file(root_dir)
+        runs = read_run_history(history_file) if os.path.exists(history_file) else []
+        print '%-34s %-26s %10s %10s %14s %10s' % ('Script', 'Stage', 'sec(s)', 'file(s)', 'file(s)/sec', 'MB/sec')
+        for run in runs:
+            for stage in run['stages']:
+                print '%-34s %-26s %10.3f %10s %14.1f %10.2f' % (run['script'], stage['name'], stage['secs'], stage['files'],
+                                                                 stage['files_per_sec'], stage['bytes_per_sec'] / 1048576.0)
+        print
+
+        # The xmls written by DQ_IL2_Seq_Check are moved to xml/ by DQ_IL2_Prep_XML_files, GA xmls are also linked into ga/ and
+        # malformed xmls are moved to reject/
+        for name, folder, expected in [('API xmls (xml)', 'xml', workload['GA'] + workload['COMMERCIAL'] + workload['UNKNOWN']),
+                                       ('GA xmls (ga)', 'ga', workload['GA']),
+                                       ('Malformed xmls (reject)', 'reject', workload['MALFORMED'])]:
+            actual = count_files(os.path.join(root_dir, folder), '.xml')
+            print '%-26s %8s (expected %s)%s' % (name, actual, expected, '' if actual == expected else '  MISMATCH')
+    finally:
+        if not keep_root_dir:
+            shutil.rmtree(root_dir, ignore_errors=True)
+
+
+BENCHMARKS = {'xml_classifier': benchmark_xml_classifier,
+              'flight_router': benchmark_flight_router,
+              'pipeline': benchmark_pipeline}
+
+
+def main(argv):
+    benchmark = None
+    kwargs = {}
+
+    try:
+        opts, args = getopt.getopt(argv, "t:n:s:d:o:")
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-t':
+            benchmark = arg
+        elif opt == '-n':
+            kwargs['no_of_items'] = int(arg)
+        elif opt == '-s':
+            kwargs['seed'] = int(arg)
+        elif opt == '-d':
+            kwargs['root_dir'] = arg
+        elif opt == '-o':
+            kwargs.setdefault('overrides', []).append(tuple(arg.split('=', 1)))
+
+    if benchmark not in BENCHMARKS:
+        print __doc__
+        sys.exit(2)
+
+    BENCHMARKS[benchmark](**kwargs)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
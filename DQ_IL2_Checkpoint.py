@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Checkpoint.py
+
+DESCRIPTION:
+
+An append-only journal of the stages completed for each zipfile of a DQ_IL2_Seq_Check batch, so a batch interrupted part way
+through (e.g. killed after the sequences were updated but before archiving) is resumed rather than redone:
+
+    {"zip": "PARSED_20171106_1200_0001.zip", "stage": "sequence", "at": "2017-11-06 12:00:00"}
+    {"zip": "PARSED_20171106_1200_0001.zip", "stage": "parse", "at": "2017-11-06 12:00:03"}
+    {"zip": "PARSED_20171106_1200_0001.zip", "stage": "aws", "at": "2017-11-06 12:00:04", "size": 5242880, "sha1": "..."}
+
+The stages are:
+- sequence - the sequence has been checked and recorded (MAX_SEQS.ini or the sequence ledger)
+- unzip    - the zipfile has been extracted to the tmp folder (STREAM_PARSE disabled)
+- parse    - the xmls have been classified and written to the output folders
+- aws      - the zipfile has been staged for the AWS data feed (with its size and sha1, for the manifest)
+- manifest - the zipfile has been listed in an AWS manifest
+
+Each record is written with a single append and flushed to disk before the stage is treated as complete. A record torn by a
+crash is ignored when the journal is read, i.e. that stage is redone. Once a batch completes, the journal is compacted to the
+zipfiles still in the batch folder (if any).
+
+With the journal disabled (CHECKPOINT_JOURNAL = False, or not set), the stages are only kept in memory.
+"""
+
+import os
+import time
+import json
+import threading
+
+STAGES = ('sequence', 'unzip', 'parse', 'aws', 'manifest')
+
+
+class CheckpointJournal(object):
+    """
+    The completed stages of each zipfile (see the module description)
+    """
+
+    def __init__(self, journal_file=None):
+        """
+        :param journal_file: None to keep the stages in memory only
+        """
+        self.journal_file = journal_file
+        self.completed = {}
+        self.details = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the journal, skipping any record which cannot be read (e.g. the last record, if torn by a crash)
+        :returns: int (the number of zipfiles with completed stages)
+        """
+        with self.lock:
+            self.completed = {}
+            self.details = {}
+            if self.journal_file is None or not os.path.exists(self.journal_file):
+                return 0
+            with open(self.journal_file, 'rb') as f:
+                for line in f:
+                    try:
+                        self._add(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+            return len(self.completed)
+
+    def _add(self, record):
+        fname = record['zip']
+        stage = record['stage']
+        self.completed.setdefault(fname, set()).add(stage)
+        self.details[(fname, stage)] = record
+
+    def is_done(self, fname, stage):
+        return stage in self.completed.get(fname, ())
+
+    def pending(self, fnames, stage):
+        """
+        Returns the zipfiles for which a stage has not been completed
+        :param fnames:
+        :param stage:
+        :returns: list
+        """
+        return [fname for fname in fnames if not self.is_done(fname, stage)]
+
+    def detail(self, fname, stage):
+        """
+        Returns the record of a completed stage (e.g. the size and sha1 recorded with the aws stage)
+        :param fname:
+        :param stage:
+        :returns: dict or None
+        """
+        return self.details.get((fname, stage))
+
+    def record(self, fname, stage, **details):
+        """
+        Records a stage as completed for a zipfile
+        :param fname:
+        :param stage:
+        :param details: any other values to record, e.g. size=..., sha1=...
+        :returns: None
+        """
+        self.record_many([fname], stage, **details)
+
+    def record_many(self, fnames, stage, **details):
+        """
+        Records a stage as completed for several zipfiles, with a single write
+        :param fnames:
+        :param stage:
+        :param details:
+        :returns: None
+        """
+        if stage not in STAGES:
+            raise ValueError('Unknown checkpoint stage: %s' % (stage))
+        at = time.strftime('%Y-%m-%d %H:%M:%S')
+        records = []
+        for fname in fnames:
+            record = dict(details)
+            record.update({'zip': fname, 'stage': stage, 'at': at})
+            records.append(record)
+        if not records:
+            return
+        with self.lock:
+            if self.journal_file is not None:
+                self._append(''.join([json.dumps(record, sort_keys=True) + '\n' for record in records]))
+            for record in records:
+                self._add(record)
+
+    def _append(self, data):
+        with open(self.journal_file, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def resumed(self, fnames):
+        """
+        Returns the zipfiles of a batch with at least one completed stage, i.e. those being resumed
+        :param fnames:
+        :returns: list
+        """
+        return [fname for fname in fnames if self.completed.get(fname)]
+
+    def compact(self, fnames):
+        """
+        Keeps only the records of the given zipfiles (i.e. those still in the batch folder) - the journal is rewritten to a
+        ".part" file and renamed into place, or removed if nothing is left
+        :param fnames:
+        :returns: None
+        """
+        keep = set(fnames)
+        with self.lock:
+            self.completed = dict([(fname, stages) for fname, stages in self.completed.items() if fname in keep])
+            self.details = dict([(key, record) for key, record in self.details.items() if key[0] in keep])
+            if self.journal_file is None:
+                return
+            records = sorted(self.details.values(), key=lambda record: (record['zip'], STAGES.index(record['stage'])))
+            if not records:
+                if os.path.exists(self.journal_file):
+                    os.remove(self.journal_file)
+                return
+            part_filename = self.journal_file + '.part'
+            with open(part_filename, 'wb') as f:
+                f.write(''.join([json.dumps(record, sort_keys=True) + '\n' for record in records]))
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            os.rename(part_filename, self.journal_file)
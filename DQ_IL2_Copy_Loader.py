@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Copy_Loader.py
+
+DESCRIPTION:
+
+Streams rows into a database table with COPY ... FROM STDIN (psycopg2 copy_expert), as they are produced, rather than
+writing them to a csv file for gpload to pick up with a gpfdist server (used by DQ_IL2_index_raw_msg when LOAD_BACKEND is
+"copy").
+
+The rows are buffered in memory as csv and sent with one COPY per COPY_CHUNK_ROWS rows, so the memory used does not grow
+with the no. of rows. The chunks are copied (and committed one at a time) into a session temporary table like the target
+table, so the target table is not touched while the rows are being produced. commit() copies the last chunk, then runs the
+TRUNCATE (if any - the PRELOAD TRUNCATE of the gpload control file) and an INSERT ... SELECT from the temporary table in one
+short transaction - the target table is only locked (ACCESS EXCLUSIVE, by the TRUNCATE) while the rows are inserted, and it
+is either fully loaded or left as it was.
+
+The connection is only opened when the first chunk is sent (or by commit(), if there are fewer rows than a chunk), so it is
+not left idle while the rows are being produced. If it cannot be opened, the rows are still buffered (see write_pending).
+
+Unlike gpload (ERROR_LIMIT: 6, with the bad rows written to the error table), COPY has no error limit - a single bad row
+fails the whole load, which is rolled back.
+"""
+
+import csv
+import time
+import cStringIO
+
+DEFAULT_CHUNK_ROWS = 10000
+
+
+class CopyStreamLoader(object):
+    """
+    Loads rows into a table in chunks, through a temporary table - see the module description
+    """
+
+    def __init__(self, connect, table, columns, chunk_rows=DEFAULT_CHUNK_ROWS, truncate=False):
+        """
+        :param connect: function returning a psycopg2 connection, called when the first chunk is sent
+        :param table: e.g. stage.load_raw_message_guid
+        :param columns: the column names, in the order of the rows
+        :param chunk_rows: the no. of rows sent per COPY
+        :param truncate: truncate the table (in the same transaction as the INSERT) before the rows are loaded
+        """
+        self.connect = connect
+        self.conn = None
+        self.cur = None
+        self.table = table
+        self.columns = ', '.join(columns)
+        # Temporary tables cannot be schema qualified
+        self.temp_table = 'copy_%s' % (table.split('.')[-1])
+        self.sql = 'COPY %s (%s) FROM STDIN WITH CSV' % (self.temp_table, self.columns)
+        self.chunk_rows = max(chunk_rows, 1)
+        self.truncate = truncate
+        self.row_count = 0
+        self.chunk_count = 0
+        self.copy_secs = 0.0
+        self._new_buffer()
+
+    def _new_buffer(self):
+        self.buffer = cStringIO.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\n')
+        self.pending = 0
+
+    def connected(self):
+        return self.conn is not None
+
+    def _open(self):
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute('CREATE TEMPORARY TABLE %s (LIKE %s)' % (self.temp_table, self.table))
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        self.conn = conn
+        self.cur = cur
+
+    def add_row(self, row):
+        """
+        Adds a row, sending the chunk once it is full
+        :param row: tuple of values (None for NULL)
+        :returns: None
+        """
+        self.writer.writerow(row)
+        self.pending += 1
+        if self.pending >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Copies the rows added since the last chunk into the temporary table (opening the connection with the first chunk)
+        :returns: int (the no. of rows sent)
+        """
+        if self.conn is None:
+            self._open()
+        if not self.pending:
+            return 0
+        sent = self.pending
+        start_time = time.time()
+        self.buffer.seek(0)
+        self.cur.copy_expert(self.sql, self.buffer)
+        self.conn.commit()
+        self.copy_secs += time.time() - start_time
+        self.row_count += sent
+        self.chunk_count += 1
+        self._new_buffer()
+        return sent
+
+    def commit(self):
+        """
+        Sends the last chunk, then truncates the table (if set) and inserts the rows of the temporary table in one transaction
+        :returns: int (the no. of rows loaded)
+        """
+        self.flush()
+        start_time = time.time()
+        if self.truncate:
+            self.cur.execute('TRUNCATE TABLE %s' % (self.table))
+        self.cur.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (self.table, self.columns, self.columns, self.temp_table))
+        self.conn.commit()
+        self.copy_secs += time.time() - start_time
+        self.truncate = False
+        return self.row_count
+
+    def rollback(self):
+        """
+        Discards the buffered rows (and the TRUNCATE and INSERT, if commit() failed) - the target table is left as it was
+        :returns: None
+        """
+        self._new_buffer()
+        if self.conn is not None:
+            self.conn.rollback()
+
+    def write_pending(self, f):
+        """
+        Writes the rows not yet sent to a file, as csv (e.g. if the connection could not be opened)
+        :param f: file object
+        :returns: int (the no. of rows written)
+        """
+        written = self.pending
+        f.write(self.buffer.getvalue())
+        self._new_buffer()
+        return written
+
+    def close(self):
+        """
+        Closes the connection (which drops the temporary table), if it was opened
+        :returns: None
+        """
+        if self.conn is not None:
+            self.cur.close()
+            self.conn.close()
@@ -7,6 +7,8 @@
 # DATE:        2016/02/12
 #
 # This script loads GA xml files to the GA database:
+# - Moves the GA xml files to the inprocess folder - taken from the parse indexes of the GA folder when there are any (see
+#   DQ_IL2_Parse_Index.py), otherwise the folder is listed
 # - Preprocesses files
 # - Loads files to the PG database (retries on failure x times as configured in parameter file)
 #
@@ -14,8 +16,12 @@
 ##############################################################################################################################
 
 ### IMPORT PYTHON MODULES ####################################################################################################
-import os, re, time, sys, shutil, fileinput, datetime, ConfigParser
+import os, re, time, sys, shutil, fileinput, datetime, ConfigParser, errno
 import psycopg2
+import DQ_IL2_Sharded_Dir
+import DQ_IL2_Metrics
+import DQ_IL2_Parse_Index
+from DQ_IL2_Flight_Router import GA
 
 ### GLOBAL VARIABLES #########################################################################################################
 YYYYMMDDSTR = time.strftime("%Y%m%d")
@@ -66,6 +72,8 @@ def main(argv):
     REJECT_FILE_DIR=os.path.join(ROOT_DIR, 'reject/')
     LOGFILE_DIR=os.path.join(ROOT_DIR, 'log/')
     OUTPUT_MOD_FILENAME=GA_CONCAT_OUTPUT_DIR + 'GA_PARSED_CONCAT_SOURCE.xml.MOD'
+    RUN_HISTORY=DQ_IL2_Metrics.run_history_file(ROOT_DIR)
+    METRICS=DQ_IL2_Metrics.RunMetrics('DQ_IL2_DB_GA_Postgres_Load_XML')
     
     FILE_COUNTER=0
 
@@ -80,22 +88,40 @@ def main(argv):
     ##############################################################################################################################
 
     print '\n*** Move xml files'
-    source_dir_list = [f for f in os.listdir(SOURCE_FILE_DIR) if f.lower().endswith(".xml")]
-    if source_dir_list:
-       FILE_COUNT=0
-       for fname in source_dir_list:
-          fname=SOURCE_FILE_DIR + fname
-          shutil.move(fname,INPROCESS_FILE_DIR + os.path.basename(fname))
-          FILE_COUNT+=1
-       add_log_entry('MOVE XML FILES', 'Moved ' + str(FILE_COUNT) + ' files')
-    else:
-       add_log_entry('MOVE XML FILES', 'No xml files')
+    with METRICS.stage('move files') as STAGE:
+       SOURCE_INDEX = DQ_IL2_Parse_Index.IndexQueue(SOURCE_FILE_DIR)
+       if SOURCE_INDEX.has_indexes():
+          # Only the GA messages listed in the parse indexes are taken, without listing the folder
+          source_dir_list = [entry[0] for entry in SOURCE_INDEX.take() if entry[2] in (GA, None)]
+       else:
+          source_dir_list = DQ_IL2_Sharded_Dir.list_files(SOURCE_FILE_DIR, ".xml")   # relative to SOURCE_FILE_DIR, including any shard subfolder
+       if source_dir_list:
+          FILE_COUNT=0
+          MISSING_COUNT=0
+          for fname in source_dir_list:
+             fname=SOURCE_FILE_DIR + fname
+             try:
+                shutil.move(fname,INPROCESS_FILE_DIR + os.path.basename(fname))
+             except (IOError, OSError), e:
+                # A file listed in a parse index may already have been moved (e.g. by an earlier run which listed the folder)
+                if e.errno != errno.ENOENT:
+                   raise
+                MISSING_COUNT+=1
+                continue
+             FILE_COUNT+=1
+          add_log_entry('MOVE XML FILES', 'Moved ' + str(FILE_COUNT) + ' files' + (' (' + str(MISSING_COUNT) + ' indexed file(s) not found)' if MISSING_COUNT else ''))
+          STAGE.file_count=FILE_COUNT
+       else:
+          add_log_entry('MOVE XML FILES', 'No xml files')
+       SOURCE_INDEX.commit()
+       DQ_IL2_Sharded_Dir.remove_empty_shards(SOURCE_FILE_DIR)
        
     ##############################################################################################################################
     # Preprocess files
     ##############################################################################################################################
 
     print '\n*** Concat xml files'
+    CONCAT_STARTTIME=time.time()
     OUTPUT_MOD_FILE = open(OUTPUT_MOD_FILENAME, 'wb')
     inprocess_dir_list = [f for f in os.listdir(INPROCESS_FILE_DIR) if f.lower().endswith(".xml")]
     if inprocess_dir_list:
@@ -121,6 +147,7 @@ def main(argv):
        add_log_entry('CONCAT XML FILES', 'No xml files')
        
     OUTPUT_MOD_FILE.close()
+    METRICS.record_stage('concat', time.time() - CONCAT_STARTTIME, len(inprocess_dir_list), os.path.getsize(OUTPUT_MOD_FILENAME))
     
     ##############################################################################################################################
     # Run POSTGRES load
@@ -151,6 +178,7 @@ def main(argv):
         for file_name in concat_inprocess_dir_list:
             f = open(GA_CONCAT_OUTPUT_DIR + file_name, 'r')
             add_log_entry('RUNNING SQL...','TRUNCATING AND LOADING TABLE '+PG_LOAD_TABLE)
+            COPY_STARTTIME=time.time()
             try:
                 cur.execute('TRUNCATE TABLE ' + PG_LOAD_TABLE + ';')
                 conn.commit()
@@ -159,9 +187,11 @@ def main(argv):
                 f.close()
                 cur.close()
                 add_log_entry('SQL FAILED', str(e))
+                METRICS.write(RUN_HISTORY, 'failed')
                 sys.exit(1)
             #rowcount=cur.rowcount
             conn.commit()
+            METRICS.record_stage('copy', time.time() - COPY_STARTTIME, len(inprocess_dir_list), os.path.getsize(GA_CONCAT_OUTPUT_DIR + file_name))
             f.close()
             add_log_entry('GA FILE LOADED ', file_name )
         cur.close()
@@ -175,6 +205,11 @@ def main(argv):
     ##############################################################################################################################
     # SCRIPT END
     ##############################################################################################################################
+    for LINE in METRICS.summary_lines():
+        add_log_entry('STAGE METRICS', LINE)
+    if not METRICS.write(RUN_HISTORY):
+        add_log_entry('RUN HISTORY', 'Error writing ' + RUN_HISTORY)
+
     ENDTIME = datetime.datetime.now()
     delta = ENDTIME - STARTTIME
     add_log_entry('*** RUN COMPLETE ***', time.strftime("%Y%m%d%H%M%S") + ' (ELAPSED TIME: ' + str(delta.seconds) + '.' + str(delta.microseconds) + ' sec(s))')
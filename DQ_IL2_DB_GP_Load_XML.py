@@ -8,11 +8,15 @@
 #
 # This script moves files to an inprocess folder, runs a batch file and archives files
 #
+# The batch file is run under DQ_IL2_Loader_Supervisor.py - with -m <secs>, it is killed (with the gpload.py and gpfdist
+# processes it started) once it has run for that long
 #
 ##############################################################################################################################
 
 ### IMPORT PYTHON MODULES ####################################################################################################
 import os, re, time, sys, shutil, fileinput, getopt, datetime
+import DQ_IL2_Loader_Supervisor
+import DQ_IL2_Metrics
 #from datetime import datetime
 
 ### GLOBAL VARIABLES #########################################################################################################
@@ -34,6 +38,7 @@ def main(argv):
     ### THESE FOLDERS MUST EXIST #################################################################################################
     ROOT_DIR=''
     DOS_BATCH_FILE=''
+    GPLOAD_MAX_RUNTIME_SECS=0
 
     MAX_GPLOAD_RETRIES=3
     SLEEPTIME=3
@@ -41,7 +46,7 @@ def main(argv):
     STARTTIME = datetime.datetime.now()
 
     try:
-          opts, args = getopt.getopt(argv,"dr:b:s:t:")
+          opts, args = getopt.getopt(argv,"dr:b:s:t:m:")
     except getopt.GetoptError:
         print 'Opt error'
         sys.exit(2)
@@ -54,12 +59,16 @@ def main(argv):
              DOS_BATCH_FILE = arg
           elif opt in ("-t"):
              SLEEPTIME = int(arg)
+          elif opt in ("-m"):
+             GPLOAD_MAX_RUNTIME_SECS = int(arg)
     
     TARGET_FILE_DIR=os.path.join(ROOT_DIR, 'tmp/')
     ARCHIVE_FILE_DIR=os.path.join(ROOT_DIR, 'archive/')
     LOGFILE_DIR=os.path.join(ROOT_DIR, 'log/')
     SOURCE_FILE_DIR=os.path.join(ROOT_DIR, 'csv/')
     INPROCESS_FILE_DIR=os.path.join(ROOT_DIR, 'xml_inprocess/')
+    RUN_HISTORY=DQ_IL2_Metrics.run_history_file(ROOT_DIR)
+    METRICS=DQ_IL2_Metrics.RunMetrics('DQ_IL2_DB_GP_Load_XML', {'DOS_BATCH_FILE': os.path.basename(DOS_BATCH_FILE)})
     
     FILE_COUNTER=0
 
@@ -88,40 +97,39 @@ def main(argv):
     ##############################################################################################################################
     print '\n*** Run the batch file: ' + DOS_BATCH_FILE
 
-    RETRY_COUNT=0
-    
-    while True:
-
-        os.system("cd " + ROOT_DIR + "/scripts")
-        RETURN_CODE=os.system(DOS_BATCH_FILE)
-        
-        # GPLOAD RETURN CODES:
-        # 0 No Error
-        # 1 Warning
-        # 2 Failure
-        if RETURN_CODE not in (0,1):
-            add_log_entry(LOGFILE,'GPLOAD BATCH FILE FAILED', DOS_BATCH_FILE + ' failed: ' + str(RETURN_CODE))
-
-            if RETRY_COUNT < MAX_GPLOAD_RETRIES:
-                RETRY_COUNT += 1
-                add_log_entry(LOGFILE,'GPLOAD', 'Retry attempt: ' + str(RETRY_COUNT))
-                time.sleep(SLEEPTIME)
-            else:
-                ENDTIME = datetime.datetime.now()
-                delta = ENDTIME - STARTTIME
-                LOGFILE.write('--------------------------------------------------------------------\n')
-                add_log_entry(LOGFILE,'*** RUN FAILED ***', time.strftime("%Y%m%d%H%M%S") + ' (ELAPSED TIME: ' + str(delta.seconds) + '.' + str(delta.microseconds) + ' sec(s))')
-                LOGFILE.write('--------------------------------------------------------------------\n')
-                LOGFILE.close()
-                sys.exit(1)
-        else:
-            break
+    LOAD_BYTES=sum([os.path.getsize(os.path.join(INPROCESS_FILE_DIR, f)) for f in source_dir_list])
+    LOAD_STARTTIME=time.time()
+
+    # GPLOAD RETURN CODES:
+    # 0 No Error
+    # 1 Warning
+    # 2 Failure
+    RESULT=DQ_IL2_Loader_Supervisor.run_loader_with_retries(DOS_BATCH_FILE, attempts=MAX_GPLOAD_RETRIES + 1, retry_delay_secs=SLEEPTIME,
+                                                           log=lambda SUMMARY, MSG: add_log_entry(LOGFILE, SUMMARY, MSG),
+                                                           max_runtime_secs=GPLOAD_MAX_RUNTIME_SECS, cwd=os.path.join(ROOT_DIR, 'scripts'), shell=True)
+    if not RESULT.succeeded():
+        add_log_entry(LOGFILE,'GPLOAD BATCH FILE FAILED', DOS_BATCH_FILE + ' failed after ' + str(RESULT.attempt) + ' attempt(s): ' + RESULT.summary())
+        METRICS.record_stage('gpload', time.time() - LOAD_STARTTIME, len(source_dir_list), LOAD_BYTES)
+        METRICS.write(RUN_HISTORY, 'failed')
+        ENDTIME = datetime.datetime.now()
+        delta = ENDTIME - STARTTIME
+        LOGFILE.write('--------------------------------------------------------------------\n')
+        add_log_entry(LOGFILE,'*** RUN FAILED ***', time.strftime("%Y%m%d%H%M%S") + ' (ELAPSED TIME: ' + str(delta.seconds) + '.' + str(delta.microseconds) + ' sec(s))')
+        LOGFILE.write('--------------------------------------------------------------------\n')
+        LOGFILE.close()
+        sys.exit(1)
 
     add_log_entry(LOGFILE,'GPLOAD BATCH FILE RUN', 'COMPLETED SUCCESSFULLY')
+    METRICS.record_stage('gpload', time.time() - LOAD_STARTTIME, len(source_dir_list), LOAD_BYTES)
     
     ##############################################################################################################################
     # SCRIPT END
     ##############################################################################################################################
+    for LINE in METRICS.summary_lines():
+        add_log_entry(LOGFILE,'STAGE METRICS', LINE)
+    if not METRICS.write(RUN_HISTORY):
+        add_log_entry(LOGFILE,'RUN HISTORY', 'Error writing ' + RUN_HISTORY)
+
     ENDTIME = datetime.datetime.now()
     delta = ENDTIME - STARTTIME
     LOGFILE.write('--------------------------------------------------------------------\n')
@@ -8,11 +8,14 @@
 #
 # This script moves files to an inprocess folder, runs a batch file and archives files
 #
+# The batch file is run under DQ_IL2_Loader_Supervisor.py - with -m <secs>, it is killed (with the gpload.py and gpfdist
+# processes it started) once it has run for that long
 #
 ##############################################################################################################################
 
 ### IMPORT PYTHON MODULES ####################################################################################################
 import os, re, time, sys, shutil, fileinput, getopt, datetime
+import DQ_IL2_Loader_Supervisor
 #from datetime import datetime
 
 ### GLOBAL VARIABLES #########################################################################################################
@@ -34,11 +37,12 @@ def main(argv):
     ### THESE FOLDERS MUST EXIST #################################################################################################
     ROOT_DIR=''
     DOS_BATCH_FILE=''
+    GPLOAD_MAX_RUNTIME_SECS=0
     ### OTHER VARIABLES ##########################################################################################################
     STARTTIME = datetime.datetime.now()
 
     try:
-          opts, args = getopt.getopt(argv,"dr:b:s:")
+          opts, args = getopt.getopt(argv,"dr:b:s:m:")
     except getopt.GetoptError:
         print 'Opt error'
         sys.exit(2)
@@ -49,6 +53,8 @@ def main(argv):
              ROOT_DIR = re.sub("/*$","/",arg)
           elif opt in ("-b"):
              DOS_BATCH_FILE = arg
+          elif opt in ("-m"):
+             GPLOAD_MAX_RUNTIME_SECS = int(arg)
     
     TARGET_FILE_DIR=os.path.join(ROOT_DIR, 'tmp/')
     ARCHIVE_FILE_DIR=os.path.join(ROOT_DIR, 'archive/')
@@ -82,16 +88,15 @@ def main(argv):
     ##############################################################################################################################
     print '\n*** Run the batch file: ' + DOS_BATCH_FILE
 
-    os.system("cd " + ROOT_DIR + "/scripts")
-    RETURN_CODE=os.system(DOS_BATCH_FILE)
-
     # GPLOAD RETURN CODES:
     # 0 No Error
     # 1 Warning
     # 2 Failure
-    if RETURN_CODE not in (0,1):
-        print DOS_BATCH_FILE + ' failed' + str(RETURN_CODE)
-        add_log_entry(LOGFILE,'GPLOAD BATCH FILE FAILED', DOS_BATCH_FILE + ' failed: ' + str(RETURN_CODE))
+    RESULT=DQ_IL2_Loader_Supervisor.run_loader(DOS_BATCH_FILE, max_runtime_secs=GPLOAD_MAX_RUNTIME_SECS, cwd=os.path.join(ROOT_DIR, 'scripts'),
+                                              shell=True, log=lambda SUMMARY, MSG: add_log_entry(LOGFILE, SUMMARY, MSG))
+    if not RESULT.succeeded():
+        print DOS_BATCH_FILE + ' failed: ' + RESULT.summary()
+        add_log_entry(LOGFILE,'GPLOAD BATCH FILE FAILED', DOS_BATCH_FILE + ' failed: ' + RESULT.summary())
         ENDTIME = datetime.datetime.now()
         delta = ENDTIME - STARTTIME
         LOGFILE.write('--------------------------------------------------------------------\n')
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Dedup.py
+
+DESCRIPTION:
+
+A content-addressed index of the zipfiles and messages received by DQ_IL2_Seq_Check (used when DEDUP_INDEX is set), so a
+zipfile re-delivered by upstream, or a message repeated in several PARSED zipfiles, is not unzipped, parsed and loaded again.
+
+Tables (SQLite):
+
+    zips        (sha1, filename, size, seen_at)          - one row per PARSED zipfile parsed and archived
+    messages    (sha1, filename, source_zip, seen_at)    - one row per xml message parsed
+
+- Before a batch is parsed, the sha1 of each PARSED zipfile is looked up - a zipfile with the content of another (in this
+  batch, or parsed by an earlier one) is not parsed, but is archived (and staged for the AWS data feed) as usual. The
+  zipfiles are only recorded once they have been parsed and archived, and a zipfile never matches a row with its own
+  filename - a zipfile whose batch failed, or re-sent under the same name, is parsed again (its messages are still
+  deduplicated)
+- Each worker looks up the sha1 of each xml message before it is classified - a message already seen is not written to the
+  output folders. A message is only recorded once it has been written (or found to be a PNR), not if it is rejected. When
+  stream parsing, the messages of a zipfile are recorded by the worker (in a single transaction) once they have all been
+  written, so a zipfile interrupted part way through is parsed again in full. Otherwise the xmls are parsed one at a time
+  and the parent records the messages from the parse results, a batch at a time (in a single transaction per batch)
+- Rows older than DEDUP_RETENTION_HRS are evicted before each batch, so the index only grows with the recent volume
+
+The workers share the index through SQLite's own locking (in WAL mode, readers do not block the writer). Two workers parsing
+the same message at the same time may both write it - the index only avoids work, it does not guarantee a message is written
+once. Errors using the index are not raised (the message is treated as new) - deduplication must never fail a batch.
+"""
+
+import time
+import hashlib
+import sqlite3
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS zips (sha1 TEXT NOT NULL PRIMARY KEY, filename TEXT NOT NULL, size INTEGER NOT NULL, '
+          'seen_at REAL NOT NULL)',
+          'CREATE TABLE IF NOT EXISTS messages (sha1 TEXT NOT NULL PRIMARY KEY, filename TEXT NOT NULL, source_zip TEXT, '
+          'seen_at REAL NOT NULL)',
+          'CREATE INDEX IF NOT EXISTS zips_seen_at ON zips (seen_at)',
+          'CREATE INDEX IF NOT EXISTS messages_seen_at ON messages (seen_at)']
+
+LOCK_TIMEOUT_SECS = 30.0
+
+
+def content_sha1(data):
+    """
+    Returns the sha1 of a message
+    :param data:
+    :returns: string
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+class DedupIndex(object):
+    """
+    The zipfile and message hashes - see the module description
+    """
+
+    def __init__(self, dedup_filename, retention_secs=None):
+        """
+        Opens (and creates, if needed) the index
+        :param dedup_filename:
+        :param retention_secs: rows older than this are removed by evict() - None to keep every row
+        """
+        self.retention_secs = retention_secs
+        self.errors = 0
+        self.conn = sqlite3.connect(dedup_filename, timeout=LOCK_TIMEOUT_SECS)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        self.conn.close()
+
+    def evict(self, now=None):
+        """
+        Removes the zipfiles and messages seen more than retention_secs ago
+        :param now: seconds since the epoch (defaults to now)
+        :returns: tuple (no. of zipfiles removed, no. of messages removed)
+        """
+        if self.retention_secs is None:
+            return 0, 0
+        cutoff = (time.time() if now is None else now) - self.retention_secs
+        try:
+            with self.conn:
+                zip_count = self.conn.execute('DELETE FROM zips WHERE seen_at < ?', (cutoff,)).rowcount
+                message_count = self.conn.execute('DELETE FROM messages WHERE seen_at < ?', (cutoff,)).rowcount
+        except sqlite3.Error:
+            self.errors += 1
+            return 0, 0
+        return zip_count, message_count
+
+    def check_zips(self, entries):
+        """
+        Returns the zipfiles with the content of a zipfile already recorded under another filename - nothing is recorded
+        (see record_zips). A zipfile with the same content as another in the same list is a duplicate of the first
+        :param entries: list of (filename, size, sha1)
+        :returns: dict of filename to the filename it duplicates
+        """
+        duplicates = {}
+        first_filenames = {}
+        try:
+            for filename, size, sha1 in entries:
+                row = self.conn.execute('SELECT filename FROM zips WHERE sha1 = ?', (sha1,)).fetchone()
+                if row is not None and row[0] != filename:
+                    duplicates[filename] = row[0]
+                elif sha1 in first_filenames:
+                    duplicates[filename] = first_filenames[sha1]
+                else:
+                    first_filenames[sha1] = filename
+        except sqlite3.Error:
+            self.errors += 1
+            return {}
+        return duplicates
+
+    def record_zips(self, entries):
+        """
+        Records zipfiles as seen (in a single transaction), once they have been parsed
+        :param entries: list of (filename, size, sha1)
+        :returns: bool (True if recorded)
+        """
+        if not entries:
+            return True
+        seen_at = time.time()
+        try:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO zips (sha1, filename, size, seen_at) VALUES (?, ?, ?, ?)',
+                                      [(sha1, filename, size, seen_at) for filename, size, sha1 in entries])
+        except sqlite3.Error:
+            self.errors += 1
+            return False
+        return True
+
+    def message_seen(self, sha1):
+        """
+        Returns the filename of the message already seen with this sha1, if any
+        :param sha1:
+        :returns: string or None
+        """
+        try:
+            row = self.conn.execute('SELECT filename FROM messages WHERE sha1 = ?', (sha1,)).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            return None
+        return row[0] if row is not None else None
+
+    def record_messages(self, entries):
+        """
+        Records messages as seen (in a single transaction)
+        :param entries: list of (sha1, filename, source zip)
+        :returns: bool (True if recorded)
+        """
+        if not entries:
+            return True
+        seen_at = time.time()
+        try:
+            with self.conn:
+                self.conn.executemany('INSERT OR IGNORE INTO messages (sha1, filename, source_zip, seen_at) VALUES (?, ?, ?, ?)',
+                                      [(sha1, filename, source_zip, seen_at) for sha1, filename, source_zip in entries])
+        except sqlite3.Error:
+            self.errors += 1
+            return False
+        return True
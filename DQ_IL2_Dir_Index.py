@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Dir_Index.py
+
+DESCRIPTION:
+
+A per-run index of the directories used by DQ_IL2_Seq_Check, so that each directory is only listed once per run:
+- directories are read with scandir (os.scandir, or the scandir package on python 2) where available, otherwise listdir
+- entries are bucketed by filetype (RAW, PARSED, STORED, FAILED) with one precompiled regex
+- large queue directories (e.g. "out") can be scanned for a count only, without holding every filename in memory
+- files moved through the index update the buckets and counts of both directories, so no re-listing is needed
+"""
+
+import os
+import re
+import shutil
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def iter_dir_names(path):
+    """
+    Yields the names of the entries in a directory, using scandir when available
+    :param path:
+    :returns: generator
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name
+    else:
+        for name in os.listdir(path):
+            yield name
+
+
+def count_dir_entries(path, suffix=None):
+    """
+    Returns the number of entries in a directory (optionally only those ending with suffix) without building a list
+    :param path:
+    :param suffix:
+    :returns: int
+    """
+    count = 0
+    for name in iter_dir_names(path):
+        if suffix is None or name.endswith(suffix):
+            count += 1
+    return count
+
+
+def compile_filetype_regex(filetype_regexes):
+    """
+    Combines the per-filetype regexes into one regex with a named group per filetype
+    :param filetype_regexes: dict of filetype to regex, e.g. {'RAW': r'^RAW_[0-9]{8}_[0-9]{4}_[0-9]{4}.*\.zip$'}
+    :returns: compiled regex, the matching filetype is given by match.lastgroup
+    """
+    return re.compile('|'.join(['(?P<%s>%s)' % (filetype, regex) for filetype, regex in sorted(filetype_regexes.items())]))
+
+
+class DirectoryIndex(object):
+    """
+    Scans each directory once and buckets the matching filenames by filetype
+    """
+
+    def __init__(self, filetype_regexes):
+        """
+        :param filetype_regexes: dict of filetype to regex
+        """
+        self.filetypes = sorted(filetype_regexes.keys())
+        self.filetype_regex = compile_filetype_regex(filetype_regexes)
+        self.buckets = {}
+        self.counts = {}
+
+    def scan(self, path, count_only=False):
+        """
+        Scans a directory (once - later calls return the indexed values) and returns its bucketed filenames
+        :param path:
+        :param count_only: only count the entries (for large queue directories), filenames are not held
+        :returns: dict of filetype to set of filenames (empty if count_only)
+        """
+        if path in self.counts and (count_only or path in self.buckets):
+            return self.buckets.get(path, {})
+
+        buckets = dict([(filetype, set()) for filetype in self.filetypes])
+        count = 0
+        if count_only:
+            count = count_dir_entries(path)
+        else:
+            match = self.filetype_regex.match
+            for name in iter_dir_names(path):
+                count += 1
+                m = match(name)
+                if m:
+                    buckets[m.lastgroup].add(name)
+            self.buckets[path] = buckets
+
+        self.counts[path] = count
+        return self.buckets.get(path, {})
+
+    def rescan(self, path, count_only=False):
+        """
+        Discards the indexed values for a directory and scans it again
+        :param path:
+        :param count_only:
+        :returns: dict of filetype to set of filenames
+        """
+        self.buckets.pop(path, None)
+        self.counts.pop(path, None)
+        return self.scan(path, count_only=count_only)
+
+    def files(self, path, filetype=None):
+        """
+        Returns the sorted filenames matching the filetype regex (optionally for a single filetype)
+        :param path:
+        :param filetype:
+        :returns: list
+        """
+        buckets = self.scan(path)
+        if filetype is not None:
+            return sorted(buckets[filetype])
+        return sorted([name for filetype in self.filetypes for name in buckets[filetype]])
+
+    def count(self, path, filetype=None):
+        """
+        Returns the number of entries in a directory, or the number of matching files of a filetype
+        :param path:
+        :param filetype:
+        :returns: int
+        """
+        if filetype is None:
+            self.scan(path, count_only=path not in self.buckets)
+            return self.counts[path]
+        return len(self.scan(path)[filetype])
+
+    def matched_count(self, path):
+        """
+        Returns the number of files matching any filetype
+        :param path:
+        :returns: int
+        """
+        buckets = self.scan(path)
+        return sum([len(buckets[filetype]) for filetype in self.filetypes])
+
+    def move(self, filename, from_path, to_path):
+        """
+        Moves a file and updates the index of both directories
+        :param filename:
+        :param from_path:
+        :param to_path:
+        :returns: None
+        """
+        shutil.move(os.path.join(from_path, filename), os.path.join(to_path, filename))
+
+        m = self.filetype_regex.match(filename)
+        for path, delta in ((from_path, -1), (to_path, 1)):
+            if path in self.counts:
+                self.counts[path] += delta
+            if m and path in self.buckets:
+                if delta > 0:
+                    self.buckets[path][m.lastgroup].add(filename)
+                else:
+                    self.buckets[path][m.lastgroup].discard(filename)
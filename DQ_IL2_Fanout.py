@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Fanout.py
+
+DESCRIPTION:
+
+Puts a file into a second folder without duplicating its bytes where possible (e.g. GA messages, which are written to both
+the "out" and the GA folder):
+- link_or_copy hardlinks the file into the target folder when both are on the same volume (os.link, or CreateHardLinkW on
+  Windows under python 2, which has no os.link) and falls back to a copy otherwise (different volume, or a filesystem
+  without hardlink support)
+- copies are written to a ".part" file, then renamed into place, so that downstream processes listing *.xml or *.zip never
+  pick up a partially written file. A hardlink appears complete, so it is created in place
+
+Note that a hardlinked file shares its content with the original, so neither must be modified in place (the pipeline only
+ever reads, moves or removes them).
+"""
+
+import os
+import shutil
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+if hasattr(os, 'link'):
+    def create_hard_link(source, target):
+        """
+        Creates a hardlink
+        :param source:
+        :param target:
+        :returns: None
+        """
+        os.link(source, target)
+else:
+    import ctypes
+
+    def create_hard_link(source, target):
+        """
+        Creates a hardlink (Windows, python 2)
+        :param source:
+        :param target:
+        :returns: None
+        """
+        if not ctypes.windll.kernel32.CreateHardLinkW(unicode(target), unicode(source), None):
+            raise OSError(ctypes.GetLastError(), 'CreateHardLinkW failed: %s -> %s' % (source, target))
+
+
+def copy_file_atomically(source, target, buffer_size=COPY_BUFFER_SIZE):
+    """
+    Copies a file in chunks to a ".part" file alongside the target, then renames it into place
+    :param source:
+    :param target:
+    :param buffer_size:
+    :returns: None
+    """
+    part_filename = target + '.part'
+    with open(source, 'rb') as fsrc:
+        with open(part_filename, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, buffer_size)
+    shutil.copystat(source, part_filename)
+    if os.path.exists(target):
+        os.remove(target)
+    os.rename(part_filename, target)
+
+
+def same_file(source, target):
+    """
+    Returns True if source and target are the same path, or (where os.path.samefile is available) the same file
+    :param source:
+    :param target:
+    :returns: bool
+    """
+    if os.path.normcase(os.path.abspath(source)) == os.path.normcase(os.path.abspath(target)):
+        return True
+    return hasattr(os.path, 'samefile') and os.path.exists(target) and os.path.samefile(source, target)
+
+
+def link_or_copy(source, target):
+    """
+    Hardlinks source to target, or copies it if the link cannot be created (e.g. across volumes). An existing target is
+    replaced - unless it is the source itself (e.g. the same folder configured twice), which is left as it is
+    :param source:
+    :param target:
+    :returns: string ('link' or 'copy')
+    """
+    if same_file(source, target):
+        # Removing the target would remove the only copy
+        return 'link'
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        create_hard_link(source, target)
+        return 'link'
+    except (OSError, AttributeError):
+        copy_file_atomically(source, target)
+        return 'copy'
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Flight_Router.py
+
+DESCRIPTION:
+
+Classifies flightIds as GA, COMMERCIAL or UNKNOWN using the carrier codes held in the MDS extract, e.g.
+
+    IATA,ZZ
+    ICAO,ZZZ
+    COMMERCIAL_IATA,BA
+    COMMERCIAL_ICAO,BAW
+
+A flightId is:
+- GA if it is prefixed with "_GA" or starts with a GA (IATA/ICAO) carrier code followed by a digit
+- COMMERCIAL if it starts with a COMMERCIAL_IATA/COMMERCIAL_ICAO carrier code followed by a digit
+- UNKNOWN otherwise
+
+All carrier codes are held in two dicts (2 character IATA codes, 3 character ICAO codes) mapping the code to its class, so
+each flightId is classified with at most two hashed lookups. Where a code is held as both GA and COMMERCIAL, GA wins.
+"""
+
+GA = 'GA'
+COMMERCIAL = 'COMMERCIAL'
+UNKNOWN = 'UNKNOWN'
+FLIGHT_CLASSES = (GA, COMMERCIAL, UNKNOWN)
+
+# MDS extract code standard -> (flight class, carrier code length)
+MDS_CLASSES = {'IATA': (GA, 2),
+               'ICAO': (GA, 3),
+               'COMMERCIAL_IATA': (COMMERCIAL, 2),
+               'COMMERCIAL_ICAO': (COMMERCIAL, 3)}
+
+DIGITS = frozenset('0123456789')
+
+
+class FlightRouter(object):
+    """
+    Hashed lookup tables for all MDS carrier classes
+    """
+
+    def __init__(self, carriers=None):
+        """
+        :param carriers: dict of MDS code standard (e.g. 'IATA', 'COMMERCIAL_ICAO') to an iterable of carrier codes
+        """
+        self.iata_carriers = {}
+        self.icao_carriers = {}
+
+        for code_standard, codes in (carriers or {}).items():
+            flight_class, code_length = MDS_CLASSES[code_standard]
+            lookup = self.iata_carriers if code_length == 2 else self.icao_carriers
+            for code in codes:
+                if lookup.get(code) != GA:
+                    lookup[code] = flight_class
+
+    def classify(self, flight_id):
+        """
+        Returns the class of a single flightId
+        :param flight_id:
+        :returns: string (GA, COMMERCIAL or UNKNOWN)
+        """
+        if flight_id[:3] == '_GA':
+            return GA
+
+        iata_class = self.iata_carriers.get(flight_id[:2]) if len(flight_id) > 2 and flight_id[2] in DIGITS else None
+        if iata_class == GA:
+            return GA
+
+        icao_class = self.icao_carriers.get(flight_id[:3]) if len(flight_id) > 3 and flight_id[3] in DIGITS else None
+        if icao_class == GA:
+            return GA
+
+        return iata_class or icao_class or UNKNOWN
+
+    def classify_message(self, flight_ids):
+        """
+        Returns the class of a message from all of its flightIds - GA if any flightId is GA, otherwise COMMERCIAL if any
+        flightId is COMMERCIAL, otherwise UNKNOWN
+        :param flight_ids:
+        :returns: string (GA, COMMERCIAL or UNKNOWN)
+        """
+        message_class = UNKNOWN
+        for flight_id in flight_ids:
+            flight_class = self.classify(flight_id)
+            if flight_class == GA:
+                return GA
+            elif flight_class == COMMERCIAL:
+                message_class = COMMERCIAL
+        return message_class
+
+    def counts(self):
+        """
+        Returns the number of carrier codes held per class, for logging
+        :returns: dict
+        """
+        counts = dict([(flight_class, 0) for flight_class in (GA, COMMERCIAL)])
+        for lookup in (self.iata_carriers, self.icao_carriers):
+            for flight_class in lookup.itervalues():
+                counts[flight_class] += 1
+        return counts
+
+
+def read_mds_carriers(mds_extract):
+    """
+    Reads the MDS extract and returns all carrier codes by MDS code standard
+    :param mds_extract:
+    :returns: dict of code standard to set of carrier codes
+    """
+    carriers = dict([(code_standard, set()) for code_standard in MDS_CLASSES])
+
+    with open(mds_extract, 'r') as mds_extract_file:
+        for row in mds_extract_file:
+            if not row.strip():
+                continue
+            fields = row.split(',')
+            code_standard = fields[0].strip()
+            carrier_code = fields[1].strip()
+            if code_standard in carriers:
+                carriers[code_standard].add(carrier_code)
+
+    return carriers
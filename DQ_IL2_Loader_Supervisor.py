@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Loader_Supervisor.py
+
+DESCRIPTION:
+
+Runs the loader subprocesses of the DQ_IL2 scripts (the GPLOAD batch files run by DQ_IL2_index_raw_msg,
+DQ_IL2_DB_GP_Load_XML and DQ_IL2_DB_GP_Load_XML_voyage_ext) under supervision, on Windows and Unix alike:
+
+- the child process is started in its own process group and waited on directly (on a waiter thread), so its exit is seen
+  as soon as it happens rather than at the next poll of the task list
+- the gpload log (e.g. the last-run log written by the batch file) is tailed as the child runs - only the lines added since
+  the last read are read, and the outcome ("|INFO|gpload succeeded" / "|INFO|gpload failed") and "|ERROR|" lines are taken
+  from them
+- a child still running after max_runtime_secs (GPLOAD_MAX_RUNTIME_SECS) is killed with its whole process group (the batch
+  file, gpload.py and its gpfdist server) - with taskkill /T on Windows, SIGTERM then SIGKILL to the group on Unix
+- the outcome, return code and duration of each attempt are returned as a LoaderResult, and failed attempts are retried
+  (see run_loader_with_retries)
+
+When the log has no outcome line (or there is no log), the outcome is taken from the return code (gpload: 0 no error,
+1 warning, 2 failure).
+"""
+
+import os
+import re
+import sys
+import time
+import signal
+import threading
+import subprocess
+
+GPLOAD_SUCCEEDED_REGEX = re.compile(r'\|INFO\|gpload succeeded')
+GPLOAD_FAILED_REGEX = re.compile(r'\|INFO\|gpload failed')
+GPLOAD_ERROR_REGEX = re.compile(r'\|ERROR\|')
+
+# GPLOAD return codes: 0 no error, 1 warning, 2 failure
+SUCCESS_RETURN_CODES = (0, 1)
+
+TAIL_INTERVAL_SECS = 1.0
+KILL_GRACE_SECS = 5.0
+
+CREATE_NEW_PROCESS_GROUP = getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0x00000200)
+
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+TIMED_OUT = 'timed out'
+
+
+class LogTail(object):
+    """
+    Reads the lines added to a log file since the last read
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.partial = ''
+
+    def read_lines(self):
+        """
+        Returns the complete lines added since the last read - a file which has shrunk (i.e. was truncated or replaced) is
+        read again from the start
+        :returns: list of lines (without line endings)
+        """
+        if self.filename is None or not os.path.exists(self.filename):
+            return []
+        try:
+            with open(self.filename, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < self.offset:
+                    self.offset = 0
+                    self.partial = ''
+                f.seek(self.offset)
+                data = f.read()
+        except (IOError, OSError):
+            # e.g. locked by the writer on Windows - read again next time
+            return []
+        self.offset += len(data)
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return [line.rstrip('\r') for line in lines]
+
+    def read_remaining(self):
+        """
+        Returns the lines added since the last read, including a last line without a line ending
+        :returns: list of lines
+        """
+        lines = self.read_lines()
+        if self.partial:
+            lines.append(self.partial.rstrip('\r'))
+            self.partial = ''
+        return lines
+
+
+class LoaderResult(object):
+    """
+    The outcome of one run of a loader
+    """
+
+    def __init__(self, outcome, return_code, duration_secs, error_lines=None, attempt=1):
+        """
+        :param outcome: SUCCEEDED, FAILED or TIMED_OUT
+        :param return_code: None if the process could not be started
+        :param duration_secs:
+        :param error_lines: the "|ERROR|" lines of the log
+        :param attempt:
+        """
+        self.outcome = outcome
+        self.return_code = return_code
+        self.duration_secs = duration_secs
+        self.error_lines = error_lines or []
+        self.attempt = attempt
+
+    def succeeded(self):
+        return self.outcome == SUCCEEDED
+
+    def summary(self):
+        return '%s (return code: %s, %.3f sec(s))' % (self.outcome, self.return_code, self.duration_secs)
+
+
+def start_process(command, cwd=None, shell=False):
+    """
+    Starts a process in a new process group
+    :param command: string or list
+    :param cwd:
+    :param shell:
+    :returns: subprocess.Popen
+    """
+    if sys.platform == 'win32':
+        return subprocess.Popen(command, cwd=cwd, shell=shell, creationflags=CREATE_NEW_PROCESS_GROUP)
+    return subprocess.Popen(command, cwd=cwd, shell=shell, preexec_fn=os.setsid)
+
+
+def kill_process_group(process, exited, grace_secs=KILL_GRACE_SECS):
+    """
+    Kills a process and every process it started
+    :param process: started by start_process
+    :param exited: threading.Event set once the process has exited
+    :param grace_secs: how long to wait for the group to exit on SIGTERM before it is sent SIGKILL (Unix)
+    :returns: bool (True if the process has exited)
+    """
+    if sys.platform == 'win32':
+        subprocess.call(['taskkill', '/F', '/T', '/PID', str(process.pid)])
+        return exited.wait(grace_secs) or exited.is_set()
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            # The group has already exited
+            pass
+        exited.wait(grace_secs)
+        if exited.is_set():
+            return True
+    return False
+
+
+def run_loader(command, max_runtime_secs=None, log_filename=None, cwd=None, shell=False, log=None, heartbeat_secs=None,
+               clear_log=True):
+    """
+    Runs a loader process to completion, or until it has run for max_runtime_secs (see the module description)
+    :param command: string or list
+    :param max_runtime_secs: None (or 0) for no limit
+    :param log_filename: the log to tail for the outcome and errors, or None
+    :param cwd:
+    :param shell:
+    :param log: callable(summary, message) for the progress messages, or None
+    :param heartbeat_secs: how often to log that the process is still running, or None
+    :param clear_log: clear log_filename before the process is started (e.g. a last-run log) - otherwise only the lines
+                      added after the process is started are read
+    :returns: LoaderResult
+    """
+    log = log or (lambda summary, message: None)
+    if log_filename and clear_log:
+        open(log_filename, 'wb').close()
+    tail = LogTail(log_filename)
+    if log_filename and not clear_log and os.path.exists(log_filename):
+        tail.offset = os.path.getsize(log_filename)
+
+    start_time = time.time()
+    try:
+        process = start_process(command, cwd, shell)
+    except (OSError, ValueError), e:
+        log('LOADER', 'Error starting %s: %s' % (command, e))
+        return LoaderResult(FAILED, None, time.time() - start_time, [str(e)])
+    log('LOADER', 'PID (%s) has been started' % (process.pid))
+
+    exited = threading.Event()
+
+    def wait_for_exit():
+        process.wait()
+        exited.set()
+
+    waiter = threading.Thread(target=wait_for_exit, name='loader-waiter-%s' % (process.pid))
+    waiter.daemon = True
+    waiter.start()
+
+    state = {'outcome': None, 'errors': []}
+
+    def scan(lines):
+        for line in lines:
+            if GPLOAD_SUCCEEDED_REGEX.search(line):
+                state['outcome'] = SUCCEEDED
+            elif GPLOAD_FAILED_REGEX.search(line):
+                state['outcome'] = FAILED
+            elif GPLOAD_ERROR_REGEX.search(line):
+                state['errors'].append(line)
+
+    timed_out = False
+    next_heartbeat = start_time + heartbeat_secs if heartbeat_secs else None
+    while not exited.is_set():
+        now = time.time()
+        wait_secs = TAIL_INTERVAL_SECS
+        if max_runtime_secs:
+            if now - start_time >= max_runtime_secs:
+                log('LOADER', 'Threshold exceeded (%.1f sec(s)), killing PID (%s) and its process group' % (now - start_time, process.pid))
+                timed_out = True
+                if not kill_process_group(process, exited):
+                    log('LOADER', 'PID (%s) is still running after being killed' % (process.pid))
+                break
+            wait_secs = min(wait_secs, start_time + max_runtime_secs - now)
+        if next_heartbeat is not None:
+            if now >= next_heartbeat:
+                log('LOADER', 'PID (%s) is running (%.1f sec(s))' % (process.pid, now - start_time))
+                next_heartbeat += heartbeat_secs
+            wait_secs = min(wait_secs, max(next_heartbeat - now, 0))
+        # Returns as soon as the process exits
+        exited.wait(wait_secs)
+        scan(tail.read_lines())
+
+    duration_secs = time.time() - start_time
+    scan(tail.read_remaining())
+    return_code = process.returncode
+
+    if timed_out:
+        outcome = TIMED_OUT
+    elif state['outcome'] is not None:
+        outcome = state['outcome']
+    else:
+        outcome = SUCCEEDED if return_code in SUCCESS_RETURN_CODES else FAILED
+    result = LoaderResult(outcome, return_code, duration_secs, state['errors'])
+    log('LOADER', 'PID (%s) %s' % (process.pid, result.summary()))
+    return result
+
+
+def run_loader_with_retries(command, attempts=1, retry_delay_secs=0, log=None, **kwargs):
+    """
+    Runs a loader (see run_loader) until it succeeds, at most attempts times
+    :param command:
+    :param attempts:
+    :param retry_delay_secs: the wait before each retry
+    :param log: callable(summary, message), or None
+    :param kwargs: see run_loader
+    :returns: LoaderResult (of the last attempt)
+    """
+    log = log or (lambda summary, message: None)
+    result = None
+    for attempt in range(1, max(attempts, 1) + 1):
+        if attempt > 1:
+            log('LOADER', 'Retry attempt: %s' % (attempt - 1))
+            time.sleep(retry_delay_secs)
+        result = run_loader(command, log=log, **kwargs)
+        result.attempt = attempt
+        for line in result.error_lines:
+            log('LOADER', line)
+        if result.succeeded():
+            break
+    return result
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_MDS_Snapshot.py
+
+DESCRIPTION:
+
+Versioned snapshots of the MDS carrier codes used by DQ_IL2_Seq_Check to classify flights (see DQ_IL2_Flight_Router.py).
+
+A snapshot holds the carrier codes by MDS code standard (IATA, ICAO, COMMERCIAL_IATA, COMMERCIAL_ICAO), the sha1 of its
+content and the time it was loaded. It is saved as a pickle (written to a ".part" file, then renamed into place), so later
+runs load it without re-parsing the CSV extract or querying the database.
+
+MDSSnapshotStore:
+- get() returns the active snapshot, loading it from disk and refreshing it from the MDS database if it has expired
+- refresh() queries the MDS database and, if successful, saves the new snapshot (and the CSV extract) and swaps it in as the
+  active snapshot - a single reference assignment, so readers always see a complete snapshot
+- if the database is unreachable (or returns no rows), the last good snapshot is kept and served
+- start_background_refresh() refreshes the snapshot from a daemon thread (for long-running processes), so parsing is never
+  blocked by the database
+
+The rows are read through a "source" - any callable returning (code standard, carrier code) rows. pyodbc_source() returns
+the SQL Server source used in production; any other callable (e.g. a local stand-in returning fixed rows) can be used
+instead.
+"""
+
+import os
+import time
+import hashlib
+import threading
+import cPickle
+
+from DQ_IL2_Flight_Router import FlightRouter, MDS_CLASSES, read_mds_carriers
+
+STOP_TIMEOUT_SECS = 30
+
+
+def pyodbc_source(mds_db_host, mds_db_database, mds_db_user, mds_db_password, mds_db_sql):
+    """
+    Returns a source which reads the carrier codes from the MDS SQL Server database
+    :param mds_db_host:
+    :param mds_db_database:
+    :param mds_db_user:
+    :param mds_db_password:
+    :param mds_db_sql:
+    :returns: callable returning a list of (code standard, carrier code) rows
+    """
+    def fetch_rows():
+        import pyodbc
+        db = pyodbc.connect(driver='{SQL Server}', server=mds_db_host, database=mds_db_database, uid=mds_db_user, pwd=mds_db_password, autocommit='False')
+        try:
+            cur = db.cursor()
+            cur.execute(mds_db_sql)
+            return [(str(row[0]), str(row[1])) for row in cur.fetchall()]
+        finally:
+            db.close()
+    return fetch_rows
+
+
+class MDSSnapshot(object):
+    """
+    The carrier codes by MDS code standard, with the sha1 of the content and the time they were loaded
+    """
+
+    def __init__(self, carriers, loaded_at=None):
+        """
+        :param carriers: dict of MDS code standard to an iterable of carrier codes
+        :param loaded_at: seconds since the epoch (defaults to now)
+        """
+        self.carriers = dict([(code_standard, tuple(sorted(set(carriers.get(code_standard, ()))))) for code_standard in sorted(MDS_CLASSES)])
+        self.content_hash = hashlib.sha1(''.join(['%s,%s\n' % (code_standard, code) for code_standard in sorted(self.carriers)
+                                                  for code in self.carriers[code_standard]])).hexdigest()
+        self.loaded_at = time.time() if loaded_at is None else loaded_at
+
+    @classmethod
+    def from_rows(cls, rows, loaded_at=None):
+        """
+        Builds a snapshot from (code standard, carrier code) rows - rows for other code standards are ignored
+        :param rows:
+        :param loaded_at:
+        :returns: MDSSnapshot
+        """
+        carriers = dict([(code_standard, set()) for code_standard in MDS_CLASSES])
+        for code_standard, code in rows:
+            code_standard = code_standard.strip()
+            if code_standard in carriers:
+                carriers[code_standard].add(code.strip())
+        return cls(carriers, loaded_at)
+
+    def code_count(self):
+        return sum([len(codes) for codes in self.carriers.values()])
+
+    def flight_router(self):
+        """
+        Returns a FlightRouter built from the snapshot
+        :returns: FlightRouter
+        """
+        return FlightRouter(self.carriers)
+
+    def save(self, snapshot_file):
+        """
+        Writes the snapshot to a ".part" file, then renames it into place
+        :param snapshot_file:
+        :returns: None
+        """
+        part_filename = snapshot_file + '.part'
+        with open(part_filename, 'wb') as f:
+            cPickle.dump({'carriers': self.carriers, 'content_hash': self.content_hash, 'loaded_at': self.loaded_at}, f, cPickle.HIGHEST_PROTOCOL)
+        if os.path.exists(snapshot_file):
+            os.remove(snapshot_file)
+        os.rename(part_filename, snapshot_file)
+
+    @classmethod
+    def load(cls, snapshot_file):
+        """
+        Reads a saved snapshot, checking its content against the saved hash
+        :param snapshot_file:
+        :returns: MDSSnapshot
+        """
+        with open(snapshot_file, 'rb') as f:
+            saved = cPickle.load(f)
+        snapshot = cls(saved['carriers'], saved['loaded_at'])
+        if snapshot.content_hash != saved['content_hash']:
+            raise ValueError('MDS snapshot %s is corrupt (content hash mismatch)' % (snapshot_file))
+        return snapshot
+
+    def write_csv_extract(self, mds_extract):
+        """
+        Writes the snapshot as the (legacy) CSV extract, in a single write
+        :param mds_extract:
+        :returns: None
+        """
+        rows = ['%s,%s\r\n' % (code_standard, code) for code_standard in sorted(self.carriers) for code in self.carriers[code_standard]]
+        part_filename = mds_extract + '.part'
+        with open(part_filename, 'wb') as f:
+            f.write(''.join(rows))
+        if os.path.exists(mds_extract):
+            os.remove(mds_extract)
+        os.rename(part_filename, mds_extract)
+
+
+class MDSSnapshotStore(object):
+    """
+    Holds the active MDS snapshot and refreshes it from the source (see the module description)
+    """
+
+    def __init__(self, snapshot_file, source, refresh_secs, logger, mds_extract=None):
+        """
+        :param snapshot_file: where the snapshot is saved
+        :param source: callable returning (code standard, carrier code) rows, e.g. pyodbc_source(...)
+        :param refresh_secs: the age after which the snapshot is refreshed
+        :param logger:
+        :param mds_extract: the CSV extract - written on each refresh, and read if there is no saved snapshot yet
+        """
+        self.snapshot_file = snapshot_file
+        self.source = source
+        self.refresh_secs = refresh_secs
+        self.logger = logger
+        self.mds_extract = mds_extract
+        self.snapshot = None
+        self.refresh_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.refresh_thread = None
+
+    def current(self):
+        """
+        Returns the active snapshot (without loading or refreshing it)
+        :returns: MDSSnapshot or None
+        """
+        return self.snapshot
+
+    def is_expired(self, snapshot=None):
+        snapshot = snapshot or self.snapshot
+        return snapshot is None or snapshot.loaded_at < time.time() - self.refresh_secs
+
+    def load_saved(self):
+        """
+        Loads the saved snapshot, or the CSV extract if there is none, as the active snapshot
+        :returns: MDSSnapshot or None
+        """
+        snapshot = None
+        if os.path.exists(self.snapshot_file):
+            try:
+                snapshot = MDSSnapshot.load(self.snapshot_file)
+            except Exception, e:
+                self.logger.warn('Error reading MDS snapshot %s: %s' % (self.snapshot_file, e))
+        if snapshot is None and self.mds_extract and os.path.exists(self.mds_extract) and os.stat(self.mds_extract).st_size > 0:
+            carriers = read_mds_carriers(self.mds_extract)
+            snapshot = MDSSnapshot(carriers, loaded_at=os.stat(self.mds_extract).st_mtime)
+            self.logger.info('MDS snapshot built from %s' % (self.mds_extract))
+            try:
+                snapshot.save(self.snapshot_file)
+            except Exception, e:
+                self.logger.warn('Error saving MDS snapshot: %s' % (e))
+        if snapshot is not None:
+            self.snapshot = snapshot
+        return snapshot
+
+    def refresh(self):
+        """
+        Reads the carrier codes from the source and swaps in the new snapshot. On error (or if the source returns no rows)
+        the active snapshot is kept
+        :returns: bool (True if the snapshot was refreshed)
+        """
+        with self.refresh_lock:
+            try:
+                snapshot = MDSSnapshot.from_rows(self.source())
+            except Exception, e:
+                self.logger.warn('MDS refresh failed - serving the last good snapshot: %s' % (e))
+                return False
+
+            if not snapshot.code_count():
+                self.logger.warn('MDS refresh returned no carriers - serving the last good snapshot')
+                return False
+
+            try:
+                snapshot.save(self.snapshot_file)
+                if self.mds_extract:
+                    snapshot.write_csv_extract(self.mds_extract)
+            except Exception, e:
+                self.logger.warn('Error saving MDS snapshot: %s' % (e))
+
+            previous = self.snapshot
+            self.snapshot = snapshot
+            if previous is not None and previous.content_hash == snapshot.content_hash:
+                self.logger.info('MDS snapshot refreshed - unchanged (%s)' % (snapshot.content_hash[:12]))
+            else:
+                self.logger.info('MDS snapshot refreshed - version %s (%s carrier code(s))' % (snapshot.content_hash[:12], snapshot.code_count()))
+            return True
+
+    def get(self):
+        """
+        Returns the active snapshot, loading the saved snapshot and refreshing it first if needed
+        :returns: MDSSnapshot
+        """
+        if self.snapshot is None:
+            self.load_saved()
+        if self.is_expired():
+            if self.snapshot is not None:
+                self.logger.info('MDS snapshot has expired (loaded %s)' % (time.ctime(self.snapshot.loaded_at)))
+            self.refresh()
+        if self.snapshot is None:
+            raise RuntimeError('No MDS snapshot available - the MDS database is unreachable and there is no saved snapshot')
+        return self.snapshot
+
+    def start_background_refresh(self, poll_secs=60):
+        """
+        Starts a daemon thread which refreshes the snapshot whenever it expires (checked every poll_secs)
+        :param poll_secs:
+        :returns: None
+        """
+        def refresh_loop():
+            while not self.stop_event.wait(poll_secs):
+                if self.is_expired():
+                    self.refresh()
+
+        self.refresh_thread = threading.Thread(target=refresh_loop, name='mds_refresh')
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+
+    def stop_background_refresh(self, timeout_secs=STOP_TIMEOUT_SECS):
+        """
+        Stops the background refresh, waiting at most timeout_secs for a refresh in progress (e.g. a hung MDS query) - the
+        thread is a daemon, so it does not keep the process alive if it is still running
+        :param timeout_secs:
+        :returns: bool (True if the thread has stopped)
+        """
+        self.stop_event.set()
+        if self.refresh_thread is None:
+            return True
+        self.refresh_thread.join(timeout_secs)
+        if self.refresh_thread.is_alive():
+            self.logger.warn('MDS refresh still running after %s sec(s) - not waiting for it' % (timeout_secs))
+            return False
+        return True
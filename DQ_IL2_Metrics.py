@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Metrics.py
+
+DESCRIPTION:
+
+Per-stage timings for the DQ_IL2 scripts, kept in a local run history so NO_OF_PROCESSES, MAX_BATCH_SIZE, etc. can be tuned
+against real throughput figures rather than the single "Elapsed time" of each run.
+
+Each script creates a RunMetrics, times its stages (prepare batch, sequence check, parse, archive, concat, COPY...) with it,
+then appends the run to the run history as a single JSON line:
+
+    {"script": "DQ_IL2_Seq_Check", "started_at": "2017-11-06 12:00:00", "elapsed_secs": 12.3, "status": "ok",
+     "settings": {"NO_OF_PROCESSES": 4, ...},
+     "stages": [{"name": "stream parse", "secs": 10.1, "files": 2000, "bytes": 5242880, "files_per_sec": 198.0}, ...],
+     "counters": {"duplicate messages": 12, ...}}
+
+The counters (e.g. the work avoided by deduplication - see DQ_IL2_Dedup.py) are only included when set.
+
+The run history is log/DQ_IL2_Run_History.jsonl (under ROOT_DIR), shared by all the scripts. Each run is written with a
+single append, so runs of different scripts do not interleave.
+
+The trend of each stage, with regressions flagged, is shown with:
+
+    python DQ_IL2_Metrics.py -f <run history file> [-s <script>] [-n <no. of runs>] [-b <no. of baseline runs>] [-r <regression %>]
+
+A stage is flagged as a regression when its throughput (files/sec, or sec(s) for stages without files) in the latest run is
+more than <regression %> (default: 25) worse than the median of the <no. of baseline runs> (default: 10) before it. Stages
+taking less than MIN_STAGE_SECS are not flagged. The exit code is 1 if any stage is flagged.
+"""
+
+import os
+import sys
+import time
+import json
+import getopt
+from contextlib import contextmanager
+
+RUN_HISTORY_FILENAME = 'DQ_IL2_Run_History.jsonl'
+MIN_STAGE_SECS = 1.0
+
+
+def run_history_file(root_dir):
+    """
+    Returns the run history file (log/DQ_IL2_Run_History.jsonl under root_dir)
+    :param root_dir:
+    :returns: string
+    """
+    return os.path.join(root_dir, 'log', RUN_HISTORY_FILENAME)
+
+
+def per_sec(count, secs):
+    return count / secs if secs > 0 else 0.0
+
+
+class StageMetrics(object):
+    """
+    The wall time, no. of files and no. of bytes of one stage - file_count and byte_count can be set while the stage runs,
+    as can concurrency (the process counts chosen for the stage - see DQ_IL2_Autotune.py)
+    """
+
+    def __init__(self, name, file_count=0, byte_count=0, secs=0.0):
+        self.name = name
+        self.file_count = file_count
+        self.byte_count = byte_count
+        self.secs = secs
+        self.concurrency = None
+
+    def as_dict(self):
+        stage = {'name': self.name, 'secs': round(self.secs, 6), 'files': self.file_count, 'bytes': self.byte_count,
+                 'files_per_sec': round(per_sec(self.file_count, self.secs), 3),
+                 'bytes_per_sec': round(per_sec(self.byte_count, self.secs), 3)}
+        if self.concurrency is not None:
+            stage['concurrency'] = self.concurrency
+        return stage
+
+    def summary(self):
+        """
+        Returns the stage as a log message, e.g. 'parse: 10.100000 sec(s), 2000 file(s), 5242880 byte(s), 198.0 file(s)/sec'
+        :returns: string
+        """
+        summary = '%s: %.6f sec(s), %s file(s), %s byte(s), %.1f file(s)/sec' % (self.name, self.secs, self.file_count, self.byte_count,
+                                                                             per_sec(self.file_count, self.secs))
+        if self.concurrency is not None:
+            summary += ', %s process(es) (%s-%s, mean %s)' % (self.concurrency['final'], self.concurrency['min'], self.concurrency['max'],
+                                                               self.concurrency['mean'])
+            if self.concurrency.get('finish_spread') is not None:
+                summary += ', finish spread %.3f sec(s) over %s worker(s)' % (self.concurrency['finish_spread'], self.concurrency['workers'])
+        return summary
+
+
+class RunMetrics(object):
+    """
+    The stages of a run (or of a batch, in DQ_IL2_Seq_Check watch mode)
+    """
+
+    def __init__(self, script, settings=None):
+        """
+        :param script: the script name, e.g. 'DQ_IL2_Seq_Check'
+        :param settings: dict of the settings in use (e.g. NO_OF_PROCESSES), recorded with the run
+        """
+        self.script = script
+        self.settings = settings or {}
+        self.started_at = time.time()
+        self.stages = []
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name, file_count=0, byte_count=0):
+        """
+        Times the enclosed block as a stage, e.g.
+
+            with metrics.stage('parse') as stage:
+                stage.file_count = parse(...)
+
+        :param name:
+        :param file_count:
+        :param byte_count:
+        :returns: StageMetrics
+        """
+        stage = StageMetrics(name, file_count, byte_count)
+        starttime = time.time()
+        try:
+            yield stage
+        finally:
+            stage.secs = time.time() - starttime
+            self.stages.append(stage)
+
+    def record_stage(self, name, secs, file_count=0, byte_count=0, concurrency=None):
+        """
+        Records a stage timed elsewhere (e.g. in a background thread)
+        :param name:
+        :param secs:
+        :param file_count:
+        :param byte_count:
+        :param concurrency: see StageMetrics
+        :returns: StageMetrics
+        """
+        stage = StageMetrics(name, file_count, byte_count, secs)
+        stage.concurrency = concurrency
+        self.stages.append(stage)
+        return stage
+
+    def count(self, name, value=1):
+        """
+        Adds to a counter of the run
+        :param name: e.g. 'duplicate messages'
+        :param value:
+        :returns: None
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def elapsed_secs(self):
+        return time.time() - self.started_at
+
+    def summary_lines(self):
+        return [stage.summary() for stage in self.stages]
+
+    def counter_lines(self):
+        """
+        Returns the counters as log messages, e.g. 'duplicate messages: 12'
+        :returns: list of strings
+        """
+        return ['%s: %s' % (name, value) for name, value in sorted(self.counters.items())]
+
+    def as_dict(self, status='ok'):
+        run = {'script': self.script,
+               'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started_at)),
+               'elapsed_secs': round(self.elapsed_secs(), 6),
+               'status': status,
+               'settings': self.settings,
+               'stages': [stage.as_dict() for stage in self.stages]}
+        if self.counters:
+            run['counters'] = self.counters
+        return run
+
+    def write(self, history_file, status='ok'):
+        """
+        Appends the run to the run history, as a single JSON line. Errors are not raised - the run history must never fail a run
+        :param history_file:
+        :param status: e.g. 'ok' or 'failed'
+        :returns: bool (True if written)
+        """
+        try:
+            line = json.dumps(self.as_dict(status), sort_keys=True) + '\n'
+            with open(history_file, 'ab') as f:
+                f.write(line)
+            return True
+        except (IOError, OSError, TypeError, ValueError):
+            return False
+
+
+def read_run_history(history_file, script=None, max_bytes=None):
+    """
+    Reads the runs in the run history (oldest first), skipping any line which cannot be read
+    :param history_file:
+    :param script: only runs of this script if set
+    :param max_bytes: only read the last max_bytes of the run history (i.e. the most recent runs) if set
+    :returns: list of dicts
+    """
+    runs = []
+    with open(history_file, 'rb') as f:
+        if max_bytes is not None and os.fstat(f.fileno()).st_size > max_bytes:
+            f.seek(-max_bytes, os.SEEK_END)
+            f.readline()
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if script is None or run.get('script') == script:
+                runs.append(run)
+    return runs
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def stage_trends(runs, baseline_runs=10, regression_pct=25.0):
+    """
+    Compares the latest run of each script/stage with the median of the baseline runs before it
+    :param runs: list of run dicts (oldest first), as returned by read_run_history
+    :param baseline_runs:
+    :param regression_pct:
+    :returns: list of dicts (script, stage, history, latest, baseline, change_pct, metric, regression), sorted by script/stage
+    """
+    history = {}
+    for run in runs:
+        for stage in run.get('stages', []):
+            history.setdefault((run['script'], stage['name']), []).append((run, stage))
+
+    trends = []
+    for (script, name), stage_history in sorted(history.items()):
+        latest_run, latest = stage_history[-1]
+        baseline_stages = [stage for run, stage in stage_history[:-1][-baseline_runs:]]
+
+        # Stages which process files are compared on files/sec (higher is better), other stages on sec(s) (lower is better)
+        metric = 'files_per_sec' if latest['files'] and all([stage['files'] for stage in baseline_stages]) else 'secs'
+        trend = {'script': script, 'stage': name, 'history': stage_history, 'latest': latest[metric], 'baseline': None,
+                 'change_pct': None, 'metric': metric, 'regression': False}
+        if baseline_stages:
+            baseline = median([stage[metric] for stage in baseline_stages])
+            trend['baseline'] = baseline
+            if baseline:
+                trend['change_pct'] = (latest[metric] - baseline) * 100.0 / baseline
+                worse_pct = -trend['change_pct'] if metric == 'files_per_sec' else trend['change_pct']
+                long_enough = latest['secs'] >= MIN_STAGE_SECS or median([stage['secs'] for stage in baseline_stages]) >= MIN_STAGE_SECS
+                trend['regression'] = worse_pct > regression_pct and long_enough
+        trends.append(trend)
+    return trends
+
+
+def format_settings(settings):
+    return ' '.join(['%s=%s' % (key, settings[key]) for key in sorted(settings)])
+
+
+def print_trends(trends, no_of_runs):
+    """
+    Prints the last no_of_runs runs of each script/stage, then the latest run against the baseline
+    :param trends:
+    :param no_of_runs:
+    :returns: None
+    """
+    units = {'files_per_sec': 'file(s)/sec', 'secs': 'sec(s)'}
+    for trend in trends:
+        print '%s / %s' % (trend['script'], trend['stage'])
+        for run, stage in trend['history'][-no_of_runs:]:
+            print '  %s  %10.3f sec(s)  %8s file(s)  %10.1f file(s)/sec  %12s byte(s)  %s%s' % (
+                run['started_at'], stage['secs'], stage['files'], stage['files_per_sec'], stage['bytes'],
+                format_settings(run.get('settings', {})), '' if run.get('status', 'ok') == 'ok' else '  [%s]' % (run['status']))
+        if trend['baseline'] is None:
+            print '  latest %.3f %s (no baseline yet)' % (trend['latest'], units[trend['metric']])
+        else:
+            print '  latest %.3f %s vs baseline median %.3f %s%s%s' % (
+                trend['latest'], units[trend['metric']], trend['baseline'], units[trend['metric']],
+                ' (%+.1f%%)' % (trend['change_pct']) if trend['change_pct'] is not None else '',
+                '  REGRESSION' if trend['regression'] else '')
+        print
+
+
+def main(argv):
+    history_file = None
+    script = None
+    no_of_runs = 10
+    baseline_runs = 10
+    regression_pct = 25.0
+
+    try:
+        opts, args = getopt.getopt(argv, "f:s:n:b:r:")
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-f':
+            history_file = arg
+        elif opt == '-s':
+            script = arg
+        elif opt == '-n':
+            no_of_runs = int(arg)
+        elif opt == '-b':
+            baseline_runs = int(arg)
+        elif opt == '-r':
+            regression_pct = float(arg)
+
+    if not history_file:
+        print __doc__
+        sys.exit(2)
+
+    trends = stage_trends(read_run_history(history_file, script), baseline_runs, regression_pct)
+    if not trends:
+        print 'No runs recorded in %s' % (history_file)
+        sys.exit(0)
+
+    print_trends(trends, no_of_runs)
+    regressions = [trend for trend in trends if trend['regression']]
+    for trend in regressions:
+        print 'REGRESSION: %s / %s' % (trend['script'], trend['stage'])
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
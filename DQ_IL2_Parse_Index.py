@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Parse_Index.py
+
+DESCRIPTION:
+
+A sidecar index of the xmls written to a queue folder ("out", "ga", "xml"), so the downstream scripts do not have to list
+the folder (which can hold hundreds of thousands of files) and stat every file to find out what is in it.
+
+DQ_IL2_Seq_Check already knows the size, class and flightIds of each xml it writes, so (with PARSE_INDEX enabled) it writes
+one index per batch and queue folder, to <queue folder>/index/PARSE_INDEX_<yyyymmddhhmissfff>.idx, one tab-separated line
+per xml:
+
+    <filename>  <size>  <class>  <flightIds>  <source zip>
+
+where <filename> is relative to the queue folder (i.e. including any shard subfolder - see DQ_IL2_Sharded_Dir.py), <class> is
+GA, COMMERCIAL or UNKNOWN and <flightIds> are comma-separated. The size and class are left empty when they are not known
+(e.g. files found by listing the folder).
+
+The index is written to a ".part" file as the results arrive and renamed into place once the batch has been parsed. A ".part"
+file left by an interrupted run is published by the next run (see recover_partial_indexes), without its last line if torn.
+
+The consumers (DQ_IL2_Prep_XML_files, DQ_IL2_PreProcess_XML_Files, DQ_IL2_DB_GA_Postgres_Load_XML) read the published
+indexes of a folder, oldest first, and only list the folder when there are none - so any file which is not indexed (e.g.
+written by an older version) is picked up once the indexed backlog has been drained. An indexed file which is no longer in
+the folder (e.g. already moved by a listing) is skipped. With PARSE_INDEX enabled (in its own section), DQ_IL2_Prep_XML_files
+indexes any file in the "xml" folder which is not indexed, and writes an index of the files it moves there before moving them,
+so every file in the "xml" folder is indexed - without it, any index in the "xml" folder is removed and the folder is listed.
+"""
+
+import os
+import time
+
+INDEX_SUBDIR = 'index'
+INDEX_PREFIX = 'PARSE_INDEX_'
+INDEX_SUFFIX = '.idx'
+PART_SUFFIX = '.part'
+
+
+def index_dir(base_dir):
+    """
+    Returns the folder holding the indexes of a queue folder
+    :param base_dir:
+    :returns: string
+    """
+    return os.path.join(base_dir, INDEX_SUBDIR)
+
+
+def new_index_id():
+    """
+    Returns a new index id, e.g. 20171106120000123 - the ids sort in the order the indexes were written
+    :returns: string
+    """
+    now = time.time()
+    return '%s%03d' % (time.strftime('%Y%m%d%H%M%S', time.localtime(now)), int(now * 1000) % 1000)
+
+
+def format_entry(entry):
+    """
+    Returns an index line
+    :param entry: tuple (filename, size, class, flightIds, source zip) - size, class, flightIds and source zip can be None
+    :returns: string
+    """
+    filename, size, msg_class, flight_ids, source_zip = entry
+    return '%s\t%s\t%s\t%s\t%s\n' % (filename, '' if size is None else size, msg_class or '', flight_ids or '', source_zip or '')
+
+
+def parse_entry(line):
+    """
+    Returns the entry of an index line
+    :param line:
+    :returns: tuple (filename, size, class, flightIds, source zip), or None if the line is incomplete (e.g. torn by a crash)
+    """
+    if not line.endswith('\n'):
+        return None
+    fields = line.rstrip('\r\n').split('\t')
+    if len(fields) != 5 or not fields[0]:
+        return None
+    try:
+        size = int(fields[1]) if fields[1] else None
+    except ValueError:
+        return None
+    return fields[0], size, fields[2] or None, fields[3] or None, fields[4] or None
+
+
+def list_indexes(base_dir):
+    """
+    Returns the published indexes of a queue folder, oldest first
+    :param base_dir:
+    :returns: list of filenames
+    """
+    path = index_dir(base_dir)
+    if not os.path.isdir(path):
+        return []
+    return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.startswith(INDEX_PREFIX) and name.endswith(INDEX_SUFFIX)]
+
+
+def read_index(index_filename):
+    """
+    Returns the entries of an index, skipping any line which cannot be read
+    :param index_filename:
+    :returns: list of tuples (see parse_entry)
+    """
+    entries = []
+    with open(index_filename, 'rb') as f:
+        for line in f:
+            entry = parse_entry(line)
+            if entry is not None:
+                entries.append(entry)
+    return entries
+
+
+def write_index(base_dir, entries, index_id=None):
+    """
+    Writes an index in one go (via a ".part" file)
+    :param base_dir:
+    :param entries:
+    :param index_id: defaults to a new id (see new_index_id)
+    :returns: string (the index filename)
+    """
+    writer = ParseIndexWriter(base_dir, index_id)
+    for entry in entries:
+        writer.add(entry)
+    return writer.close()
+
+
+def rewrite_index(index_filename, entries):
+    """
+    Replaces the entries of an index (via a ".part" file), or removes the index if there are none left
+    :param index_filename:
+    :param entries:
+    :returns: None
+    """
+    if not entries:
+        os.remove(index_filename)
+        return
+    part_filename = index_filename + PART_SUFFIX
+    with open(part_filename, 'wb') as f:
+        f.write(''.join([format_entry(entry) for entry in entries]))
+    os.remove(index_filename)
+    os.rename(part_filename, index_filename)
+
+
+def remove_indexes(base_dir):
+    """
+    Removes the published indexes of a queue folder (e.g. once the files they list have been removed)
+    :param base_dir:
+    :returns: int (the number of indexes removed)
+    """
+    removed = 0
+    for index_filename in list_indexes(base_dir):
+        os.remove(index_filename)
+        removed += 1
+    return removed
+
+
+def recover_partial_indexes(base_dir):
+    """
+    Publishes the ".part" indexes left by an interrupted run - the files they list were written before the run stopped
+    :param base_dir:
+    :returns: int (the number of indexes recovered)
+    """
+    path = index_dir(base_dir)
+    if not os.path.isdir(path):
+        return 0
+    recovered = 0
+    for name in sorted(os.listdir(path)):
+        if not (name.startswith(INDEX_PREFIX) and name.endswith(INDEX_SUFFIX + PART_SUFFIX)):
+            continue
+        part_filename = os.path.join(path, name)
+        index_filename = part_filename[:-len(PART_SUFFIX)]
+        entries = read_index(part_filename)
+        if entries:
+            rewrite_index(part_filename, entries)
+            os.rename(part_filename, index_filename)
+            recovered += 1
+        else:
+            os.remove(part_filename)
+    return recovered
+
+
+class ParseIndexWriter(object):
+    """
+    Writes the index of a queue folder for one batch, a line at a time (see the module description)
+    """
+
+    def __init__(self, base_dir, index_id=None):
+        """
+        :param base_dir: the queue folder
+        :param index_id: defaults to a new id (see new_index_id)
+        """
+        self.base_dir = base_dir
+        self.index_filename = os.path.join(index_dir(base_dir), '%s%s%s' % (INDEX_PREFIX, index_id or new_index_id(), INDEX_SUFFIX))
+        self.part_filename = self.index_filename + PART_SUFFIX
+        self.count = 0
+        self.f = None
+
+    def add(self, entry):
+        """
+        Adds a file to the index - the ".part" file is only created with the first entry
+        :param entry: see format_entry
+        :returns: None
+        """
+        if self.f is None:
+            if not os.path.isdir(index_dir(self.base_dir)):
+                os.makedirs(index_dir(self.base_dir))
+            self.f = open(self.part_filename, 'wb')
+        self.f.write(format_entry(entry))
+        self.count += 1
+
+    def close(self):
+        """
+        Publishes the index (renames the ".part" file into place)
+        :returns: string (the index filename, or None if it has no entries)
+        """
+        if self.f is None:
+            return None
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.f = None
+        os.rename(self.part_filename, self.index_filename)
+        return self.index_filename
+
+
+class BatchParseIndex(object):
+    """
+    The indexes written by one DQ_IL2_Seq_Check batch, one per queue folder
+    """
+
+    def __init__(self, output_dirs, ga_file_dir, index_id=None):
+        """
+        :param output_dirs: dict of class to the output folder of its messages
+        :param ga_file_dir: the folder GA messages are also written to
+        :param index_id: defaults to a new id (see new_index_id)
+        """
+        self.output_dirs = output_dirs
+        self.ga_file_dir = ga_file_dir
+        self.index_id = index_id or new_index_id()
+        self.writers = {}
+
+    def add_message(self, msg_class, filename, ga_filename, size, flight_ids, source_zip):
+        """
+        Adds an API message to the index of its output folder (and of the GA folder)
+        :param msg_class: GA, COMMERCIAL or UNKNOWN
+        :param filename: relative to the output folder of msg_class
+        :param ga_filename: relative to the GA folder, or None if the message was not written to it
+        :param size:
+        :param flight_ids: comma-separated
+        :param source_zip:
+        :returns: None
+        """
+        self.add(self.output_dirs[msg_class], (filename, size, msg_class, flight_ids, source_zip))
+        if ga_filename is not None:
+            self.add(self.ga_file_dir, (ga_filename, size, msg_class, flight_ids, source_zip))
+
+    def add(self, base_dir, entry):
+        """
+        :param base_dir: the queue folder the file was written to
+        :param entry: see format_entry
+        :returns: None
+        """
+        key = os.path.normpath(base_dir)
+        writer = self.writers.get(key)
+        if writer is None:
+            writer = self.writers[key] = ParseIndexWriter(base_dir, self.index_id)
+        writer.add(entry)
+
+    def publish(self):
+        """
+        Publishes the index of each queue folder
+        :returns: dict of queue folder to the no. of files indexed
+        """
+        counts = {}
+        for key, writer in sorted(self.writers.items()):
+            writer.close()
+            counts[writer.base_dir] = writer.count
+        self.writers = {}
+        return counts
+
+
+class IndexQueue(object):
+    """
+    The published indexes of a queue folder, read oldest first - entries are taken with take() and the indexes updated with
+    commit() once the files have been moved
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.index_filenames = list_indexes(base_dir)
+        self.taken = []
+
+    def has_indexes(self):
+        return bool(self.index_filenames)
+
+    def entries(self):
+        """
+        Returns the entries of every index, oldest first - a file listed more than once (e.g. by a zipfile reparsed after an
+        interrupted run) is only returned once
+        :returns: list of tuples (see parse_entry)
+        """
+        entries = []
+        seen = set()
+        for index_filename in self.index_filenames:
+            for entry in read_index(index_filename):
+                if entry[0] not in seen:
+                    seen.add(entry[0])
+                    entries.append(entry)
+        return entries
+
+    def count(self):
+        """
+        Returns the no. of files listed by the indexes
+        :returns: int
+        """
+        return len(self.entries())
+
+    def take(self, limit=None):
+        """
+        Returns up to limit entries (all of them if None), oldest first
+        :param limit:
+        :returns: list of tuples (see parse_entry)
+        """
+        entries = []
+        seen = set()
+        self.taken = []
+        for index_filename in self.index_filenames:
+            if limit is not None and len(entries) >= limit:
+                break
+            index_entries = read_index(index_filename)
+            taken_count = 0
+            for entry in index_entries:
+                if limit is not None and len(entries) >= limit:
+                    break
+                taken_count += 1
+                if entry[0] not in seen:
+                    seen.add(entry[0])
+                    entries.append(entry)
+            self.taken.append((index_filename, index_entries[taken_count:]))
+        return entries
+
+    def commit(self):
+        """
+        Removes the entries returned by take() from the indexes - fully taken indexes are removed
+        :returns: None
+        """
+        for index_filename, remaining_entries in self.taken:
+            rewrite_index(index_filename, remaining_entries)
+        self.index_filenames = list_indexes(self.base_dir)
+        self.taken = []
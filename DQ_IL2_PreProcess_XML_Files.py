@@ -5,7 +5,7 @@
 #
 # AUTHOR:       Stewart Lee
 # DATE:         2016/05/20
-# LAST UPDATED: 2016/12/05
+# LAST UPDATED: 2026/10/18
 #
 # DESCRIPTION:  
 #
@@ -19,14 +19,21 @@
 # 20161205      Due to "gpfdist" failing (not in this script) due to files of more than 1MB in size being received, this
 #               script has been updated to reject any files more than 1MB (configurable) in size.  The reject folder
 #               is also configurable.
+#
+# 20261018      The files (and their sizes) are taken from the parse indexes of XML_DIR when there are any (see
+#               DQ_IL2_Parse_Index.py), rather than listing the folder and statting every file.
 #                   
 ##############################################################################################################################
 
 ### IMPORT PYTHON MODULES 
-import os, zipfile, re, time, sys, shutil, getopt, ConfigParser, glob, ntpath, multiprocessing
+import os, zipfile, re, time, sys, shutil, getopt, ConfigParser, glob, ntpath, multiprocessing, errno
 from datetime import datetime
 import itertools
 from multiprocessing import Pool, freeze_support
+import DQ_IL2_Sharded_Dir
+import DQ_IL2_Autotune
+import DQ_IL2_Parse_Index
+import DQ_IL2_Metrics
 
 ##############################################################################################################################
 YYYYMMDDSTR = time.strftime("%Y%m%d")
@@ -44,15 +51,22 @@ def concat_xml_files(multiprocessing_pool_vars):
     XML_INPROCESS_DIR=multiprocessing_pool_vars[2]
     MAX_FILESIZE_BYTES=multiprocessing_pool_vars[3]
     REJECT_DIR=multiprocessing_pool_vars[4]
+    filesize=multiprocessing_pool_vars[5]       # from the parse index, None if not known
 
     concat=None
     full_filename=os.path.join(XML_DIR,filename)
-    filesize=int(os.stat(full_filename).st_size)
-    if filesize < MAX_FILESIZE_BYTES:
-        with open(full_filename) as f:
-            concat = f.read() + '|' + ntpath.basename(filename)
-    else:
-        shutil.move(full_filename,os.path.join(REJECT_DIR,filename))
+    try:
+        if filesize is None:
+            filesize=int(os.stat(full_filename).st_size)
+        if filesize < MAX_FILESIZE_BYTES:
+            with open(full_filename) as f:
+                concat = f.read() + '|' + ntpath.basename(filename)
+        else:
+            shutil.move(full_filename,os.path.join(REJECT_DIR,ntpath.basename(filename)))
+    except (IOError, OSError), e:
+        # A file listed in a parse index may no longer be there
+        if e.errno != errno.ENOENT:
+            raise
     
     return concat
 
@@ -101,6 +115,9 @@ def main(argv):
     XML_DIR             = re.sub("/*$","/",config.get(CUSTOM_SECTION,'XML_DIR'))            # Location of the source xml
     XML_INPROCESS_DIR   = re.sub("/*$","/",config.get(CUSTOM_SECTION,'XML_INPROCESS_DIR'))  # Location of the source xml
     NO_OF_PROCESSES     = int(config.get(CUSTOM_SECTION,'NO_OF_PROCESSES'))                 # No. of processes
+    MIN_PROCESSES       = int(config.get(CUSTOM_SECTION,'MIN_PROCESSES')) if config.has_option(CUSTOM_SECTION,'MIN_PROCESSES') else NO_OF_PROCESSES  # Min/max no. of processes, see DQ_IL2_Autotune.py
+    MAX_PROCESSES       = int(config.get(CUSTOM_SECTION,'MAX_PROCESSES')) if config.has_option(CUSTOM_SECTION,'MAX_PROCESSES') else NO_OF_PROCESSES
+    MP_CHUNKSIZE        = int(config.get(CUSTOM_SECTION,'MP_CHUNKSIZE')) if config.has_option(CUSTOM_SECTION,'MP_CHUNKSIZE') else 100                # No. of files sent to a process at a time
     BUFFER_LIMIT        = int(config.get(CUSTOM_SECTION,'BUFFER_LIMIT'))                    # Max no. of files to hold in memory before writing to file
     MAX_FILESIZE_BYTES  = int(config.get(CUSTOM_SECTION,'MAX_FILESIZE_BYTES'))              # Max filesize in bytes to accept, anything over this will be rejected
     REJECT_DIR          = config.get(CUSTOM_SECTION,'REJECT_DIR')                          # Max no. of files to hold in memory before writing to file
@@ -108,6 +125,9 @@ def main(argv):
    
     LOGFILE_DIR=os.path.join(ROOT_DIR, 'log/')
     OUTPUT_MOD_FILENAME=os.path.join(XML_INPROCESS_DIR,'PARSED_CONCAT_X.xml.MOD')
+    RUN_HISTORY=DQ_IL2_Metrics.run_history_file(ROOT_DIR)
+    METRICS=DQ_IL2_Metrics.RunMetrics('DQ_IL2_PreProcess_XML_Files', {'NO_OF_PROCESSES': NO_OF_PROCESSES, 'MIN_PROCESSES': MIN_PROCESSES,
+                                                                         'MAX_PROCESSES': MAX_PROCESSES, 'BUFFER_LIMIT': BUFFER_LIMIT})
     
     ### LOG FILE VARIABLES #######################################################################################################
     LOGFILENAME=LOGFILE_DIR + 'DQ_IL2_PREPROCESS_XML_FILES_LOGFILE_' + YYYYMMDDSTR + '.log' # records general script output
@@ -124,27 +144,43 @@ def main(argv):
     print '\n*** Concat xml files'
     xml_inprocess_dir_list = [os.path.join(XML_INPROCESS_DIR,f) for f in os.listdir(XML_INPROCESS_DIR) if f.endswith(".xml.MOD")]
 
-    xml_dir_list = [f for f in os.listdir(XML_DIR) if f.lower().endswith(".xml")]   
+    with METRICS.stage('list files') as STAGE:
+        XML_INDEX = DQ_IL2_Parse_Index.IndexQueue(XML_DIR)
+        if XML_INDEX.has_indexes():
+            xml_dir_entries = XML_INDEX.entries()
+            add_log_entry('LIST XML FILES', str(len(xml_dir_entries)) + ' file(s) taken from the parse indexes of ' + XML_DIR)
+        else:
+            # relative to XML_DIR, including any shard subfolder
+            xml_dir_entries = [(FILENAME, None, None, None, None) for FILENAME in DQ_IL2_Sharded_Dir.list_files(XML_DIR, ".xml")]
+        STAGE.file_count = len(xml_dir_entries)
 
     open(OUTPUT_MOD_FILENAME, 'wb').close()
     
     BATCH_COUNTER=1
     RESULT_COUNTER=0
 
-    BATCHES=batch_list(xml_dir_list, BUFFER_LIMIT)
+    BATCHES=batch_list(xml_dir_entries, BUFFER_LIMIT)
     BATCHES_LENGTH=len(BATCHES)
+    CONCAT_STARTTIME=time.time()
+
+    # One pool is used for every batch - the no. of files in flight starts at NO_OF_PROCESSES and is tuned between
+    # MIN_PROCESSES and MAX_PROCESSES (carried over from one batch to the next). The results are written as they complete
+    pool = multiprocessing.Pool(MAX_PROCESSES)
+    EXECUTOR = DQ_IL2_Autotune.AutotuningExecutor(pool, 'concat', NO_OF_PROCESSES, MIN_PROCESSES, MAX_PROCESSES)
     
     for batch in BATCHES:
-        pool = multiprocessing.Pool(NO_OF_PROCESSES)
-        
         if batch:
+            # Largest files first (when their size is indexed), in chunks which shrink towards the end of the batch, so the
+            # workers finish the batch together (see DQ_IL2_Autotune.py)
+            batch = sorted(batch, key=lambda ENTRY: ENTRY[1] if ENTRY[1] is not None else -1, reverse=True)
             with open(OUTPUT_MOD_FILENAME, 'ab') as f:
-                for result in pool.map(concat_xml_files,    itertools.izip(batch,                            # ARG 1 (Filename)
+                for result in EXECUTOR.imap_unordered(concat_xml_files, itertools.izip([ENTRY[0] for ENTRY in batch], # ARG 1 (Filename)
                                                             itertools.repeat(XML_DIR),                       # ARG 2 (XML_DIR - input)
                                                             itertools.repeat(XML_INPROCESS_DIR),             # ARG 3 (XML_INPROCESS - output)
                                                             itertools.repeat(MAX_FILESIZE_BYTES),            # ARG 4 (MAX_FILESIZE_BYTES - filesize reject threshold)
-                                                            itertools.repeat(REJECT_DIR)                     # ARG 5 (REJECT_DIR - output)
-                                                        )):
+                                                            itertools.repeat(REJECT_DIR),                    # ARG 5 (REJECT_DIR - output)
+                                                            [ENTRY[1] for ENTRY in batch]                    # ARG 6 (Filesize, if indexed)
+                                                        ), MP_CHUNKSIZE, total=len(batch)):
                     # (filename, count) tuples from worker
                     if result is not None:
                         f.write(result + '\n')
@@ -153,12 +189,22 @@ def main(argv):
             add_log_entry('CONCAT XML FILES', 'Batch %s of %s complete (%s file(s) processed)' % (BATCH_COUNTER,BATCHES_LENGTH,RESULT_COUNTER))
             
         BATCH_COUNTER+=1
-        pool.close()
-        pool.join()
+
+    pool.close()
+    pool.join()
+
+    # The concat stage is measured on the xmls written to the .MOD file (rejected files are not counted)
+    METRICS.record_stage('concat', time.time() - CONCAT_STARTTIME, RESULT_COUNTER, os.path.getsize(OUTPUT_MOD_FILENAME),
+                         EXECUTOR.stats())
 
     ##############################################################################################################################
     # SCRIPT END 
     ##############################################################################################################################
+    for LINE in METRICS.summary_lines():
+        add_log_entry('STAGE METRICS', LINE)
+    if not METRICS.write(RUN_HISTORY):
+        add_log_entry('RUN HISTORY', 'Error writing ' + RUN_HISTORY)
+
     ENDTIME = datetime.now()
     delta = ENDTIME - STARTTIME
     LOGFILE.write('--------------------------------------------------------------------\n')
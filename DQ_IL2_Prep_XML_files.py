@@ -8,12 +8,20 @@
 #
 # Loads files source folder to target folder based on a max batch size parameter
 #
+# With PARSE_INDEX enabled, the files are taken from the parse indexes of the source folder when there are any (see
+# DQ_IL2_Parse_Index.py), otherwise the folder is listed. An index of the files moved is written to the target folder before
+# they are moved, and any file already in the target folder which is not indexed is indexed first
+#
 ##############################################################################################################################
 
 ### IMPORT PYTHON MODULES ####################################################################################################
 import os, re, time, sys, shutil, fileinput, datetime, ConfigParser, multiprocessing
-import itertools
+import itertools, heapq
 from multiprocessing import Pool, freeze_support
+import DQ_IL2_Sharded_Dir
+import DQ_IL2_Metrics
+import DQ_IL2_Autotune
+import DQ_IL2_Parse_Index
 
 ### GLOBAL VARIABLES #########################################################################################################
 YYYYMMDDSTR = time.strftime("%Y%m%d")
@@ -26,23 +34,31 @@ def move_file(multiprocessing_pool_vars):
     from_dir=multiprocessing_pool_vars[1]
     to_dir=multiprocessing_pool_vars[2]
 
-    from_filename=os.path.join(from_dir,filename)
-    to_filename=os.path.join(to_dir,filename)
-    
-    shutil.move(from_filename,to_filename)
+    # filename is relative to from_dir and may include a shard subfolder, which is kept in to_dir
+    # A file listed in a parse index may already have been moved (e.g. by an earlier run which listed the folder)
+    try:
+        DQ_IL2_Sharded_Dir.move_file(filename,from_dir,to_dir)
+    except (IOError, OSError), e:
+        return [False, os.path.basename(filename) + ': ' + str(e)]
 
-    return [True, os.path.basename(from_filename)]
+    return [True, os.path.basename(filename)]
 
-# Takes a list of list objects e.g. [[False, <error msg>],[True, <error msg>]] and outputs to log when an error has been encountered
-def check_multiprocessing_errors(results_list):
+# Takes a list (or iterator) of list objects e.g. [[False, <error msg>],[True, <error msg>]] and outputs to log when an error has been encountered
+# Progress is logged every log_freq results (0 for none). Returns the number of results
+def check_multiprocessing_errors(results_list, log_freq=0):
     NO_OF_ERRORS=0
+    RESULT_COUNT=0
     for result in results_list:
+        RESULT_COUNT+=1
+        if log_freq and RESULT_COUNT % log_freq == 0:
+            add_log_entry('MOVING FILES', str(RESULT_COUNT) + ' file(s) moved')
         ERROR=result[0]
         DETAILS=result[1]
         if not ERROR:
             NO_OF_ERRORS+=1
             add_log_entry('MULTIPROCESSING ERROR CHECKING', 'Error: ' + str(DETAILS))
     add_log_entry('MULTIPROCESSING ERROR CHECKING', str(NO_OF_ERRORS) + ' error(s)')
+    return RESULT_COUNT
 
 def add_log_entry(log_summary, log_msg):
     curr_time = time.strftime("%Y%m%d%H%M%S")
@@ -70,9 +86,18 @@ def main(argv):
     XML_DIR             = re.sub("/*$","/",config.get(CUSTOM_SECTION,'XML_DIR'))            # Location of the source xml
     MAX_XML_BATCH_SIZE  = int(config.get(CUSTOM_SECTION,'MAX_XML_BATCH_SIZE'))              # Controls max batch size - e.g. if set to 100, a max of 100 files will be processed
     NO_OF_PROCESSES     = int(config.get(CUSTOM_SECTION,'NO_OF_PROCESSES'))                 # No. of processes
+    MIN_PROCESSES       = int(config.get(CUSTOM_SECTION,'MIN_PROCESSES')) if config.has_option(CUSTOM_SECTION,'MIN_PROCESSES') else NO_OF_PROCESSES  # Min/max no. of processes, see DQ_IL2_Autotune.py
+    MAX_PROCESSES       = int(config.get(CUSTOM_SECTION,'MAX_PROCESSES')) if config.has_option(CUSTOM_SECTION,'MAX_PROCESSES') else NO_OF_PROCESSES
     DEBUG               = int(config.get(CUSTOM_SECTION,'DEBUG'))                           # Used to control output to the console (Default=1, i.e. output)
+    MP_CHUNKSIZE        = int(config.get(CUSTOM_SECTION,'MP_CHUNKSIZE')) if config.has_option(CUSTOM_SECTION,'MP_CHUNKSIZE') else 100                # No. of files sent to a process at a time
+    XML_MOVE_LOG_FREQ   = int(config.get(CUSTOM_SECTION,'XML_MOVE_LOG_FREQ')) if config.has_option(CUSTOM_SECTION,'XML_MOVE_LOG_FREQ') else 10000  # Progress is logged every XML_MOVE_LOG_FREQ files
+    PARSE_INDEX         = config.getboolean(CUSTOM_SECTION,'PARSE_INDEX') if config.has_option(CUSTOM_SECTION,'PARSE_INDEX') else False  # Use the parse indexes, see DQ_IL2_Parse_Index.py
 
     LOGFILE_DIR=os.path.join(ROOT_DIR, 'log/')
+    RUN_HISTORY=DQ_IL2_Metrics.run_history_file(ROOT_DIR)
+    METRICS=DQ_IL2_Metrics.RunMetrics('DQ_IL2_Prep_XML_files', {'NO_OF_PROCESSES': NO_OF_PROCESSES, 'MIN_PROCESSES': MIN_PROCESSES,
+                                                                  'MAX_PROCESSES': MAX_PROCESSES, 'MAX_XML_BATCH_SIZE': MAX_XML_BATCH_SIZE,
+                                                                  'MP_CHUNKSIZE': MP_CHUNKSIZE, 'PARSE_INDEX': PARSE_INDEX})
     
     ### LOG FILE VARIABLES #######################################################################################################
     LOGFILENAME=LOGFILE_DIR + 'DQ_IL2_Prep_XML_files_' + YYYYMMDDSTR + '.log'
@@ -86,29 +111,75 @@ def main(argv):
     ##############################################################################################################################
     print '\n*** Move files to inprocess folder'
 
-    source_dir_list =  [f for f in os.listdir(SOURCE_FILE_DIR) if f.endswith('.xml')]
-    source_dir_list.sort()
-         
-    batch_dir_list = [f for f in os.listdir(XML_DIR) if f.endswith('.xml')]
-    CURRENT_BATCH_SIZE = len(batch_dir_list)
+    # DQ_IL2_PreProcess_XML_Files only reads the parse indexes of XML_DIR when there are any, so they must list every file in
+    # it - files already there which are not indexed are indexed before the batch is added (and without PARSE_INDEX, any index
+    # left from when it was enabled is removed, so the folder is listed)
+    xml_dir_list = DQ_IL2_Sharded_Dir.list_files(XML_DIR, '.xml')
+    if PARSE_INDEX:
+        XML_INDEX = DQ_IL2_Parse_Index.IndexQueue(XML_DIR)
+        INDEXED = set([ENTRY[0] for ENTRY in XML_INDEX.entries()])
+        UNINDEXED = [FILENAME for FILENAME in xml_dir_list if FILENAME not in INDEXED]
+        if UNINDEXED:
+            DQ_IL2_Parse_Index.write_index(XML_DIR, [(FILENAME, None, None, None, None) for FILENAME in UNINDEXED])
+            add_log_entry('PARSE INDEX', str(len(UNINDEXED)) + ' file(s) in ' + XML_DIR + ' indexed')
+    else:
+        REMOVED_INDEXES = DQ_IL2_Parse_Index.remove_indexes(XML_DIR)
+        if REMOVED_INDEXES:
+            add_log_entry('PARSE INDEX', str(REMOVED_INDEXES) + ' index(es) removed from ' + XML_DIR + ' (PARSE_INDEX is not enabled)')
+    CURRENT_BATCH_SIZE = len(xml_dir_list)
     BATCH_DIFF=MAX_XML_BATCH_SIZE-CURRENT_BATCH_SIZE
-    pool = multiprocessing.Pool(NO_OF_PROCESSES)
+    SOURCE_INDEX = DQ_IL2_Parse_Index.IndexQueue(SOURCE_FILE_DIR) if PARSE_INDEX else None
+    source_entries = []
+    if BATCH_DIFF>0:
+        with METRICS.stage('list files') as STAGE:
+            if SOURCE_INDEX is not None and SOURCE_INDEX.has_indexes():
+                # The oldest BATCH_DIFF files are taken from the parse indexes, without listing the folder
+                source_entries = SOURCE_INDEX.take(BATCH_DIFF)
+                add_log_entry('PREPARING BATCH', str(len(source_entries)) + ' file(s) taken from the parse indexes of ' + SOURCE_FILE_DIR)
+            else:
+                # Only the first BATCH_DIFF filenames (in name order) are kept while the folder is listed, rather than the whole folder
+                source_entries = [(FILENAME, None, None, None, None) for FILENAME in heapq.nsmallest(BATCH_DIFF, DQ_IL2_Sharded_Dir.iter_files(SOURCE_FILE_DIR, '.xml'))]
+            STAGE.file_count = len(source_entries)
+    source_dir_list = [ENTRY[0] for ENTRY in source_entries]
+
     if BATCH_DIFF<=0:
         add_log_entry('PREPARING BATCH', str(CURRENT_BATCH_SIZE) + ' xml file(s) present in ' + XML_DIR + ' - no files added')
         
     elif source_dir_list: # If files exist for this filetype in the FTP_LANDING_ZONE
-        
-        results=pool.map(move_file, itertools.izip(source_dir_list[:BATCH_DIFF],itertools.repeat(SOURCE_FILE_DIR),
-                                                                                itertools.repeat(XML_DIR)))
-        add_log_entry('MOVED FILES', 'Processed ' + str(len(results)) + ' file(s)')
-        # Check multiprocessing results
-        check_multiprocessing_errors(results)
+
+        # The index is written before the files are moved, so that no file reaches XML_DIR without being indexed
+        if PARSE_INDEX:
+            DQ_IL2_Parse_Index.write_index(XML_DIR, source_entries)
+        # The no. of moves in flight starts at NO_OF_PROCESSES and is tuned between MIN_PROCESSES and MAX_PROCESSES
+        pool = multiprocessing.Pool(MAX_PROCESSES)
+        EXECUTOR = DQ_IL2_Autotune.AutotuningExecutor(pool, 'move files', NO_OF_PROCESSES, MIN_PROCESSES, MAX_PROCESSES)
+        with METRICS.stage('move files') as STAGE:
+            # The results are counted as they complete rather than collected
+            results=EXECUTOR.imap_unordered(move_file, itertools.izip(source_dir_list,itertools.repeat(SOURCE_FILE_DIR),
+                                                                                      itertools.repeat(XML_DIR)), MP_CHUNKSIZE)
+            # Check multiprocessing results
+            STAGE.file_count = check_multiprocessing_errors(results, XML_MOVE_LOG_FREQ)
+            STAGE.concurrency = EXECUTOR.stats()
+        pool.close()
+        pool.join()
+        if SOURCE_INDEX is not None:
+            SOURCE_INDEX.commit()
+        add_log_entry('MOVED FILES', 'Processed ' + str(STAGE.file_count) + ' file(s), ' + DQ_IL2_Autotune.format_stats(STAGE.concurrency))
     else:
         add_log_entry('PREPARING BATCH', 'No files available')
 
+    REMOVED_SHARDS = DQ_IL2_Sharded_Dir.remove_empty_shards(SOURCE_FILE_DIR)
+    if REMOVED_SHARDS:
+        add_log_entry('CLEANUP SHARD FOLDERS', str(REMOVED_SHARDS) + ' empty folder(s) removed from ' + SOURCE_FILE_DIR)
+
     ##############################################################################################################################
     # SCRIPT END
     ##############################################################################################################################
+    for LINE in METRICS.summary_lines():
+        add_log_entry('STAGE METRICS', LINE)
+    if not METRICS.write(RUN_HISTORY):
+        add_log_entry('RUN HISTORY', 'Error writing ' + RUN_HISTORY)
+
     ENDTIME = datetime.datetime.now()
     delta = ENDTIME - STARTTIME
     LOGFILE.write('--------------------------------------------------------------------\n')
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Scheduler.py
+
+DESCRIPTION:
+
+Decides how many zipfiles of each filetype DQ_IL2_Seq_Check admits from the landing zone each cycle, from the measured depth
+of the downstream queues and the recent throughput of the stages draining them, rather than from fixed batch sizes alone.
+
+The inputs are:
+- the depth of each downstream queue (see QUEUES) - "out", "xml" and "xml_inprocess" on the API path, "ga" on the GA path
+- the recent run history (see DQ_IL2_Metrics.py) - the effective drain rate of each queue is the no. of files its stage
+  processed over the last SCHEDULER_WINDOW_SECS (wall time, i.e. including the time between scheduled runs), the batch
+  throughput of DQ_IL2_Seq_Check (bytes/sec) and the no. of xmls per PARSED zipfile byte
+
+From these:
+- the latency of a path is estimated as the sum over its queues of depth / drain rate
+- the API headroom is the no. of xmls which can be added to the API path while keeping its latency under
+  TARGET_LATENCY_SECS: (TARGET_LATENCY_SECS - API latency) x the slowest xml drain rate
+- the cycle budget is the no. of zipfile bytes DQ_IL2_Seq_Check can process in SCHEDULER_CYCLE_SECS
+- the GA path is behind when the oldest PARSED zipfile waiting in the landing zone (plus the GA queue latency) is older than
+  half of TARGET_LATENCY_SECS
+
+Zipfiles are then admitted in sequence (filename) order within each filetype, oldest first across filetypes - or PARSED
+first, when the GA path is behind - until the cycle budget is spent. PARSED zipfiles are also limited by the API headroom
+(except when the GA path is behind, as GA messages only arrive in PARSED zipfiles) and are not admitted at all while the
+"out" folder holds more than MAX_OUTPUT_BATCH_SIZE files. MAX_BATCH_SIZE remains the upper limit per filetype. At least one
+zipfile is admitted per cycle whenever the limits allow, so a cycle budget smaller than a single zipfile cannot stall a
+filetype.
+
+Where there is no run history yet for a stage (e.g. a new deployment), that limit is not applied and is logged as unknown.
+"""
+
+import os
+import time
+import heapq
+
+from DQ_IL2_Metrics import read_run_history
+from DQ_IL2_Sharded_Dir import count_files
+
+SEQ_CHECK_SCRIPT = 'DQ_IL2_Seq_Check'
+PARSED = 'PARSED'
+HISTORY_TAIL_BYTES = 4 * 1024 * 1024
+
+# Queue name: (the suffix of the files counted, the script and stage draining it)
+QUEUES = {'out': ('.xml', 'DQ_IL2_Prep_XML_files', 'move files'),
+          'xml': ('.xml', 'DQ_IL2_PreProcess_XML_Files', 'concat'),
+          'xml_inprocess': ('.xml.MOD', 'DQ_IL2_DB_GP_Load_XML', 'gpload'),
+          'ga': ('.xml', 'DQ_IL2_DB_GA_Postgres_Load_XML', 'move files')}
+API_QUEUES = ('out', 'xml', 'xml_inprocess')
+API_XML_QUEUES = ('out', 'xml')
+GA_QUEUES = ('ga',)
+
+
+def run_started_at(run):
+    return time.mktime(time.strptime(run['started_at'], '%Y-%m-%d %H:%M:%S'))
+
+
+def drain_rate(runs, script, stage_name, now, window_secs):
+    """
+    Returns the effective rate (files/sec) of a stage over the window, i.e. the files processed by the runs started in the
+    window divided by the time since the first of them started (at least the time spent in the stage)
+    :param runs: list of run dicts (see DQ_IL2_Metrics.read_run_history)
+    :param script:
+    :param stage_name:
+    :param now:
+    :param window_secs:
+    :returns: float, or None if the stage has not run in the window
+    """
+    file_count = 0
+    stage_secs = 0.0
+    first_started_at = None
+    for run in runs:
+        if run.get('script') != script:
+            continue
+        started_at = run_started_at(run)
+        if started_at < now - window_secs:
+            continue
+        for stage in run.get('stages', []):
+            if stage['name'] == stage_name:
+                file_count += stage['files']
+                stage_secs += stage['secs']
+                first_started_at = started_at if first_started_at is None else min(first_started_at, started_at)
+    if first_started_at is None:
+        return None
+    span_secs = max(now - first_started_at, stage_secs)
+    return file_count / span_secs if span_secs > 0 else None
+
+
+def batch_bytes_per_sec(runs, now, window_secs):
+    """
+    Returns the batch throughput (zipfile bytes/sec) of DQ_IL2_Seq_Check over the window
+    :param runs:
+    :param now:
+    :param window_secs:
+    :returns: float, or None if no batch has been processed in the window
+    """
+    byte_count = 0
+    secs = 0.0
+    for run in runs:
+        if run.get('script') != SEQ_CHECK_SCRIPT or run.get('status', 'ok') != 'ok' or run_started_at(run) < now - window_secs:
+            continue
+        for stage in run.get('stages', []):
+            if stage['name'] == 'prepare batch' and stage['bytes']:
+                byte_count += stage['bytes']
+                secs += run['elapsed_secs']
+    return byte_count / secs if byte_count and secs > 0 else None
+
+
+def xmls_per_byte(runs, now, window_secs):
+    """
+    Returns the no. of xmls per PARSED zipfile byte seen by DQ_IL2_Seq_Check over the window
+    :param runs:
+    :param now:
+    :param window_secs:
+    :returns: float, or None if unknown
+    """
+    xml_count = 0
+    byte_count = 0
+    for run in runs:
+        if run.get('script') != SEQ_CHECK_SCRIPT or run_started_at(run) < now - window_secs:
+            continue
+        stages = dict([(stage['name'], stage) for stage in run.get('stages', [])])
+        if 'stream parse' in stages:
+            xml_count += stages['stream parse']['files']
+            byte_count += stages['stream parse']['bytes']
+        elif 'unzip' in stages and 'parse' in stages:
+            xml_count += stages['parse']['files']
+            byte_count += stages['unzip']['bytes']
+    return float(xml_count) / byte_count if xml_count and byte_count else None
+
+
+def path_latency(queues, depths, rates):
+    """
+    Returns the estimated latency (secs) of a path, i.e. the sum over its queues of depth / drain rate
+    :param queues:
+    :param depths: dict of queue name to no. of files
+    :param rates: dict of queue name to drain rate (None if unknown)
+    :returns: float, or None if the rate of a non-empty queue is unknown
+    """
+    latency = 0.0
+    for queue in queues:
+        depth = depths.get(queue, 0)
+        if not depth:
+            continue
+        if rates.get(queue) is None:
+            return None
+        if not rates[queue]:
+            return float('inf')
+        latency += depth / rates[queue]
+    return latency
+
+
+def format_secs(secs):
+    if secs is None:
+        return 'unknown'
+    if secs == float('inf'):
+        return 'stalled'
+    return '%.0fs' % (secs)
+
+
+class AdmissionPlan(object):
+    """
+    The zipfiles admitted by the scheduler for one cycle, with the measurements behind the decision
+    """
+
+    def __init__(self, filetypes):
+        self.admitted = dict([(filetype, []) for filetype in filetypes])
+        self.limits = {}
+        self.api_latency = None
+        self.ga_latency = None
+        self.api_headroom = None
+        self.budget_bytes = None
+        self.admitted_bytes = 0
+        self.ga_priority = False
+
+    def count(self, filetype):
+        return len(self.admitted[filetype])
+
+    def summary(self):
+        """
+        Returns the plan as a log message
+        :returns: string
+        """
+        return 'Admitted %s (%s byte(s), budget %s) - API latency %s, GA latency %s, API headroom %s xml(s)%s%s' % (
+            ', '.join(['%s %s' % (filetype, self.count(filetype)) for filetype in sorted(self.admitted)]), self.admitted_bytes,
+            'unknown' if self.budget_bytes is None else '%.0f byte(s)' % (self.budget_bytes), format_secs(self.api_latency),
+            format_secs(self.ga_latency), 'unknown' if self.api_headroom is None else '%.0f' % (self.api_headroom),
+            ', GA priority' if self.ga_priority else '',
+            ''.join(['; %s limited by %s' % (filetype, self.limits[filetype]) for filetype in sorted(self.limits)]))
+
+
+class AdmissionScheduler(object):
+    """
+    Plans the admission of landing zone zipfiles into the batch folder (see the module description)
+    """
+
+    def __init__(self, queue_dirs, history_file, target_latency_secs=900, cycle_secs=60, window_secs=3600, max_batch_size=720,
+                 max_output_batch_size=500000):
+        """
+        :param queue_dirs: dict of queue name (see QUEUES) to folder
+        :param history_file: the run history (see DQ_IL2_Metrics.py)
+        :param target_latency_secs: the end-to-end latency to keep under
+        :param cycle_secs: the time a cycle (batch) should take
+        :param window_secs: the run history window the throughput is measured over
+        :param max_batch_size: the maximum no. of zipfiles of each filetype in the batch folder
+        :param max_output_batch_size: PARSED zipfiles are not admitted while the "out" folder holds more files than this
+        """
+        self.queue_dirs = queue_dirs
+        self.history_file = history_file
+        self.target_latency_secs = target_latency_secs
+        self.cycle_secs = cycle_secs
+        self.window_secs = window_secs
+        self.max_batch_size = max_batch_size
+        self.max_output_batch_size = max_output_batch_size
+
+    def queue_depths(self):
+        """
+        Counts the files in each downstream queue
+        :returns: dict of queue name to no. of files
+        """
+        return dict([(queue, count_files(path, QUEUES[queue][0]) if os.path.isdir(path) else 0) for queue, path in self.queue_dirs.items()])
+
+    def recent_runs(self):
+        if not os.path.exists(self.history_file):
+            return []
+        return read_run_history(self.history_file, max_bytes=HISTORY_TAIL_BYTES)
+
+    def plan(self, candidates, batch, depths, runs, now=None):
+        """
+        Decides which zipfiles to admit this cycle
+        :param candidates: dict of filetype to a list of (filename, size, mtime) waiting in the landing zone, in sequence order
+        :param batch: dict of filetype to a list of (filename, size) already in the batch folder
+        :param depths: dict of queue name to no. of files (see queue_depths)
+        :param runs: the recent run history (see recent_runs)
+        :param now: seconds since the epoch (defaults to now)
+        :returns: AdmissionPlan
+        """
+        now = time.time() if now is None else now
+        plan = AdmissionPlan(candidates.keys())
+
+        rates = dict([(queue, drain_rate(runs, QUEUES[queue][1], QUEUES[queue][2], now, self.window_secs)) for queue in QUEUES])
+        plan.api_latency = path_latency(API_QUEUES, depths, rates)
+        plan.ga_latency = path_latency(GA_QUEUES, depths, rates)
+
+        bytes_per_sec = batch_bytes_per_sec(runs, now, self.window_secs)
+        batch_bytes = sum([size for filetype in batch for fname, size in batch[filetype]])
+        if bytes_per_sec is not None:
+            plan.budget_bytes = max(bytes_per_sec * self.cycle_secs - batch_bytes, 0)
+
+        # PARSED zipfiles are limited by the xml headroom on the API path (in expected xmls, from their size)
+        xml_ratio = xmls_per_byte(runs, now, self.window_secs)
+        xml_rates = [rates[queue] for queue in API_XML_QUEUES]
+        if plan.api_latency is not None and None not in xml_rates:
+            plan.api_headroom = max(self.target_latency_secs - plan.api_latency, 0) * min(xml_rates)
+            if xml_ratio is not None:
+                plan.api_headroom -= sum([size for fname, size in batch.get(PARSED, [])]) * xml_ratio
+
+        parsed_candidates = candidates.get(PARSED, [])
+        if parsed_candidates:
+            oldest_age = now - min([mtime for fname, size, mtime in parsed_candidates])
+            ga_latency = plan.ga_latency if plan.ga_latency not in (None, float('inf')) else 0.0
+            plan.ga_priority = oldest_age + ga_latency > self.target_latency_secs / 2.0
+
+        closed = set()
+        if depths.get('out', 0) > self.max_output_batch_size:
+            closed.add(PARSED)
+            plan.limits[PARSED] = 'MAX_OUTPUT_BATCH_SIZE (%s file(s) in out)' % (depths['out'])
+        elif plan.api_headroom is not None and plan.api_headroom <= 0 and not plan.ga_priority:
+            closed.add(PARSED)
+            plan.limits[PARSED] = 'API latency (%s)' % (format_secs(plan.api_latency))
+
+        xml_used = 0.0
+        for filetype, fname, size in self._admission_order(candidates, plan.ga_priority):
+            if filetype in closed:
+                continue
+            if len(batch.get(filetype, [])) + plan.count(filetype) >= self.max_batch_size:
+                closed.add(filetype)
+                plan.limits[filetype] = 'MAX_BATCH_SIZE'
+                continue
+            if filetype == PARSED and PARSED not in plan.limits and plan.api_headroom is not None and xml_ratio is not None \
+                    and not plan.ga_priority and plan.count(PARSED) and xml_used + size * xml_ratio > plan.api_headroom:
+                closed.add(PARSED)
+                plan.limits[PARSED] = 'API headroom'
+                continue
+            if plan.budget_bytes is not None and plan.admitted_bytes + size > plan.budget_bytes and (plan.admitted_bytes or batch_bytes):
+                break
+            plan.admitted[filetype].append(fname)
+            plan.admitted_bytes += size
+            if filetype == PARSED and xml_ratio is not None:
+                xml_used += size * xml_ratio
+        return plan
+
+    def _admission_order(self, candidates, ga_priority):
+        """
+        Yields (filetype, filename, size) in admission order - each filetype in sequence order, merged oldest first across
+        filetypes, with PARSED first when ga_priority is set
+        :param candidates:
+        :param ga_priority:
+        :returns: generator
+        """
+        def in_sequence_order(filetype):
+            # heapq.merge needs each input sorted, so each zipfile is keyed on the latest mtime so far of its filetype - a
+            # zipfile is never admitted before an earlier zipfile (in sequence order) of the same filetype
+            latest = None
+            for fname, size, mtime in candidates[filetype]:
+                latest = mtime if latest is None else max(latest, mtime)
+                yield latest, filetype, fname, size
+
+        filetypes = sorted([filetype for filetype in candidates if candidates[filetype]])
+        if ga_priority and PARSED in filetypes:
+            for fname, size, mtime in candidates[PARSED]:
+                yield PARSED, fname, size
+            filetypes.remove(PARSED)
+        for latest, filetype, fname, size in heapq.merge(*[in_sequence_order(filetype) for filetype in filetypes]):
+            yield filetype, fname, size
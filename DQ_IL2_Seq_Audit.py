@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Seq_Audit.py
+
+DESCRIPTION:
+
+Audits the zipfile sequences of the archive tree for a date range (e.g. a year of history, for an incident review), rather
+than one batch at a time as DQ_IL2_Seq_Check does. Requires numpy.
+
+Every RAW/PARSED/STORED/FAILED zipfile name (<filetype>_<yyyymmdd>_<hhmi>_<seq>.zip) found under the given folders (and
+their subfolders) is loaded into numpy arrays of (filetype, date, time, sequence), and the gaps, duplicates and midnight
+resets of each filetype and date are computed over the whole arrays at once:
+
+- the files of each filetype and date are taken in time order, and each sequence is unwrapped into an ordinal from the
+  step from the previous one, modulo MAX_FILE_SEQ (the same wrap as modulo_seq_add in DQ_IL2_Seq_Check - 9999 is followed
+  by 0000, then 0001...), so a day which wraps past 9999 is not reported as a gap. A step back (a late file) of up to half
+  of MAX_FILE_SEQ is taken as a step back rather than a wrap
+- sequences restart at 0001 each day - the sequences below the first one of a date are missing, unless the date carries on
+  from the last sequence of the previous date (no midnight reset), which is reported as such rather than as a gap
+- a date with no files between two dates with files is reported as a missing date
+
+    python DQ_IL2_Seq_Audit.py -r <root folder> | -d <folder> [-d <folder>...] [-s <yyyymmdd>] [-e <yyyymmdd>] [-t <filetype>] [-a] [-v]
+
+-r audits the archive and raw_inprocess folders of a DQ_IL2 root folder (see DQ_IL2_Seq_Check.py), -d any other folder.
+Only the dates with an issue are listed, unless -a is given. -v also lists each missing range and duplicate.
+"""
+
+import os
+import re
+import sys
+import time
+import getopt
+import numpy as np
+from DQ_IL2_Seq_Ledger import format_range
+
+MAX_FILE_SEQ = 10000
+
+FILETYPES = ['RAW', 'PARSED', 'STORED', 'FAILED']
+
+FILENAME_REGEX = re.compile(r'^(RAW|PARSED|STORED|FAILED)_[0-9]{8}_[0-9]{4}_[0-9]{4}.*\.zip$')
+
+ARCHIVE_SUBDIRS = ['archive', 'raw_inprocess']
+
+
+def list_sequence_filenames(dirs, filetypes=FILETYPES):
+    """
+    Returns the zipfile names (without their folder) found under the given folders and their subfolders
+    :param dirs:
+    :param filetypes:
+    :returns: list of filenames
+    """
+    filenames = []
+    for base_dir in dirs:
+        for path, subdirs, names in os.walk(base_dir):
+            filenames.extend([name for name in names if FILENAME_REGEX.match(name) and name[:name.index('_')] in filetypes])
+    return filenames
+
+
+def parse_filenames(filenames, filetypes=FILETYPES):
+    """
+    Returns the filetype, date, time and sequence of each filename as numpy arrays. The fields are read from the bytes of
+    the filenames of each filetype at once - filenames not in the expected format (or with an invalid date) are dropped
+    :param filenames:
+    :param filetypes:
+    :returns: dict of 'filetype' (index into filetypes), 'date' (datetime64[D]), 'minute' (minute of the day), 'seq' (0 -
+              9999) and 'filename' arrays
+    """
+    by_filetype = dict((filetype, []) for filetype in filetypes)
+    for filename in filenames:
+        names = by_filetype.get(filename[:filename.find('_')])
+        if names is not None:
+            names.append(filename)
+
+    columns = {'filetype': [], 'date': [], 'minute': [], 'seq': [], 'filename': []}
+    for filetype_index, filetype in enumerate(filetypes):
+        prefix = filetype + '_'
+        if not by_filetype[filetype]:
+            continue
+        names = np.array(by_filetype[filetype], dtype=str)
+        width = names.dtype.itemsize
+        if width < len(prefix) + 18:
+            continue
+        chars = np.frombuffer(names.tobytes(), dtype=np.uint8).reshape(len(names), width)
+        start = len(prefix)
+        # <yyyymmdd>_<hhmi>_<seq> - a non digit (or the padding of a short filename) is > 9 once '0' is subtracted
+        digits = chars[:, start:start + 18] - np.uint8(ord('0'))
+        digit_cols = [i for i in range(18) if i not in (8, 13)]
+        valid = (digits[:, digit_cols] <= 9).all(axis=1) & (chars[:, start + 8] == ord('_')) & (chars[:, start + 13] == ord('_'))
+        digits = digits[valid].astype(np.int32)
+
+        def number(first, length):
+            return digits[:, first:first + length].dot(10 ** np.arange(length - 1, -1, -1))
+
+        year, month, day = number(0, 4), number(4, 2), number(6, 2)
+        hours, minutes = number(9, 2), number(11, 2)
+        months = (year - 1970) * 12 + month - 1
+        dates = months.astype('datetime64[M]').astype('datetime64[D]') + (day - 1)
+        valid_date = (month >= 1) & (month <= 12) & (day >= 1) & (dates.astype('datetime64[M]').astype(np.int64) == months) & (hours < 24) & (minutes < 60)
+
+        columns['filetype'].append(np.full(valid_date.sum(), filetype_index, dtype=np.int8))
+        columns['date'].append(dates[valid_date])
+        columns['minute'].append((hours * 60 + minutes)[valid_date])
+        columns['seq'].append(number(14, 4)[valid_date])
+        columns['filename'].append(names[valid][valid_date])
+
+    empty = {'filetype': np.int8, 'date': 'datetime64[D]', 'minute': np.int32, 'seq': np.int32, 'filename': str}
+    return dict((key, np.concatenate(values) if values else np.array([], dtype=empty[key])) for key, values in columns.items())
+
+
+def to_date(yyyymmdd):
+    return np.datetime64('%s-%s-%s' % (yyyymmdd[:4], yyyymmdd[4:6], yyyymmdd[6:8]), 'D')
+
+
+def select_files(files, start_date=None, end_date=None, filetype_index=None):
+    """
+    Returns the files within a date range (inclusive) and of one filetype. The files of the date before start_date are kept
+    too, to check the midnight reset of start_date - see audit_from
+    :param files: see parse_filenames
+    :param start_date: yyyymmdd, or None
+    :param end_date: yyyymmdd, or None
+    :param filetype_index: index into the filetypes, or None for all of them
+    :returns: dict (see parse_filenames)
+    """
+    keep = np.ones(len(files['seq']), dtype=bool)
+    if start_date:
+        keep &= files['date'] >= to_date(start_date) - 1
+    if end_date:
+        keep &= files['date'] <= to_date(end_date)
+    if filetype_index is not None:
+        keep &= files['filetype'] == filetype_index
+    return dict((key, values[keep]) for key, values in files.items())
+
+
+def audit_sequences(files, max_file_seq=MAX_FILE_SEQ):
+    """
+    Computes the gaps, duplicates and midnight resets of each filetype and date (see the module description)
+    :param files: see parse_filenames
+    :param max_file_seq:
+    :returns: dict of:
+              'days' - arrays, one entry per filetype and date: 'filetype', 'date', 'received', 'first_seq', 'last_seq'
+                       (ordinals - a sequence past the 9999 wrap is above max_file_seq), 'missing', 'duplicates' and
+                       'no_reset' (True if the date carries on from the previous date's sequences)
+              'gaps' - arrays, one entry per missing range: 'filetype', 'date', 'first_seq', 'last_seq' (ordinals)
+              'duplicates' - arrays, one entry per duplicate file: 'filetype', 'date', 'seq' (ordinal), 'filename'
+              'missing_dates' - arrays, one entry per run of dates with no files: 'filetype', 'first_date', 'last_date'
+    """
+    # A single int64 sort key (filetype, date, minute, seq) sorts much faster than a lexsort of the 4 arrays
+    key = files['filetype'].astype(np.int64) << 22
+    key += files['date'].astype(np.int64) - np.datetime64('1970-01-01').astype(np.int64) + (1 << 21)
+    key *= 1440
+    key += files['minute']
+    key *= max_file_seq
+    key += files['seq']
+    order = np.argsort(key, kind='mergesort')
+    filetype, date, seq, filename = files['filetype'][order], files['date'][order], files['seq'][order].astype(np.int64), files['filename'][order]
+    count = len(seq)
+
+    new_day = np.ones(count, dtype=bool)
+    new_day[1:] = (filetype[1:] != filetype[:-1]) | (date[1:] != date[:-1])
+    day_starts = np.flatnonzero(new_day)
+    day_index = np.cumsum(new_day) - 1
+
+    # The step from the previous file of the same date, modulo max_file_seq (as modulo_seq_add): 9999 -> 0000 is a step of 1
+    step = np.zeros(count, dtype=np.int64)
+    step[1:] = (seq[1:] - seq[:-1]) % max_file_seq
+    step[step > max_file_seq // 2] -= max_file_seq
+    # The first file of each date starts from its own sequence - 0000 (the sequence after 9999) as max_file_seq
+    first_ordinal = np.where(seq[day_starts] == 0, max_file_seq, seq[day_starts])
+    step[day_starts] = 0
+    ordinal = np.cumsum(step)
+    ordinal += (first_ordinal - ordinal[day_starts])[day_index]
+
+    # Distinct ordinals of each date, in order - a repeated ordinal is a duplicate
+    by_ordinal = np.argsort(day_index * (ordinal.max() - ordinal.min() + 1 if count else 1) + (ordinal - ordinal.min() if count else ordinal), kind='mergesort')
+    sorted_day, sorted_ordinal = day_index[by_ordinal], ordinal[by_ordinal]
+    repeat = np.zeros(count, dtype=bool)
+    repeat[1:] = (sorted_day[1:] == sorted_day[:-1]) & (sorted_ordinal[1:] == sorted_ordinal[:-1])
+    distinct_day, distinct_ordinal = sorted_day[~repeat], sorted_ordinal[~repeat]
+    day_count = len(day_starts)
+
+    # Midnight resets - a date carries on from the previous one if it does not start at 0001 but at the sequence after the
+    # last one (in time order) of the previous date
+    day_filetype, day_date = filetype[day_starts], date[day_starts]
+    day_ends = np.append(day_starts[1:], count) - 1
+    no_reset = np.zeros(day_count, dtype=bool)
+    no_reset[1:] = ((day_filetype[1:] == day_filetype[:-1]) & (day_date[1:] - day_date[:-1] == np.timedelta64(1, 'D')) &
+                    (first_ordinal[1:] != 1) & (seq[day_starts[1:]] == (seq[day_ends[:-1]] + 1) % max_file_seq))
+
+    # Gaps - between consecutive distinct ordinals of a date, and below the first ordinal of a date which was reset
+    follows = np.zeros(len(distinct_ordinal), dtype=bool)
+    follows[1:] = distinct_day[1:] == distinct_day[:-1]
+    previous = np.zeros(len(distinct_ordinal), dtype=np.int64)
+    previous[1:] = distinct_ordinal[:-1]
+    previous[~follows] = 0
+    gap = (distinct_ordinal - previous > 1) & (follows | ~no_reset[distinct_day])
+    gap_day = distinct_day[gap]
+    gap_first, gap_last = previous[gap] + 1, distinct_ordinal[gap] - 1
+
+    # Dates with no files between two dates with files of the same filetype
+    date_step = np.zeros(day_count, dtype=np.int64)
+    date_step[1:] = (day_date[1:] - day_date[:-1]).astype(np.int64)
+    missing_run = np.flatnonzero((date_step > 1) & np.append(False, day_filetype[1:] == day_filetype[:-1]))
+
+    return {'days': {'filetype': day_filetype,
+                     'date': day_date,
+                     'received': np.bincount(day_index, minlength=day_count),
+                     'first_seq': first_ordinal,
+                     'last_seq': np.maximum.reduceat(ordinal[by_ordinal], day_starts) if count else ordinal,
+                     'missing': np.bincount(gap_day, weights=gap_last - gap_first + 1, minlength=day_count).astype(np.int64),
+                     'duplicates': np.bincount(sorted_day[repeat], minlength=day_count),
+                     'no_reset': no_reset},
+            'gaps': {'filetype': day_filetype[gap_day], 'date': day_date[gap_day], 'first_seq': gap_first, 'last_seq': gap_last},
+            'duplicates': {'filetype': filetype[by_ordinal][repeat], 'date': date[by_ordinal][repeat], 'seq': sorted_ordinal[repeat],
+                           'filename': filename[by_ordinal][repeat]},
+            'missing_dates': {'filetype': day_filetype[missing_run], 'first_date': day_date[missing_run - 1] + 1,
+                              'last_date': day_date[missing_run] - 1}}
+
+
+def audit_from(audit, start_date):
+    """
+    Returns the audit of the dates from start_date, i.e. without the date before it (see select_files)
+    :param audit: see audit_sequences
+    :param start_date: yyyymmdd
+    :returns: dict (see audit_sequences)
+    """
+    start = to_date(start_date)
+    selected = {}
+    for section, arrays in audit.items():
+        keep = (arrays['last_date'] if section == 'missing_dates' else arrays['date']) >= start
+        selected[section] = dict((key, values[keep]) for key, values in arrays.items())
+    return selected
+
+
+def format_date(date):
+    return str(date).replace('-', '')
+
+
+def print_report(audit, filetypes=FILETYPES, all_dates=False, verbose=False, max_file_seq=MAX_FILE_SEQ):
+    """
+    Prints the audit, one line per filetype and date (with an issue, unless all_dates) and a summary per filetype
+    :param audit: see audit_sequences
+    :param filetypes:
+    :param all_dates:
+    :param verbose: also print each missing range and duplicate
+    :param max_file_seq:
+    :returns: None
+    """
+    days = audit['days']
+    issue = (days['missing'] > 0) | (days['duplicates'] > 0) | days['no_reset']
+    for i in (range(len(issue)) if all_dates else np.flatnonzero(issue)):
+        print '%s\t%s\t%s file(s)\t%s\t%s missing\t%s duplicate(s)%s' % (
+            filetypes[days['filetype'][i]], format_date(days['date'][i]), days['received'][i],
+            format_range(days['first_seq'][i], days['last_seq'][i], max_file_seq), days['missing'][i], days['duplicates'][i],
+            '\tno midnight reset' if days['no_reset'][i] else '')
+
+    if verbose:
+        gaps = audit['gaps']
+        for i in range(len(gaps['first_seq'])):
+            print 'Missing\t%s\t%s\t%s\t(%s file(s))' % (filetypes[gaps['filetype'][i]], format_date(gaps['date'][i]),
+                                                         format_range(gaps['first_seq'][i], gaps['last_seq'][i], max_file_seq),
+                                                         gaps['last_seq'][i] - gaps['first_seq'][i] + 1)
+        duplicates = audit['duplicates']
+        for i in range(len(duplicates['seq'])):
+            print 'Duplicate\t%s\t%s\t%s\t%s' % (filetypes[duplicates['filetype'][i]], format_date(duplicates['date'][i]),
+                                                 format_range(duplicates['seq'][i], duplicates['seq'][i], max_file_seq), duplicates['filename'][i])
+
+    missing_dates = audit['missing_dates']
+    for i in range(len(missing_dates['first_date'])):
+        first_date, last_date = missing_dates['first_date'][i], missing_dates['last_date'][i]
+        print 'No files\t%s\t%s%s' % (filetypes[missing_dates['filetype'][i]], format_date(first_date),
+                                      '' if first_date == last_date else '-%s' % (format_date(last_date)))
+
+    for filetype_index, filetype in enumerate(filetypes):
+        of_filetype = days['filetype'] == filetype_index
+        if not of_filetype.any():
+            continue
+        print '%s: %s date(s) %s-%s, %s file(s), %s missing, %s duplicate(s), %s date(s) without a midnight reset, %s date(s) with no files' % (
+            filetype, of_filetype.sum(), format_date(days['date'][of_filetype].min()), format_date(days['date'][of_filetype].max()),
+            days['received'][of_filetype].sum(), days['missing'][of_filetype].sum(), days['duplicates'][of_filetype].sum(),
+            days['no_reset'][of_filetype].sum(),
+            (missing_dates['last_date'] - missing_dates['first_date'] + 1)[missing_dates['filetype'] == filetype_index].astype(np.int64).sum())
+
+
+def main(argv):
+    dirs = []
+    start_date = None
+    end_date = None
+    filetype = None
+    all_dates = False
+    verbose = False
+
+    try:
+        opts, args = getopt.getopt(argv, "r:d:s:e:t:av")
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-r':
+            dirs.extend([os.path.join(arg, subdir) for subdir in ARCHIVE_SUBDIRS])
+        elif opt == '-d':
+            dirs.append(arg)
+        elif opt == '-s':
+            start_date = arg
+        elif opt == '-e':
+            end_date = arg
+        elif opt == '-t':
+            filetype = arg
+        elif opt == '-a':
+            all_dates = True
+        elif opt == '-v':
+            verbose = True
+
+    if not dirs or (filetype is not None and filetype not in FILETYPES):
+        print __doc__
+        sys.exit(2)
+
+    start_time = time.time()
+    filenames = list_sequence_filenames(dirs, [filetype] if filetype else FILETYPES)
+    list_secs = time.time() - start_time
+
+    start_time = time.time()
+    files = select_files(parse_filenames(filenames), start_date, end_date)
+    audit = audit_sequences(files)
+    if start_date:
+        audit = audit_from(audit, start_date)
+    audit_secs = time.time() - start_time
+
+    print_report(audit, all_dates=all_dates, verbose=verbose)
+    print 'Audited %s file(s) in %.3f sec(s) (listed in %.3f sec(s))' % (audit['days']['received'].sum(), audit_secs, list_secs)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
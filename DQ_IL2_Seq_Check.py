@@ -16,8 +16,9 @@ This script does the following:
 - Unzips the files using multicore processing
 - Move the files to an output folder
 - Removes temporary folders
-- Checks how old the MDS extract file is and if older than MDS_REFRESH_HRS, then it is refreshed from the MDS database
-- Parses all xml files using multicore processing
+- Checks how old the MDS snapshot is and if older than MDS_REFRESH_HRS, then it is refreshed from the MDS database (see
+  DQ_IL2_MDS_Snapshot.py) - if the database is unreachable, the last good snapshot is used
+- Parses all xml files using multicore processing (incrementally, without building the element tree - see DQ_IL2_XML_Classifier.py)
 
         #<commonAPIPlus>
         #    <APIData>
@@ -27,9 +28,50 @@ This script does the following:
         #    </APIData>
         #</commonAPIPlus>
 
-- Filters GA rows from the xmls (all files are written to the "out" folder)
+- Filters GA rows from the xmls (all files are written to the "out" folder, GA files are also hardlinked into the GA folder - or
+  copied, if it is on another volume - see DQ_IL2_Fanout.py)
+- Classifies each API message as GA, COMMERCIAL or UNKNOWN from its flightId (see DQ_IL2_Flight_Router.py) and writes it to
+  the GA_OUTPUT_DIR, COMMERCIAL_OUTPUT_DIR or UNKNOWN_OUTPUT_DIR folder (all default to the "out" folder)
+- With SEQ_LEDGER set, every sequence received is recorded in an SQLite ledger, which keeps the gaps as missing ranges and
+  handles late (out of order) arrivals (see DQ_IL2_Seq_Ledger.py) - MAX_SEQS.ini is still written from the ledger, so
+  SEQ_LEDGER can be unset again without losing the sequences
 - Updated to fix sequences bug which does not handle sequences resetting at midnight
 - If the record does not have an API tag then it is removed
+- Run with -w (--watch) to run as a long-running process, which keeps a warm worker pool and the MDS carrier tables in memory
+  and processes zipfiles as soon as they arrive in the FTP_LANDING_ZONE (polled every WATCH_POLL_INTERVAL_SECS)
+- Each directory is scanned once per batch (see DQ_IL2_Dir_Index.py) - the "out" folder is only counted, and the landing zone
+  and batch folder listings are bucketed by filetype and kept up to date as files are moved
+- With PIPELINE_MODE enabled, each PARSED zip is a single unzip/classify/route task (as STREAM_PARSE) whose result is consumed
+  as soon as it completes, while the AWS staging and archive moves run in background threads - each zip is archived as soon as it
+  has been parsed and staged, rather than after every zip has been parsed
+- With SHARD_OUTPUT enabled, xmls are written to <output folder>/<yyyymmddhh>/<hash prefix>/ subfolders rather than one flat
+  folder (see DQ_IL2_Sharded_Dir.py) - the downstream scripts list and move files with the same shard-aware helpers
+- Zips are staged for the AWS data feed on AWS_STAGING_THREADS threads while the xmls are parsed, each with its size and sha1
+  recorded in a per-batch AWS_MANIFEST_<timestamp>.csv (see DQ_IL2_AWS_Staging.py). Set AWS_STAGING_WAIT to wait for the
+  manifest before the batch completes
+- The wall time, no. of files and bytes of each stage of a batch are logged and appended to the run history (see
+  DQ_IL2_Metrics.py)
+- The unzip and parse phases run on a pool of MAX_PROCESSES workers, each with a no. of tasks in flight which starts at
+  NO_OF_PROCESSES and is tuned between MIN_PROCESSES and MAX_PROCESSES from the observed throughput and CPU utilisation (see
+  DQ_IL2_Autotune.py) - in watch mode, each batch starts from the concurrency chosen in the previous one
+- With ADMISSION_SCHEDULER enabled, the no. of zipfiles of each filetype admitted from the landing zone each batch is
+  decided from the depth of the downstream queues and the recent stage throughput, to keep the end-to-end latency under
+  TARGET_LATENCY_SECS, rather than by MAX_BATCH_SIZE alone (see DQ_IL2_Scheduler.py)
+- With CHECKPOINT_JOURNAL enabled, the stages completed for each zipfile of a batch (sequence check, unzip, parse, AWS staging)
+  are recorded in an append-only checkpoint journal, so a batch interrupted part way through is resumed - completed stages
+  are skipped and only the incomplete zipfiles are redone (see DQ_IL2_Checkpoint.py)
+- With PARSE_INDEX enabled, each batch writes a sidecar index of the xmls written to each output folder (and the GA folder) -
+  filename, size, class, flightIds and source zip - which the downstream scripts read instead of listing the folder and
+  statting every file (see DQ_IL2_Parse_Index.py)
+- With DEDUP_INDEX set, the sha1 of each PARSED zip and of each xml message is recorded in an SQLite index (for
+  DEDUP_RETENTION_HRS) - a zip re-delivered by upstream is archived without being parsed, and a message already received
+  (e.g. in another PARSED zip) is not written to the output folders again (see DQ_IL2_Dedup.py)
+- With SUPERVISE_WORKERS enabled, each xml (or zip) parsed has a time budget (XML_TASK_TIMEOUT_SECS, ZIP_TASK_TIMEOUT_SECS) -
+  a worker over budget, or crashed, is replaced and the file is routed to the "reject" folder (with the reason in
+  <filename>.reason), while the rest of the batch carries on. Workers are also recycled after MAX_TASKS_PER_CHILD tasks or
+  over MAX_WORKER_MEMORY_MB (see DQ_IL2_Supervisor.py)
+- With STREAM_PARSE enabled, PARSED zips are read in memory by each worker and xmls are written once, directly to the "out" (and GA)
+  folder - nothing is extracted to the tmp folder, so there is no second read of each file and no temp folder cleanup
 """
 
 import os
@@ -41,17 +83,46 @@ import re
 import shutil
 import logging
 import ConfigParser
-import xml.etree.ElementTree as ET
-import pyodbc
-import getpass
 import multiprocessing
 import itertools
+import cPickle
+import getopt
+import signal
+import functools
+import threading
+import Queue
 from logging.handlers import TimedRotatingFileHandler
 from multiprocessing import freeze_support
+from DQ_IL2_XML_Classifier import classify_xml_file, classify_xml_string
+from DQ_IL2_Flight_Router import GA, FLIGHT_CLASSES
+from DQ_IL2_Fanout import link_or_copy, same_file
+from DQ_IL2_AWS_Staging import AWSStager, file_sha1
+from DQ_IL2_MDS_Snapshot import MDSSnapshotStore, pyodbc_source
+from DQ_IL2_Dir_Index import DirectoryIndex
+from DQ_IL2_Sharded_Dir import output_dir, count_files
+from DQ_IL2_Seq_Ledger import SeqLedger, format_range
+from DQ_IL2_Metrics import RunMetrics, run_history_file
+from DQ_IL2_Checkpoint import CheckpointJournal
+from DQ_IL2_Scheduler import AdmissionScheduler
+from DQ_IL2_Autotune import AutotuningExecutor
+from DQ_IL2_Parse_Index import BatchParseIndex, recover_partial_indexes
+from DQ_IL2_Dedup import DedupIndex, content_sha1
+from DQ_IL2_Supervisor import SupervisedPool
 
 info_logger = logging.getLogger('Seq Check')
 seq_logger = logging.getLogger('Sequences')
 
+PARSED_NS = 'http://www.ibm.com/semaphore/commonAPI/'
+MAX_FILE_SEQ = 10000
+IPC_SAMPLE_TASKS = 100
+DEDUP_RECORD_BATCH = 1000     # No. of messages recorded in the dedup index per transaction (see ParseResultCounts)
+
+# Read-only classification tables/settings shared by all parse tasks in a worker process, set once by init_parse_worker
+parse_worker_config = {}
+
+# The last AutotuningExecutor of each phase, so that in watch mode the next batch starts from the concurrency it chose
+phase_executors = {}
+
 
 # Logging function
 
@@ -94,20 +165,25 @@ def setup_logger(name, log_file, debug=False, write_to_console=False, log_freque
 # Filesystem functions
 
 
-def prepare_batch_files(output_file_dir, max_output_batch_size, ftp_landing_zone, source_file_dir, regex, max_batch_size, filetypes):
+def prepare_batch_files(dir_index, output_file_dir, max_output_batch_size, ftp_landing_zone, source_file_dir, max_batch_size, filetypes, scheduler=None):
     """
     Moves batch of files from source to target matching the file suffix and expected filetypes
+    Each directory is scanned once by the DirectoryIndex and the moves are recorded in it, so it can be reused by the caller
+    With a scheduler, the zipfiles admitted are decided by it instead (see schedule_batch_files)
+    :param dir_index: DirectoryIndex
     :param output_file_dir:
     :param max_output_batch_size:
     :param ftp_landing_zone:
     :param source_file_dir:
-    :param regex:
     :param max_batch_size:
     :param filetypes:
-    :returns: None
+    :param scheduler: AdmissionScheduler or None
+    :returns: int (the number of zipfiles in the batch)
     """
+    if scheduler is not None:
+        return schedule_batch_files(dir_index, scheduler, ftp_landing_zone, source_file_dir, filetypes)
 
-    output_dir_length = len(os.listdir(output_file_dir))
+    output_dir_length = count_files(output_file_dir)
 
     if output_dir_length > max_output_batch_size:
         info_logger.warn('Output batch size exceeded: %s files in %s' % (output_dir_length, output_file_dir))
@@ -116,17 +192,15 @@ def prepare_batch_files(output_file_dir, max_output_batch_size, ftp_landing_zone
         info_logger.info('Output batch size ok: %s file(s) in %s' % (output_dir_length, output_file_dir))
 
     for filetype in filetypes:
-        ftp_landing_zone_dir_list = [f for f in os.listdir(ftp_landing_zone) if re.match(regex, f) and f.startswith(filetype)]
-        ftp_landing_zone_dir_list.sort()
+        ftp_landing_zone_dir_list = dir_index.files(ftp_landing_zone, filetype)
 
-        batch_dir_list = [f for f in os.listdir(source_file_dir) if re.match(regex, f) and f.startswith(filetype)]
-        current_batch_size = len(batch_dir_list)
+        current_batch_size = dir_index.count(source_file_dir, filetype)
         if current_batch_size >= max_batch_size:
             info_logger.warn('%s %s zipfile(s) present - no files added ' % (max_batch_size, filetype))
         elif ftp_landing_zone_dir_list:
             ftp_landing_zone_file_counter = 0
             for filename in ftp_landing_zone_dir_list:
-                shutil.move(os.path.join(ftp_landing_zone, filename), os.path.join(source_file_dir, filename))
+                dir_index.move(filename, ftp_landing_zone, source_file_dir)
                 info_logger.info('Moved %s' % filename)
                 ftp_landing_zone_file_counter += 1
                 if ftp_landing_zone_file_counter + current_batch_size >= max_batch_size:
@@ -135,24 +209,41 @@ def prepare_batch_files(output_file_dir, max_output_batch_size, ftp_landing_zone
         else:
             info_logger.info('No %s files' % (filetype))
 
-    return len([f for f in os.listdir(source_file_dir) if re.match(regex, f)])
+    return dir_index.matched_count(source_file_dir)
 
 
-def copy_files_for_aws(source_dir_list, source_folder, target_folder):
+def schedule_batch_files(dir_index, scheduler, ftp_landing_zone, source_file_dir, filetypes):
     """
-    Copy files in source list from source to target
-    :param source_dir_list:
-    :param source_folder:
-    :param target_folder:
-    :returns: None
+    Moves the zipfiles admitted by the scheduler (from the downstream queue depths and the recent stage throughput - see
+    DQ_IL2_Scheduler.py) from the landing zone to the batch folder
+    :param dir_index: DirectoryIndex
+    :param scheduler: AdmissionScheduler
+    :param ftp_landing_zone:
+    :param source_file_dir:
+    :param filetypes:
+    :returns: int (the number of zipfiles in the batch)
     """
-    file_count = 0
-    temporary_folder = os.path.join(target_folder,'tmp')
-    for fname in source_dir_list:
-        shutil.copy(os.path.join(source_folder, fname), os.path.join(temporary_folder, fname))
-        shutil.move(os.path.join(temporary_folder, fname), os.path.join(target_folder, fname))
-        file_count += 1
-    info_logger.info(str(file_count) + ' file(s) copied to ' + target_folder)
+    depths = scheduler.queue_depths()
+    info_logger.info('Queue depths: %s' % (', '.join(['%s %s' % (queue, depths[queue]) for queue in sorted(depths)])))
+
+    candidates = {}
+    batch = {}
+    for filetype in filetypes:
+        candidates[filetype] = []
+        for filename in dir_index.files(ftp_landing_zone, filetype):
+            file_stat = os.stat(os.path.join(ftp_landing_zone, filename))
+            candidates[filetype].append((filename, file_stat.st_size, file_stat.st_mtime))
+        batch[filetype] = [(filename, os.path.getsize(os.path.join(source_file_dir, filename))) for filename in dir_index.files(source_file_dir, filetype)]
+
+    plan = scheduler.plan(candidates, batch, depths, scheduler.recent_runs())
+    info_logger.info(plan.summary())
+
+    for filetype in filetypes:
+        for filename in plan.admitted[filetype]:
+            dir_index.move(filename, ftp_landing_zone, source_file_dir)
+            info_logger.info('Moved %s' % filename)
+
+    return dir_index.matched_count(source_file_dir)
 
 
 def move_files(source_dir_list, source_folder, target_folder):
@@ -161,13 +252,14 @@ def move_files(source_dir_list, source_folder, target_folder):
     :param source_dir_list:
     :param source_folder:
     :param target_folder:
-    :returns: None
+    :returns: int (the number of files moved)
     """
     file_count = 0
     for fname in source_dir_list:
         shutil.move(os.path.join(source_folder, fname), os.path.join(target_folder, fname))
         file_count += 1
     info_logger.info(str(file_count) + ' file(s) moved')
+    return file_count
 
 
 def remove_temp_folders(source_folder, regex):
@@ -208,7 +300,7 @@ def mp_unzip_files(multiprocessing_pool_vars):
     """ Unzip a file from a zipfile to a given folder
     multiprocessing_pool_vars (iterable): [zipfilename, target_dir]
     :param in_val_to_pad:
-    :returns: string
+    :returns: list ([True, zipfile name, no. of xmls extracted] or [False, error msg])
     """
     zipfilename = multiprocessing_pool_vars[0]
     target_dir = multiprocessing_pool_vars[1]
@@ -219,274 +311,716 @@ def mp_unzip_files(multiprocessing_pool_vars):
     try:
         with zipfile.ZipFile(zipfilename) as zf:
             zf.extractall(dirname)
+            xml_count = len([name for name in zf.namelist() if name.lower().endswith('.xml')])
             zf.close()
     except Exception, e:
         return [False, os.path.basename(zipfilename) + ': ' + str(e)]
-    return [True, os.path.basename(zipfilename)]
+    return [True, os.path.basename(zipfilename), xml_count]
+
+
+def init_parse_worker(root_dir, parsed_ns, flight_router, output_dirs, ga_file_dir, shard_hash_prefix_length=0, dedup_index=None):
+    """ Pool initializer - stores the classification tables and settings once per worker process, so that parse tasks
+    only carry a filename
+    :param root_dir:
+    :param parsed_ns:
+    :param flight_router:
+    :param output_dirs:
+    :param ga_file_dir:
+    :param shard_hash_prefix_length: 0 (flat output folders) or the hash prefix length of the sharded layout (see DQ_IL2_Sharded_Dir)
+    :param dedup_index: the dedup index filename (see DQ_IL2_Dedup.py), or None
+    :returns: None
+    """
+    parse_worker_config['root_dir'] = root_dir
+    parse_worker_config['parsed_ns'] = parsed_ns
+    parse_worker_config['flight_router'] = flight_router
+    parse_worker_config['output_dirs'] = output_dirs
+    parse_worker_config['ga_file_dir'] = ga_file_dir
+    parse_worker_config['shard_hash_prefix_length'] = shard_hash_prefix_length
+    parse_worker_config['dedup_index'] = dedup_index
+    parse_worker_config['dedup'] = None
+
+    # Ctrl-C is handled by the parent (see run_watch_mode), which drains the pool. Workers forked after the parent has set
+    # its own SIGTERM handler are reset to the default, so that pool.terminate() still stops them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def worker_dedup_index():
+    """ Returns the worker's connection to the dedup index, opened with the first task (i.e. in the worker process)
+    :returns: DedupIndex or None (if DEDUP_INDEX is not set)
+    """
+    if parse_worker_config.get('dedup_index') and parse_worker_config['dedup'] is None:
+        parse_worker_config['dedup'] = DedupIndex(parse_worker_config['dedup_index'])
+    return parse_worker_config.get('dedup')
 
 
-def mp_parse_xml(multiprocessing_pool_vars):
+def mp_parse_xml(filename):
     """ Parses XML, finds GA rows (either from flight_id or matched MDS GA carriers), writes to output files
-    multiprocessing_pool_vars (iterable) [filename, root_dir, parsed_flight_id_xml_path, iata_executive_carriers, icao_executive_carriers]
-    :param multiprocessing_pool_vars:
-    :returns: list
+    The classification tables and settings are taken from parse_worker_config (see init_parse_worker)
+    :param filename:
+    :returns: list - with a dedup index, the message to record in it, (sha1, filename, source zip), is appended to the
+              result of a message written to the output folders (or a PNR), and recorded by the parent (see ParseResultCounts)
     """
-    filename = multiprocessing_pool_vars[0]
-    root_dir = multiprocessing_pool_vars[1]
-    parsed_flight_id_xml_path = multiprocessing_pool_vars[3] + multiprocessing_pool_vars[2]
-    parsed_api_xml_path = multiprocessing_pool_vars[3]
-    iata_executive_carriers = multiprocessing_pool_vars[4]
-    icao_executive_carriers = multiprocessing_pool_vars[5]
+    root_dir = parse_worker_config['root_dir']
+    parsed_ns = parse_worker_config['parsed_ns']
+    flight_router = parse_worker_config['flight_router']
+    output_dirs = parse_worker_config['output_dirs']
+    shard_hash_prefix_length = parse_worker_config['shard_hash_prefix_length']
 
-    output_file_dir = os.path.join(root_dir, 'out/')
-    ga_inprocess_dir = os.path.join(root_dir, 'ga_inprocess/')
     reject_file_dir = os.path.join(root_dir, 'reject/')
+    target_file_dir = os.path.join(root_dir, 'tmp/')
 
     filename_basename = os.path.basename(filename)
-
-    is_ga_record = False
+    # The xmls of each zipfile are extracted to tmp/<zipfile name without .zip>/
+    source_zip = os.path.relpath(filename, target_file_dir).split(os.sep)[0] + '.zip'
+
+    # A message already received is removed without being parsed
+    dedup = worker_dedup_index()
+    sha1 = None
+    if dedup is not None:
+        with open(filename, 'rb') as f:
+            sha1 = content_sha1(f.read())
+        original_filename = dedup.message_seen(sha1)
+        if original_filename is not None:
+            size = os.path.getsize(filename)
+            os.remove(filename)
+            return [True, filename_basename, 'DUPLICATE', original_filename, size]
 
     try:
-        tree = ET.parse(filename)
+        is_api, flight_ids = classify_xml_file(filename, parsed_ns)
     except Exception, e:
         shutil.move(filename, os.path.join(reject_file_dir, filename_basename))
         return [False, filename_basename + ': ' + str(e), None]
 
-    if len(tree.findall(parsed_api_xml_path)):
+    if not is_api:
+        os.remove(filename)
+        result = [True, filename_basename, 'PNR']
+    else:
+        flight_class = flight_router.classify_message(flight_ids)
+        size = os.path.getsize(filename)
+        output_filename = os.path.join(output_dir(output_dirs[flight_class], filename_basename, shard_hash_prefix_length), filename_basename)
+        shutil.move(filename, output_filename)
+        result = [True, filename_basename, 'API', flight_class] + fanout_ga_message(output_filename, flight_class, size, flight_ids, source_zip)
+
+    if sha1 is not None:
+        result.append((sha1, filename_basename, source_zip))
+    return result
+
+
+def fanout_ga_message(output_filename, flight_class, size, flight_ids, source_zip):
+    """ Hardlinks (or copies, across volumes) a GA message directly into the GA folder, and returns the end of its parse
+    result: the fan-out method and the details recorded in the parse index (see DQ_IL2_Parse_Index.py)
+    The settings are taken from parse_worker_config (see init_parse_worker)
+    :param output_filename: the file written to the output folder of its class
+    :param flight_class:
+    :param size:
+    :param flight_ids:
+    :param source_zip:
+    :returns: list [fanout, (filename, GA filename, size, flightIds, source zip)] - the filenames are relative to the
+              output/GA folders, the GA filename and fanout are None unless flight_class is GA
+    """
+    filename_basename = os.path.basename(output_filename)
+    output_dirs = parse_worker_config['output_dirs']
+    ga_file_dir = parse_worker_config['ga_file_dir']
+    shard_hash_prefix_length = parse_worker_config['shard_hash_prefix_length']
+
+    fanout = None
+    ga_relative_filename = None
+    if flight_class == GA:
+        ga_filename = os.path.join(output_dir(ga_file_dir, filename_basename, shard_hash_prefix_length), filename_basename)
+        fanout = link_or_copy(output_filename, ga_filename)
+        ga_relative_filename = os.path.relpath(ga_filename, ga_file_dir)
+    return [fanout, (os.path.relpath(output_filename, output_dirs[flight_class]), ga_relative_filename, size, ','.join(flight_ids),
+                     source_zip)]
+
+
+def mp_stream_parse_zip(zipfilename):
+    """ Reads each xml member of a zipfile in memory, finds GA rows (either from flight_id or matched MDS GA carriers) and
+    writes the member once, directly to the output folder (and the GA folder when needed) - nothing is extracted to tmp/
+    The classification tables and settings are taken from parse_worker_config (see init_parse_worker)
+    :param zipfilename:
+    :returns: list of lists in the same format as mp_parse_xml, i.e. [[success, details, msg_type, flight_class, fanout, index details], ...]
+    """
+    root_dir = parse_worker_config['root_dir']
+    parsed_ns = parse_worker_config['parsed_ns']
+    flight_router = parse_worker_config['flight_router']
+    output_dirs = parse_worker_config['output_dirs']
+    shard_hash_prefix_length = parse_worker_config['shard_hash_prefix_length']
 
-        p = tree.findall(parsed_flight_id_xml_path)
+    reject_file_dir = os.path.join(root_dir, 'reject/')
 
-        for flightId in p:
+    results = []
+    # The messages already received (see DQ_IL2_Dedup.py) are skipped - the others are recorded once the zipfile is done (the
+    # rejected messages are not recorded)
+    dedup = worker_dedup_index()
+    new_messages = {}
 
-            if flightId.text is not None:
-                flight_id = flightId.text.strip()
-                if re.search('^_GA.*$', flight_id) or is_executive_flight(flight_id, iata_executive_carriers, 2) or is_executive_flight(flight_id, icao_executive_carriers, 3):
-                    is_ga_record = True
-                    break
+    try:
+        zf = zipfile.ZipFile(zipfilename)
+    except Exception, e:
+        return [[False, os.path.basename(zipfilename) + ': ' + str(e), None]]
 
-        if is_ga_record:
-            shutil.copy(filename, os.path.join(ga_inprocess_dir, filename_basename))
+    try:
+        for member in zf.infolist():
+            filename_basename = os.path.basename(member.filename)
+            if not filename_basename.lower().endswith('.xml'):
+                continue
 
-    else:
+            try:
+                data = zf.read(member)
+            except Exception, e:
+                results.append([False, os.path.basename(zipfilename) + '/' + member.filename + ': ' + str(e), None])
+                continue
+
+            sha1 = None
+            if dedup is not None:
+                sha1 = content_sha1(data)
+                original_filename = new_messages.get(sha1, (None, None))[0] or dedup.message_seen(sha1)
+                if original_filename is not None:
+                    results.append([True, filename_basename, 'DUPLICATE', original_filename, len(data)])
+                    continue
+
+            try:
+                is_api, flight_ids = classify_xml_string(data, parsed_ns)
+            except Exception, e:
+                write_file_atomically(os.path.join(reject_file_dir, filename_basename), data)
+                results.append([False, filename_basename + ': ' + str(e), None])
+                continue
+
+            if is_api:
+                flight_class = flight_router.classify_message(flight_ids)
+                output_filename = os.path.join(output_dir(output_dirs[flight_class], filename_basename, shard_hash_prefix_length), filename_basename)
+                write_file_atomically(output_filename, data)
+                results.append([True, filename_basename, 'API', flight_class] + fanout_ga_message(output_filename, flight_class, len(data), flight_ids,
+                                                                                                  os.path.basename(zipfilename)))
+            else:
+                results.append([True, filename_basename, 'PNR'])
+            # Only a message written to the output folders (or a PNR) is recorded - a rejected message is not
+            if sha1 is not None:
+                new_messages[sha1] = (filename_basename, os.path.basename(zipfilename))
+    finally:
+        zf.close()
+
+    if dedup is not None:
+        dedup.record_messages([(sha1, filename, source_zip) for sha1, (filename, source_zip) in new_messages.items()])
+    return results
+
+
+def write_file_atomically(filename, data):
+    """ Writes data to a temporary ".part" file alongside the target, then renames it into place, so that downstream
+    processes listing *.xml never pick up a partially written file
+    :param filename:
+    :param data:
+    :returns: None
+    """
+    part_filename = filename + '.part'
+    with open(part_filename, 'wb') as f:
+        f.write(data)
+    if os.path.exists(filename):
         os.remove(filename)
-        return [True, filename_basename, 'PNR']
+    os.rename(part_filename, filename)
 
-    shutil.move(filename, os.path.join(output_file_dir, filename_basename))
-    return [True, filename_basename, 'API']
 
+def process_mp_unzip_files(executor, source_dir_list, source_file_dir, target_file_dir, regex, journal=None, zip_sizes=None):
+    """ Extracts the PARSED zipfiles to the tmp folder, largest first
+    :param executor: AutotuningExecutor
+    :param source_dir_list:
+    :param source_file_dir:
+    :param target_file_dir:
+    :param regex:
+    :param journal: CheckpointJournal or None
+    :param zip_sizes: dict of zipfile to size (see largest_first)
+    :returns: tuple (no. of zipfiles processed, no. of xmls extracted)
+    """
+    if journal is not None:
+        source_dir_list = skip_completed(journal, source_dir_list, 'unzip', regex)
+    parsed_zipfile_list = [os.path.join(source_file_dir, f) for f in largest_first(source_dir_list, zip_sizes) if re.match(regex, f)]
 
-def mp_move_files(multiprocessing_pool_vars):
-    """ Moves the file as given with multiprocessing_pool_vars (iterable)
-    multiprocessing_pool_vars: [filename, from_dir, to_dir]
-    :param multiprocessing_pool_vars:
+    if parsed_zipfile_list:
+        info_logger.info('Unzipping/copying: Starting (No. of processes: %s)' % (executor.window))
+
+        # Each task is a whole zipfile, so they are handed out one at a time and the results are counted as they complete
+        results = executor.imap_unordered(mp_unzip_files, itertools.izip(parsed_zipfile_list, itertools.repeat(target_file_dir)))
+        if journal is not None:
+            results = journal_unzip_results(results, journal)
+        totals = {'xmls': 0}
+        zip_count = check_multiprocessing_errors(sum_unzipped_xmls(results, totals))
+
+        info_logger.info('Unzipping/copying: done (%s file(s) processed, %s xml(s) extracted)' % (zip_count, totals['xmls']))
+        return zip_count, totals['xmls']
+    info_logger.info('No source files')
+    return 0, 0
+
+
+def largest_first(fnames, sizes=None):
+    """ Returns the zipfiles largest first, so that the batch does not end with one worker busy with a large zipfile while
+    the others are idle. The sizes are those found when the batch was listed - zipfiles without a size go last
+    :param fnames:
+    :param sizes: dict of zipfile to size, or None to keep the order
     :returns: list
     """
-    filename = multiprocessing_pool_vars[0]
-    from_dir = multiprocessing_pool_vars[1]
-    to_dir = multiprocessing_pool_vars[2]
+    if not sizes:
+        return list(fnames)
+    return sorted(fnames, key=lambda fname: sizes.get(fname, -1), reverse=True)
 
-    from_filename = os.path.join(from_dir, filename)
-    to_filename = os.path.join(to_dir, filename)
 
-    if os.path.exists(to_filename):
-        os.remove(to_filename)
-    try:
-        os.rename(from_filename, to_filename)
-    except Exception, e:
-        return [False, os.path.basename(from_filename) + ': ' + str(e)]
-    return [True, os.path.basename(from_filename)]
+def sum_unzipped_xmls(results, totals):
+    """ Adds up the no. of xmls extracted from each zipfile (see mp_unzip_files) in totals['xmls'], passing the results through
+    :param results: iterator of mp_unzip_files results
+    :param totals: dict
+    :returns: generator
+    """
+    for result in results:
+        if result[0]:
+            totals['xmls'] += result[2]
+        yield result
 
 
-def process_mp_unzip_files(pool, source_dir_list, source_file_dir, target_file_dir, regex, no_of_processes=4):
-    parsed_zipfile_list = [os.path.join(source_file_dir, f) for f in source_dir_list if re.match(regex, f)]
+def journal_unzip_results(results, journal):
+    """ Records each zipfile extracted successfully in the checkpoint journal, passing the results through
+    :param results: iterator of mp_unzip_files results
+    :param journal: CheckpointJournal
+    :returns: generator
+    """
+    for result in results:
+        if result[0]:
+            journal.record(result[1], 'unzip')
+        yield result
 
-    zip_count = len(parsed_zipfile_list)
 
-    if parsed_zipfile_list:
-        info_logger.info('Unzipping/copying: Starting (No. of processes: %s)' % (no_of_processes))
+def skip_completed(journal, source_dir_list, stage, regex=None):
+    """ Returns the zipfiles for which a stage has not been completed (see DQ_IL2_Checkpoint.py), logging how many are skipped
+    :param journal: CheckpointJournal
+    :param source_dir_list:
+    :param stage:
+    :param regex: only count zipfiles matching regex as skipped
+    :returns: list
+    """
+    pending = journal.pending(source_dir_list, stage)
+    skipped = [fname for fname in source_dir_list if journal.is_done(fname, stage) and (regex is None or re.match(regex, fname))]
+    if skipped:
+        info_logger.info('Checkpoint: %s stage already completed for %s zipfile(s) - skipped' % (stage, len(skipped)))
+    return pending
+
 
-        results = pool.map(mp_unzip_files, itertools.izip(parsed_zipfile_list,  itertools.repeat(target_file_dir)))
+def iter_xml_files(target_file_dir):
+    """ Yields the xml files extracted to the tmp folder, one folder at a time (the full list is never built)
+    :param target_file_dir:
+    :returns: generator
+    """
+    for root, dirnames, filenames in os.walk(target_file_dir):
+        for filename in filenames:
+            if filename.lower().endswith('.xml'):
+                yield os.path.join(root, filename)
+
+
+def process_mp_parse_xml(executor, target_file_dir, worker_initargs, chunksize=100, log_freq=1000, parse_index=None, metrics=None,
+                         xml_count=None, dedup_index=None):
+    """ Parses the xml files extracted to the tmp folder. The files are streamed to the pool in chunks and the results are
+    counted as they complete, so the memory used by the parent does not grow with the size of the batch
+    :param executor: AutotuningExecutor
+    :param target_file_dir:
+    :param worker_initargs:
+    :param chunksize: the no. of xml files sent to a worker at a time - smaller chunks are sent towards the end of the
+                      batch if xml_count is given (see DQ_IL2_Autotune.py)
+    :param log_freq: progress is logged every log_freq xml files
+    :param parse_index: BatchParseIndex or None
+    :param metrics: RunMetrics or None
+    :param xml_count: the no. of xml files in the tmp folder, if known
+    :param dedup_index: the dedup index filename (see DQ_IL2_Dedup.py) the messages parsed are recorded in, or None
+    :returns: int (the number of xml files parsed)
+    """
+    xml_files = iter_xml_files(target_file_dir)
+    ipc_sample = list(itertools.islice(xml_files, chunksize))
 
-        info_logger.info('Unzipping/copying: done (%s file(s) processed)' % (zip_count))
+    if ipc_sample:
 
-        check_multiprocessing_errors(results)
-    else:
-        info_logger.info('No source files')
+        info_logger.info('Parsing: Starting (No. of processes: %s, chunksize: %s)' % (executor.window, chunksize))
+        log_task_ipc_bytes('Parsing', ipc_sample, worker_initargs)
+        results = executor.imap_unordered(mp_parse_xml, itertools.chain(ipc_sample, xml_files), chunksize, total=xml_count)
+        dedup = DedupIndex(dedup_index) if dedup_index else None
+        try:
+            xml_count = check_multiprocessing_parse_xml_errors(results, 'Parsing', log_freq, parse_index, metrics, dedup)
+        finally:
+            if dedup is not None:
+                dedup.close()
+
+        info_logger.info('Parsing XML: Done (%s file(s) processed)' % (xml_count))
+        return xml_count
+    info_logger.info('No source files')
+    return 0
+
+
+def process_mp_stream_parse_zips(executor, source_dir_list, source_file_dir, regex, worker_initargs, log_freq=1000, journal=None, parse_index=None,
+                                 metrics=None, zip_sizes=None):
+    """ Parses the PARSED zipfiles in memory, largest first - each zipfile is a single task, whose xmls are classified and
+    written straight to the output (and GA) folders (see mp_stream_parse_zip), so nothing is extracted to the tmp folder
+    :param executor: AutotuningExecutor
+    :param source_dir_list:
+    :param source_file_dir:
+    :param regex:
+    :param worker_initargs:
+    :param log_freq: progress is logged every log_freq xml files
+    :param journal: CheckpointJournal or None
+    :param parse_index: BatchParseIndex or None
+    :param metrics: RunMetrics or None
+    :param zip_sizes: dict of zipfile to size (see largest_first)
+    :returns: int (the number of xml files parsed)
+    """
+    if journal is not None:
+        source_dir_list = skip_completed(journal, source_dir_list, 'parse', regex)
+    parsed_zipfile_list = [os.path.join(source_file_dir, f) for f in largest_first(source_dir_list, zip_sizes) if re.match(regex, f)]
 
+    if parsed_zipfile_list:
 
-def process_mp_parse_xml(pool, target_file_dir, root_dir, parsed_ns, iata_executive_carriers, icao_executive_carriers, ga_inprocess_dir, ga_file_dir, no_of_processes=4):
-    xml_list = [os.path.join(root, filename)
-                for root, dirnames, filenames in os.walk(target_file_dir)
-                for filename in filenames if filename.lower().endswith('.xml')]
+        info_logger.info('Stream parsing: Starting (No. of processes: %s)' % (executor.window))
+        log_task_ipc_bytes('Stream parsing', parsed_zipfile_list, worker_initargs)
+        # Each task is a whole zipfile - its results are counted (and released) as soon as it completes
+        results = executor.imap_unordered(mp_stream_parse_zip_task, parsed_zipfile_list)
+        xml_count = check_multiprocessing_parse_xml_errors(iter_zip_results(results, journal), 'Stream parsing', log_freq, parse_index, metrics)
 
-    if xml_list:
+        info_logger.info('Stream parsing: Done (%s zipfile(s) processed)' % (len(parsed_zipfile_list)))
+        return xml_count
+    info_logger.info('No source files')
+    return 0
 
-        info_logger.info('Parsing: Starting (No. of processes: %s)' % (no_of_processes))
-        results = pool.map(mp_parse_xml, itertools.izip(xml_list,
-                                                        itertools.repeat(root_dir),
-                                                        itertools.repeat("/{%s}flightDetails/{%s}flightId" % (parsed_ns, parsed_ns)),
-                                                        itertools.repeat("{%s}APIData" % (parsed_ns)),
-                                                        itertools.repeat(iata_executive_carriers),
-                                                        itertools.repeat(icao_executive_carriers)))
 
-        info_logger.info('Parsing XML: Done (%s file(s) processed)' % (len(xml_list)))
-        check_multiprocessing_parse_xml_errors(results)
+def mp_stream_parse_zip_task(zipfilename):
+    """ Pipeline task - stream parses a zipfile (see mp_stream_parse_zip) and returns the zipfile name with the results, so
+    that the parent knows which zipfile can be archived
+    :param zipfilename:
+    :returns: tuple (zipfilename, list of results)
+    """
+    return zipfilename, mp_stream_parse_zip(zipfilename)
+
+
+def reject_timed_out_task(reject_file_dir, func, item, reason):
+    """ Timeout handler of the supervised pool (see DQ_IL2_Supervisor.py) - an xml which timed out (or whose worker crashed)
+    is moved to the reject folder, and a zipfile is copied there (the zipfile itself is archived as usual). The reason
+    (e.g. the timeout, or the worker's exit) is written alongside, to <filename>.reason. Returns the error result of the
+    task, in the format of func
+    :param reject_file_dir:
+    :param func: the task function
+    :param item: the task argument
+    :param reason:
+    :returns: list (or tuple, for mp_stream_parse_zip_task)
+    """
+    filename = item[0] if func is mp_unzip_files else item
+    try:
+        if func is mp_parse_xml:
+            shutil.move(filename, os.path.join(reject_file_dir, os.path.basename(filename)))
+        else:
+            shutil.copy2(filename, os.path.join(reject_file_dir, os.path.basename(filename)))
+    except (IOError, OSError), e:
+        info_logger.warn('Error moving %s to %s: %s' % (filename, reject_file_dir, e))
+    try:
+        write_file_atomically(os.path.join(reject_file_dir, os.path.basename(filename) + '.reason'),
+                              '%s %s\n' % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), reason))
+    except (IOError, OSError), e:
+        info_logger.warn('Error writing the reject reason of %s: %s' % (filename, e))
+    result = [False, '%s: %s' % (os.path.basename(filename), reason), None]
+    if func is mp_stream_parse_zip_task:
+        return filename, [result]
+    return result
+
+
+def iter_zip_results(zip_results, journal=None):
+    """ Yields the results of each zipfile (see mp_stream_parse_zip_task), recording the zipfile as parsed in the checkpoint
+    journal once all of its results have been consumed
+    :param zip_results: iterator of (zipfilename, list of results)
+    :param journal: CheckpointJournal or None
+    :returns: generator
+    """
+    for zipfilename, results in zip_results:
+        for result in results:
+            yield result
+        if journal is not None:
+            journal.record(os.path.basename(zipfilename), 'parse')
+
+
+def stage_aws_batch(aws_stager, source_dir_list, source_file_dir, journal, on_staged=None):
+    """ Starts staging a batch for the AWS data feed (see DQ_IL2_AWS_Staging.py), recording each zipfile in the checkpoint
+    journal once it is in the AWS folder and again once it is listed in a manifest. Zipfiles already staged by an
+    interrupted run are not staged again - those not yet listed in a manifest are listed in this batch's manifest
+    :param aws_stager: AWSStager
+    :param source_dir_list:
+    :param source_file_dir:
+    :param journal: CheckpointJournal
+    :param on_staged: see AWSStager.stage_batch
+    :returns: AWSStagingBatch
+    """
+    staged_entries = []
+    for fname in source_dir_list:
+        if journal.is_done(fname, 'aws') and not journal.is_done(fname, 'manifest'):
+            detail = journal.detail(fname, 'aws')
+            staged_entries.append((fname, detail['size'], detail['sha1']))
 
-        ga_inprocess_dir_list = [f for f in os.listdir(ga_inprocess_dir) if f.lower().endswith('.xml')]
+    def on_entry(entry):
+        journal.record(entry[0], 'aws', size=entry[1], sha1=entry[2])
 
-        if ga_inprocess_dir_list:
+    def on_manifest(manifest_filename, entries):
+        journal.record_many([entry[0] for entry in entries], 'manifest', manifest=os.path.basename(manifest_filename))
 
-            info_logger.info('Moving GA files')
-            results = pool.map(mp_move_files, itertools.izip(ga_inprocess_dir_list, itertools.repeat(ga_inprocess_dir), itertools.repeat(ga_file_dir)))
+    return aws_stager.stage_batch(skip_completed(journal, source_dir_list, 'aws'), source_file_dir, on_staged=on_staged,
+                                  on_entry=on_entry, on_manifest=on_manifest, staged_entries=staged_entries)
 
-            info_logger.info('Done (%s GA file(s) processed)' % (len(ga_inprocess_dir_list)))
 
-            check_multiprocessing_errors(results)
+def process_pipelined_batch(executor, source_dir_list, source_file_dir, archive_dirs, worker_initargs, journal, aws_stager=None, log_freq=1000,
+                            parse_index=None, metrics=None, zip_sizes=None):
+    """ Runs the parse, AWS staging and archive stages of a batch concurrently:
+    - one stream parse task per PARSED zipfile is submitted to the pool and the results are consumed as they complete
+    - the AWS stager stages the zipfiles for the AWS data feed (PARSED zipfiles first)
+    - a thread archives each zipfile as soon as it has been parsed (PARSED zipfiles only) and staged (if aws_stager is set)
+    A zipfile which could not be staged is left in the batch folder. Stages already completed for a zipfile (recorded in the
+    checkpoint journal by an interrupted run) are skipped
+    :param executor: AutotuningExecutor
+    :param source_dir_list:
+    :param source_file_dir:
+    :param archive_dirs: dict of filetype to the folder the zipfiles are moved to
+    :param worker_initargs:
+    :param journal: CheckpointJournal
+    :param aws_stager: the AWSStager, or None if the data feed is disabled
+    :param log_freq: progress is logged every log_freq xml files
+    :param parse_index: BatchParseIndex or None
+    :param metrics: RunMetrics or None
+    :param zip_sizes: dict of zipfile to size - the PARSED zipfiles are parsed largest first
+    :returns: AWSStagingBatch (or None if the data feed is disabled)
+    """
+    events = Queue.Queue()
+    pending = {}
+    for fname in source_dir_list:
+        pending[fname] = set()
+        if aws_stager is not None and not journal.is_done(fname, 'aws'):
+            pending[fname].add('aws')
+        if fname.startswith('PARSED') and not journal.is_done(fname, 'parse'):
+            pending[fname].add('parsed')
+    archived = []
+
+    def on_staged(fname, success):
+        if success:
+            events.put((fname, 'aws'))
+
+    def archive_zipfile(fname):
+        try:
+            shutil.move(os.path.join(source_file_dir, fname), os.path.join(archive_dirs[fname[:fname.index('_')]], fname))
+            archived.append(fname)
+        except Exception:
+            info_logger.exception('Error archiving %s' % (fname))
+
+    def archive():
+        for fname in [fname for fname in source_dir_list if not pending[fname]]:
+            archive_zipfile(fname)
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            fname, stage = event
+            pending[fname].discard(stage)
+            if not pending[fname]:
+                archive_zipfile(fname)
+
+    archive_thread = threading.Thread(target=archive, name='archive')
+    archive_thread.start()
+
+    aws_batch = None
+    if aws_stager is not None:
+        aws_batch = stage_aws_batch(aws_stager, sorted(source_dir_list, key=lambda fname: not fname.startswith('PARSED')), source_file_dir, journal, on_staged=on_staged)
+
+    parsed_zipfile_list = [os.path.join(source_file_dir, fname) for fname in largest_first(skip_completed(journal, source_dir_list, 'parse', '^PARSED'), zip_sizes)
+                           if fname.startswith('PARSED')]
+    result_counts = ParseResultCounts('Pipelined parsing', log_freq, parse_index, metrics)
+    try:
+        if parsed_zipfile_list:
+            info_logger.info('Pipelined parsing: Starting (No. of processes: %s)' % (executor.window))
+            log_task_ipc_bytes('Pipelined parsing', parsed_zipfile_list, worker_initargs)
+            for zipfilename, zip_results in executor.imap_unordered(mp_stream_parse_zip_task, parsed_zipfile_list):
+                for result in zip_results:
+                    result_counts.add(result)
+                journal.record(os.path.basename(zipfilename), 'parse')
+                events.put((os.path.basename(zipfilename), 'parsed'))
+                info_logger.debug('Parsed %s (%s file(s))' % (os.path.basename(zipfilename), len(zip_results)))
+            info_logger.info('Pipelined parsing: Done (%s zipfile(s) processed)' % (len(parsed_zipfile_list)))
         else:
             info_logger.info('No source files')
-    else:
-        info_logger.info('No source files')
+    finally:
+        if aws_batch is not None:
+            aws_batch.wait_staged()
+        events.put(None)
+        archive_thread.join()
+
+    if parsed_zipfile_list:
+        result_counts.log_summary()
+
+    info_logger.info('%s zipfile(s) archived' % (len(archived)))
+    if len(archived) < len(source_dir_list):
+        info_logger.warn('%s zipfile(s) not archived - left in %s' % (len(source_dir_list) - len(archived), source_file_dir))
+    return aws_batch
+
+
+def log_task_ipc_bytes(stage, tasks, worker_initargs, sample_size=IPC_SAMPLE_TASKS):
+    """ Logs (at DEBUG level only) the average number of bytes pickled per task, and what it would have been had the worker
+    initializer arguments (i.e. the classification tables) been sent with every task, as they were before init_parse_worker.
+    Only the first sample_size tasks are pickled, as one chunk (so pickle memoisation is counted as it is when a chunk is sent)
+    :param stage:
+    :param tasks: the tasks, or a sample of them
+    :param worker_initargs:
+    :param sample_size:
+    :returns: None
+    """
+    if not info_logger.isEnabledFor(logging.DEBUG):
+        return
+    sample = list(itertools.islice(tasks, sample_size))
+    if not sample:
+        return
+    task_ipc_bytes = len(cPickle.dumps(sample, cPickle.HIGHEST_PROTOCOL))
+    legacy_ipc_bytes = len(cPickle.dumps([(task, worker_initargs) for task in sample], cPickle.HIGHEST_PROTOCOL))
+    initargs_ipc_bytes = len(cPickle.dumps(worker_initargs, cPickle.HIGHEST_PROTOCOL))
+
+    info_logger.debug('%s IPC: %s task(s) sampled, %s byte(s)/task (was %s byte(s)/task with the classification tables in every task, %s byte(s) now sent once per worker)'
+                      % (stage, len(sample), task_ipc_bytes / len(sample), legacy_ipc_bytes / len(sample), initargs_ipc_bytes))
 
 
 def check_multiprocessing_errors(results_list):
-    """ Takes a list of list objects e.g. [[False, <error msg>],[True, <error msg>]] and outputs to log when an error has been encountered
+    """ Takes a list (or iterator) of list objects e.g. [[False, <error msg>],[True, <error msg>]] and outputs to log when an
+    error has been encountered
     :param results_list:
-    :returns: list
+    :returns: int (the number of results)
     """
     no_of_errors = 0
+    result_count = 0
     for result in results_list:
+        result_count += 1
         success = result[0]
         details = result[1]
         if not success:
             no_of_errors += 1
             info_logger.info('Multiprocessing error: %s' % (details))
     info_logger.info('Multiprocessing errors: %s' % (no_of_errors))
+    return result_count
 
 
-def check_multiprocessing_parse_xml_errors(results_list):
-    """ Takes a list of list objects e.g. [[False, <error msg>],[True, <error msg>]] and outputs to log when an error has been encountered
-    :param results_list:
-    :returns: list
+class ParseResultCounts(object):
+    """ Counts the parse results (see mp_parse_xml) as they arrive, logging each error and the progress every log_freq
+    results - only the counters are kept, not the results (API messages are added to the parse index, and the duplicate
+    messages skipped are counted in the run metrics, if given). With a dedup index, the messages of the results of
+    mp_parse_xml are recorded in it DEDUP_RECORD_BATCH at a time (see record_messages)
     """
-    no_of_errors = 0
-    api_count = 0
-    pnr_count = 0
-    for result in results_list:
+
+    def __init__(self, stage='Parsing', log_freq=0, parse_index=None, metrics=None, dedup=None):
+        self.stage = stage
+        self.log_freq = log_freq
+        self.parse_index = parse_index
+        self.metrics = metrics
+        self.dedup = dedup
+        self.dedup_entries = []
+        self.result_count = 0
+        self.no_of_errors = 0
+        self.api_count = 0
+        self.pnr_count = 0
+        self.duplicate_count = 0
+        self.duplicate_bytes = 0
+        self.flight_class_counts = dict([(flight_class, 0) for flight_class in FLIGHT_CLASSES])
+        self.fanout_counts = {'link': 0, 'copy': 0}
+
+    def add(self, result):
         success = result[0]
         details = result[1]
         msg_type = result[2]
+        self.result_count += 1
         if not success:
-            no_of_errors += 1
+            self.no_of_errors += 1
             info_logger.info('Multiprocessing error: %s' % (details))
         if msg_type == 'API':
-            api_count += 1
+            self.api_count += 1
+            self.flight_class_counts[result[3]] += 1
+            if result[4]:
+                self.fanout_counts[result[4]] += 1
+            if self.parse_index is not None:
+                self.parse_index.add_message(result[3], *result[5])
         elif msg_type == 'PNR':
-            pnr_count += 1
-
-    info_logger.info('Total multiprocessing errors: %s' % (no_of_errors))
-    info_logger.info('API count: %s' % (api_count))
-    info_logger.info('PNR count: %s' % (pnr_count))
+            self.pnr_count += 1
+        elif msg_type == 'DUPLICATE':
+            self.duplicate_count += 1
+            self.duplicate_bytes += result[4]
+            info_logger.debug('Duplicate message: %s (already received as %s)' % (details, result[3]))
+            if self.metrics is not None:
+                self.metrics.count('duplicate messages')
+                self.metrics.count('duplicate message bytes', result[4])
+
+        if self.dedup is not None and msg_type in ('API', 'PNR'):
+            self.dedup_entries.append(result[-1])
+            if len(self.dedup_entries) >= DEDUP_RECORD_BATCH:
+                self.record_messages()
+
+        if self.log_freq and self.result_count % self.log_freq == 0:
+            info_logger.info('%s: %s file(s) processed (%s API, %s PNR, %s error(s))' % (self.stage, self.result_count, self.api_count, self.pnr_count, self.no_of_errors))
+
+    def record_messages(self):
+        """ Records the messages added since the last call in the dedup index, in a single transaction
+        :returns: None
+        """
+        if self.dedup_entries and not self.dedup.record_messages(self.dedup_entries):
+            info_logger.warn('Error using the dedup index - %s message(s) not recorded' % (len(self.dedup_entries)))
+        self.dedup_entries = []
+
+    def log_summary(self):
+        info_logger.info('Total multiprocessing errors: %s' % (self.no_of_errors))
+        info_logger.info('API count: %s' % (self.api_count))
+        info_logger.info('PNR count: %s' % (self.pnr_count))
+        for flight_class in FLIGHT_CLASSES:
+            info_logger.info('%s count: %s' % (flight_class, self.flight_class_counts[flight_class]))
+        if self.fanout_counts['link'] or self.fanout_counts['copy']:
+            info_logger.info('GA fan-out: %s hardlink(s), %s copy(ies)' % (self.fanout_counts['link'], self.fanout_counts['copy']))
+        if self.duplicate_count:
+            info_logger.info('Duplicate messages skipped: %s (%s byte(s))' % (self.duplicate_count, self.duplicate_bytes))
+
+
+def check_multiprocessing_parse_xml_errors(results_list, stage='Parsing', log_freq=0, parse_index=None, metrics=None, dedup=None):
+    """ Takes a list (or iterator) of list objects e.g. [[False, <error msg>],[True, <error msg>]] and outputs to log when an
+    error has been encountered
+    :param results_list:
+    :param stage: the stage name used in the progress messages
+    :param log_freq: progress is logged every log_freq results (0 for no progress messages)
+    :param parse_index: BatchParseIndex or None
+    :param metrics: RunMetrics or None
+    :param dedup: DedupIndex the messages are recorded in (see mp_parse_xml), or None
+    :returns: int (the number of results, i.e. xml files)
+    """
+    result_counts = ParseResultCounts(stage, log_freq, parse_index, metrics, dedup)
+    try:
+        for result in results_list:
+            result_counts.add(result)
+    finally:
+        # The messages written before an error are still recorded
+        if dedup is not None:
+            result_counts.record_messages()
+    result_counts.log_summary()
+    return result_counts.result_count
 
 # GA functions
 
 
-def is_executive_flight(flight_id, executive_carriers, expected_length):
-    if (len(flight_id) > expected_length and re.match('[0-9]', flight_id[expected_length])):
-        return flight_id[:expected_length] in executive_carriers
-    return False
-
-
-def check_mds_file(mds_extract, mds_db_sql, mds_db_host, mds_db_database, mds_db_user, mds_db_password, mds_refresh_hrs=8):
-    if not os.path.exists(mds_extract):
-        info_logger.warn('MDS EXTRACT does not exist - creating file')
-        open(mds_extract, 'a').close()
-
-    mds_extract_empty = (os.stat(mds_extract).st_size == 0)
-    mds_extract_expired = (os.stat(mds_extract).st_mtime < time.time() - (int(mds_refresh_hrs) * 60 * 60))
-
-    if (mds_extract_expired or mds_extract_empty):
-        if mds_extract_empty:
-            info_logger.warn('MDS EXTRACT is empty')
-        if mds_extract_expired:
-            info_logger.info('MDS EXTRACT has expired')
-
-        mds_connect_error = 0
-        info_logger.debug('Windows Authentication as: %s' % (getpass.getuser()))
-        exception_msg = ''
-        info_logger.debug('server=%s database=%s' % (mds_db_host, mds_db_database))
-
-        try:
-            db = pyodbc.connect(driver='{SQL Server}', server=mds_db_host, database=mds_db_database, uid=mds_db_user, pwd=mds_db_password, autocommit='False')
-        except Exception, e:
-            mds_connect_error = 1
-            exception_msg = str(e)
-
-        if not mds_connect_error:
-            info_logger.info('Connected')
-
-            cur = db.cursor()
-            mds_sql_error = 0
-
-            info_logger.debug(mds_db_sql)
-
-            try:
-                cur.execute(mds_db_sql)
-            except Exception, e:
-                mds_sql_error = 1
-                exception_msg = str(e)
-
-            if not mds_sql_error:
-                rows = cur.fetchall()
-                mds_extract_file = open(mds_extract, 'wb')
-
-                for row in rows:
-                    try:
-                        mds_extract_file.write(str(row[0]) + ',' + str(row[1]) + '\r\n')
-                    except ValueError, err:
-                        info_logger.exception('Error: %s, check MDS view and SQL statement (in config file)' % (err))
-
-                mds_extract_file.close()
-            else:
-                info_logger.exception('Error: %s' % (exception_msg))
-        else:
-            info_logger.exception('Error: %s' % (exception_msg))
-    else:
-        info_logger.warn('Not updated - file was updated %s' % (str(datetime.datetime.strptime(time.ctime(os.stat(mds_extract).st_mtime), "%a %b %d %H:%M:%S %Y"))))
-
-
-def read_mds_extract(mds_extract):
+def create_mds_snapshot_store(cfg):
     """
-    Reads the MDS extract and returns two lists of iata/icao executive carriers
-    :param mds_extract:
-    :returns: list, list
+    Returns the MDS snapshot store (see DQ_IL2_MDS_Snapshot.py), refreshed from the MDS database every MDS_REFRESH_HRS
+    :param cfg:
+    :returns: MDSSnapshotStore
     """
-    try:
-        mds_extract_file = open(mds_extract, 'r')
-        mds_extract_file_lines = mds_extract_file.readlines()
-    except Exception, e:
-        info_logger.exception(str(e))
-        raise
-    counter = 0
-
-    iata_executive_carriers = []
-    icao_executive_carriers = []
+    info_logger.debug('server=%s database=%s' % (cfg['mds_db_host'], cfg['mds_db_database']))
+    source = pyodbc_source(cfg['mds_db_host'], cfg['mds_db_database'], cfg['mds_db_user'], cfg['mds_db_password'], cfg['mds_db_sql'])
+    return MDSSnapshotStore(cfg['mds_snapshot'], source, cfg['mds_refresh_hrs'] * 60 * 60, info_logger, mds_extract=cfg['mds_extract'])
 
-    for row in mds_extract_file_lines:
-        try:
-            airport_code_standard = row.split(',')[0].strip()
-            carrier_code = row.split(',')[1].strip()
-
-            if airport_code_standard == 'IATA':
-                iata_executive_carriers.append(carrier_code)
-            elif airport_code_standard == 'ICAO':
-                icao_executive_carriers.append(carrier_code)
 
-        except IndexError, err:
-            info_logger.warn('Error: %s, check MDS extract file' % (err))
-            raise
-        counter += 1
-    mds_extract_file.close()
-    return iata_executive_carriers, icao_executive_carriers
+def build_flight_router(snapshot):
+    """
+    Returns a FlightRouter holding all of the GA/COMMERCIAL iata/icao carriers of the MDS snapshot
+    :param snapshot:
+    :returns: FlightRouter
+    """
+    flight_router = snapshot.flight_router()
+    info_logger.info('MDS carriers: %s (version %s, loaded %s)' % (', '.join(['%s %s' % (count, flight_class) for flight_class, count in sorted(flight_router.counts().items())]),
+                                                                  snapshot.content_hash[:12], time.ctime(snapshot.loaded_at)))
+    return flight_router
 
 
 # Config functions
@@ -616,6 +1150,55 @@ def update_config_file(seq_info, seq_config, max_seqs_log_temp, max_seqs_log, ar
     info_logger.debug('Moving seq file %s to %s' % (max_seqs_log_temp, max_seqs_log))
 
 
+def check_sequence_ledger(source_dir_list, seq_ledger, max_seqs_log, max_seqs_log_temp, archive_file_dir, filetypes):
+    """
+    Records the sequences of the files in the source dir list in the sequence ledger (in a single transaction) and logs
+    any new gaps, late arrivals and duplicates. The first time a filetype is recorded, the ledger is seeded with the last
+    sequence from MAX_SEQS.ini (if it exists). MAX_SEQS.ini is then updated with the last sequence of each filetype in the
+    ledger, as check_sequences would have left it
+    :param source_dir_list:
+    :param seq_ledger: the ledger filename
+    :param max_seqs_log:
+    :param max_seqs_log_temp:
+    :param archive_file_dir:
+    :param filetypes:
+    :returns: dict (see SeqLedger.record_files)
+    """
+    ledger = SeqLedger(seq_ledger, MAX_FILE_SEQ)
+    try:
+        seq_config = check_sequence_config_file(max_seqs_log, filetypes)
+        for filetype in filetypes:
+            last_sequence = get_config_option(seq_config, filetype, 'last_sequence')
+            if ledger.is_empty(filetype) and last_sequence not in ['N/A', '', None]:
+                ledger.seed(filetype, get_config_option(seq_config, filetype, 'last_updated'), last_sequence)
+                info_logger.info('%s: Sequence ledger seeded from %s (last sequence: %s)' % (filetype, max_seqs_log, last_sequence))
+
+        results = ledger.record_files(source_dir_list)
+        last_sequences = ledger.last_sequences()
+    finally:
+        ledger.close()
+
+    seq_info = {}
+    for filetype, (filedate, last_sequence) in last_sequences.items():
+        if filetype in filetypes:
+            seq_info[filetype] = {'last_sequence': last_sequence, 'last_updated': datetime.datetime.strptime(filedate, '%Y%m%d')}
+    update_config_file(seq_info, seq_config, max_seqs_log_temp, max_seqs_log, archive_file_dir)
+
+    for filetype, filedate, first_seq, last_seq, filename in results['gaps']:
+        seq_logger.info('Invalid sequence: %s, missing %s %s %s' % (filename, filetype, filedate, format_range(first_seq, last_seq, MAX_FILE_SEQ)))
+        info_logger.warn('Missing %s %s %s (%s file(s))' % (filetype, filedate, format_range(first_seq, last_seq, MAX_FILE_SEQ), last_seq - first_seq + 1))
+    for filename in results['late']:
+        seq_logger.info('Late sequence: %s' % (filename))
+        info_logger.info('Late sequence: %s' % (filename))
+    for filename in results['duplicates']:
+        seq_logger.info('Duplicate sequence: %s' % (filename))
+        info_logger.warn('Duplicate sequence: %s' % (filename))
+
+    info_logger.info('Sequence ledger: %s file(s) recorded, %s gap(s), %s late, %s duplicate(s)'
+                     % (results['received'], len(results['gaps']), len(results['late']), len(results['duplicates'])))
+    return results
+
+
 # Date functions
 
 
@@ -634,109 +1217,574 @@ def get_time_delta_in_secs(start_time, end_time=None):
     return elapsed_time
 
 
-def main(argv):
-    seq_info = {'RAW': {'last_sequence': 'N/A', 'expected_sequence': 'N/A', 'last_updated': '19000101', 'regex': r'^RAW_[0-9]{8}_[0-9]{4}_[0-9]{4}.*\.zip$'},
-                'PARSED': {'last_sequence': 'N/A', 'expected_sequence': 'N/A', 'last_updated': '19000101', 'regex': r'^PARSED_[0-9]{8}_[0-9]{4}_[0-9]{4}.*\.zip$'},
-                'STORED': {'last_sequence': 'N/A', 'expected_sequence': 'N/A', 'last_updated': '19000101', 'regex': r'^STORED_[0-9]{8}_[0-9]{4}_[0-9]{4}.*\.zip$'},
-                'FAILED': {'last_sequence': 'N/A', 'expected_sequence': 'N/A', 'last_updated': '19000101', 'regex': r'^FAILED_[0-9]{8}_[0-9]{4}_[0-9]{4}.*\.zip$'}}
-
-    starttime = datetime.datetime.now()
-    debug = False
-    config_file = os.path.join(os.path.dirname(__file__), 'DQ_IL2_Config.ini')
-    default_section = 'DEFAULT'
-    custom_section = os.path.basename(__file__).replace('.py', '')
-    parsed_ns = 'http://www.ibm.com/semaphore/commonAPI/'
-    max_file_seq = 10000
-    iata_executive_carriers = []
-    icao_executive_carriers = []
-
+def read_config(config_file, default_section, custom_section):
+    """
+    Reads the config file and returns the settings used by this script
+    :param config_file:
+    :param default_section:
+    :param custom_section:
+    :returns: dict
+    """
     config = ConfigParser.ConfigParser()
     config.read(config_file)
 
-    root_dir = config.get(default_section, 'ROOT_DIR')
-    ftp_landing_zone = config.get(default_section, 'FTP_LANDING_ZONE')
-    source_file_dir = config.get(custom_section, 'SOURCE_FILE_DIR')
-    aws_file_dir = config.get(custom_section, 'AWS_FILE_DIR')
-    ga_file_dir = config.get(custom_section, 'GA_FILE_DIR')
-    mds_refresh_hrs = float(config.get(custom_section, 'MDS_REFRESH_HRS'))
-    mds_db_host = config.get(default_section, 'MDS_DB_HOST')
-    mds_db_database = config.get(custom_section, 'MDS_DB_DATABASE')
-    mds_db_sql = config.get(custom_section, 'MDS_DB_SQL')
-    mds_db_user = config.get(default_section, 'MDS_DB_USER')
-    mds_db_password = config.get(default_section, 'MDS_DB_PASSWORD')
-    max_batch_size = int(config.get(custom_section, 'MAX_BATCH_SIZE'))
-    max_output_batch_size = int(config.get(custom_section, 'MAX_OUTPUT_BATCH_SIZE'))
-    no_of_processes = int(config.get(custom_section, 'NO_OF_PROCESSES'))
-    log_frequency = config.get(custom_section, 'log_frequency')
-    log_interval = int(config.get(custom_section, 'log_interval'))
-    log_backup_count = int(config.get(custom_section, 'log_backup_count'))
-    debug = config.getboolean(custom_section, 'DEBUG')
-    aws_data_feed = config.getboolean(custom_section, 'AWS_DATA_FEED')
+    cfg = {}
+    cfg['root_dir'] = config.get(default_section, 'ROOT_DIR')
+    cfg['ftp_landing_zone'] = config.get(default_section, 'FTP_LANDING_ZONE')
+    cfg['source_file_dir'] = config.get(custom_section, 'SOURCE_FILE_DIR')
+    cfg['aws_file_dir'] = config.get(custom_section, 'AWS_FILE_DIR')
+    cfg['ga_file_dir'] = config.get(custom_section, 'GA_FILE_DIR')
+    cfg['mds_refresh_hrs'] = float(config.get(custom_section, 'MDS_REFRESH_HRS'))
+    cfg['mds_db_host'] = config.get(default_section, 'MDS_DB_HOST')
+    cfg['mds_db_database'] = config.get(custom_section, 'MDS_DB_DATABASE')
+    cfg['mds_db_sql'] = config.get(custom_section, 'MDS_DB_SQL')
+    cfg['mds_db_user'] = config.get(default_section, 'MDS_DB_USER')
+    cfg['mds_db_password'] = config.get(default_section, 'MDS_DB_PASSWORD')
+    cfg['max_batch_size'] = int(config.get(custom_section, 'MAX_BATCH_SIZE'))
+    cfg['max_output_batch_size'] = int(config.get(custom_section, 'MAX_OUTPUT_BATCH_SIZE'))
+    cfg['no_of_processes'] = int(config.get(custom_section, 'NO_OF_PROCESSES'))
+    cfg['min_processes'] = int(config.get(custom_section, 'MIN_PROCESSES')) if config.has_option(custom_section, 'MIN_PROCESSES') else cfg['no_of_processes']
+    cfg['max_processes'] = int(config.get(custom_section, 'MAX_PROCESSES')) if config.has_option(custom_section, 'MAX_PROCESSES') else cfg['no_of_processes']
+    cfg['xml_parse_log_freq'] = int(config.get(custom_section, 'XML_PARSE_LOG_FREQ')) if config.has_option(custom_section, 'XML_PARSE_LOG_FREQ') else 1000
+    cfg['mp_chunksize'] = int(config.get(custom_section, 'MP_CHUNKSIZE')) if config.has_option(custom_section, 'MP_CHUNKSIZE') else 100
+    cfg['log_frequency'] = config.get(custom_section, 'log_frequency')
+    cfg['log_interval'] = int(config.get(custom_section, 'log_interval'))
+    cfg['log_backup_count'] = int(config.get(custom_section, 'log_backup_count'))
+    cfg['debug'] = config.getboolean(custom_section, 'DEBUG')
+    cfg['aws_data_feed'] = config.getboolean(custom_section, 'AWS_DATA_FEED')
+    cfg['stream_parse'] = config.getboolean(custom_section, 'STREAM_PARSE') if config.has_option(custom_section, 'STREAM_PARSE') else False
+    cfg['seq_ledger'] = config.get(custom_section, 'SEQ_LEDGER') if config.has_option(custom_section, 'SEQ_LEDGER') else None
+    cfg['aws_staging_threads'] = int(config.get(custom_section, 'AWS_STAGING_THREADS')) if config.has_option(custom_section, 'AWS_STAGING_THREADS') else 4
+    cfg['aws_staging_wait'] = config.getboolean(custom_section, 'AWS_STAGING_WAIT') if config.has_option(custom_section, 'AWS_STAGING_WAIT') else False
+    cfg['pipeline_mode'] = config.getboolean(custom_section, 'PIPELINE_MODE') if config.has_option(custom_section, 'PIPELINE_MODE') else False
+    cfg['shard_output'] = config.getboolean(custom_section, 'SHARD_OUTPUT') if config.has_option(custom_section, 'SHARD_OUTPUT') else False
+    cfg['shard_hash_prefix_length'] = 0
+    if cfg['shard_output']:
+        cfg['shard_hash_prefix_length'] = int(config.get(custom_section, 'SHARD_HASH_PREFIX_LENGTH')) if config.has_option(custom_section, 'SHARD_HASH_PREFIX_LENGTH') else 2
+    cfg['admission_scheduler'] = config.getboolean(custom_section, 'ADMISSION_SCHEDULER') if config.has_option(custom_section, 'ADMISSION_SCHEDULER') else False
+    cfg['target_latency_secs'] = float(config.get(custom_section, 'TARGET_LATENCY_SECS')) if config.has_option(custom_section, 'TARGET_LATENCY_SECS') else 900.0
+    cfg['scheduler_cycle_secs'] = float(config.get(custom_section, 'SCHEDULER_CYCLE_SECS')) if config.has_option(custom_section, 'SCHEDULER_CYCLE_SECS') else 60.0
+    cfg['scheduler_window_secs'] = float(config.get(custom_section, 'SCHEDULER_WINDOW_SECS')) if config.has_option(custom_section, 'SCHEDULER_WINDOW_SECS') else 3600.0
+    # The downstream queues measured by the admission scheduler are configured in the sections of the scripts draining them
+    cfg['xml_dir'] = config.get('DQ_IL2_Prep_XML_files', 'XML_DIR') if config.has_option('DQ_IL2_Prep_XML_files', 'XML_DIR') else os.path.join(cfg['root_dir'], 'xml')
+    cfg['xml_inprocess_dir'] = config.get('DQ_IL2_PreProcess_XML_files', 'XML_INPROCESS_DIR') if config.has_option('DQ_IL2_PreProcess_XML_files', 'XML_INPROCESS_DIR') else os.path.join(cfg['root_dir'], 'xml_inprocess')
+    cfg['parse_index'] = config.getboolean(custom_section, 'PARSE_INDEX') if config.has_option(custom_section, 'PARSE_INDEX') else False
+    cfg['dedup_index'] = config.get(custom_section, 'DEDUP_INDEX') if config.has_option(custom_section, 'DEDUP_INDEX') else None
+    cfg['supervise_workers'] = config.getboolean(custom_section, 'SUPERVISE_WORKERS') if config.has_option(custom_section, 'SUPERVISE_WORKERS') else False
+    cfg['xml_task_timeout_secs'] = float(config.get(custom_section, 'XML_TASK_TIMEOUT_SECS')) if config.has_option(custom_section, 'XML_TASK_TIMEOUT_SECS') else 60.0
+    cfg['zip_task_timeout_secs'] = float(config.get(custom_section, 'ZIP_TASK_TIMEOUT_SECS')) if config.has_option(custom_section, 'ZIP_TASK_TIMEOUT_SECS') else 900.0
+    cfg['max_tasks_per_child'] = int(config.get(custom_section, 'MAX_TASKS_PER_CHILD')) if config.has_option(custom_section, 'MAX_TASKS_PER_CHILD') else 0
+    cfg['max_worker_memory_mb'] = int(config.get(custom_section, 'MAX_WORKER_MEMORY_MB')) if config.has_option(custom_section, 'MAX_WORKER_MEMORY_MB') else 0
+    cfg['dedup_retention_secs'] = float(config.get(custom_section, 'DEDUP_RETENTION_HRS')) * 3600 if config.has_option(custom_section, 'DEDUP_RETENTION_HRS') else 72 * 3600.0
+    cfg['checkpoint_journal'] = None
+    if config.has_option(custom_section, 'CHECKPOINT_JOURNAL') and config.getboolean(custom_section, 'CHECKPOINT_JOURNAL'):
+        cfg['checkpoint_journal'] = os.path.join(config.get(default_section, 'ROOT_DIR'), 'log', 'DQ_IL2_Seq_Check_Journal.jsonl')
+    cfg['watch_poll_interval_secs'] = float(config.get(custom_section, 'WATCH_POLL_INTERVAL_SECS')) if config.has_option(custom_section, 'WATCH_POLL_INTERVAL_SECS') else 2.0
+
+    cfg['target_file_dir'] = os.path.join(cfg['root_dir'], 'tmp/')
+    cfg['archive_file_dir'] = os.path.join(cfg['root_dir'], 'archive/')
+    cfg['archive_parsed_file_dir'] = os.path.join(cfg['archive_file_dir'], 'parsed/')
+    cfg['archive_stored_file_dir'] = os.path.join(cfg['archive_file_dir'], 'stored/')
+    cfg['archive_failed_file_dir'] = os.path.join(cfg['archive_file_dir'], 'failed/')
+    cfg['output_file_dir'] = os.path.join(cfg['root_dir'], 'out/')
+    cfg['logfile_dir'] = os.path.join(cfg['root_dir'], 'log/')
+    cfg['raw_file_inprocess_dir'] = os.path.join(cfg['root_dir'], 'raw_inprocess/')
+    cfg['mds_extract_dir'] = os.path.join(cfg['root_dir'], 'mds/')
+    cfg['max_seqs_log'] = os.path.join(os.path.dirname(__file__), 'MAX_SEQS.ini')
+    cfg['max_seqs_log_temp'] = os.path.join(cfg['logfile_dir'], '%s.tmp' % (cfg['max_seqs_log']))
+    cfg['mds_extract'] = os.path.join(cfg['mds_extract_dir'], 'MDS_EXTRACT.csv')
+    cfg['mds_snapshot'] = os.path.join(cfg['mds_extract_dir'], 'MDS_SNAPSHOT.pkl')
+    cfg['output_dirs'] = {}
+    for flight_class in FLIGHT_CLASSES:
+        option = '%s_OUTPUT_DIR' % (flight_class)
+        cfg['output_dirs'][flight_class] = config.get(custom_section, option) if config.has_option(custom_section, option) else cfg['output_file_dir']
+    # GA messages are linked from the GA output folder into the GA folder, so they must be different folders
+    if same_file(cfg['output_dirs'][GA], cfg['ga_file_dir']):
+        raise ValueError('GA_OUTPUT_DIR and GA_FILE_DIR must be different folders: %s' % (cfg['ga_file_dir']))
+    cfg['run_history'] = run_history_file(cfg['root_dir'])
+    cfg['seq_logfilename'] = os.path.join(cfg['logfile_dir'], 'DQ_Invalid_Sequences.log')
+    cfg['log_filename'] = os.path.join(cfg['logfile_dir'], '%s.log' % (os.path.basename(__file__)))
+
+    return cfg
+
+
+def get_seq_info():
+    """
+    Returns the initial sequence information (and filename regex) for each filetype
+    :returns: dict
+    """
+    return {'RAW': {'last_sequence': 'N/A', 'expected_sequence': 'N/A', 'last_updated': '19000101', 'regex': r'^RAW_[0-9]{8}_[0-9]{4}_[0-9]{4}.*\.zip$'},
+            'PARSED': {'last_sequence': 'N/A', 'expected_sequence': 'N/A', 'last_updated': '19000101', 'regex': r'^PARSED_[0-9]{8}_[0-9]{4}_[0-9]{4}.*\.zip$'},
+            'STORED': {'last_sequence': 'N/A', 'expected_sequence': 'N/A', 'last_updated': '19000101', 'regex': r'^STORED_[0-9]{8}_[0-9]{4}_[0-9]{4}.*\.zip$'},
+            'FAILED': {'last_sequence': 'N/A', 'expected_sequence': 'N/A', 'last_updated': '19000101', 'regex': r'^FAILED_[0-9]{8}_[0-9]{4}_[0-9]{4}.*\.zip$'}}
 
-    target_file_dir = os.path.join(root_dir, 'tmp/')
-    archive_file_dir = os.path.join(root_dir, 'archive/')
-    archive_parsed_file_dir = os.path.join(archive_file_dir, 'parsed/')
-    archive_stored_file_dir = os.path.join(archive_file_dir, 'stored/')
-    archive_failed_file_dir = os.path.join(archive_file_dir, 'failed/')
-    output_file_dir = os.path.join(root_dir, 'out/')
-    logfile_dir = os.path.join(root_dir, 'log/')
-    raw_file_inprocess_dir = os.path.join(root_dir, 'raw_inprocess/')
-    ga_inprocess_dir = os.path.join(root_dir, 'ga_inprocess/')
-    mds_extract_dir = os.path.join(root_dir, 'mds/')
-    max_seqs_log = os.path.join(os.path.dirname(__file__), 'MAX_SEQS.ini')
-    max_seqs_log_temp = os.path.join(logfile_dir, '%s.tmp' % (max_seqs_log))
-    mds_extract = os.path.join(mds_extract_dir, 'MDS_EXTRACT.csv')
-    all_regex = '|'.join([seq_info[filetype]['regex'] for filetype in seq_info])
-    seq_logfilename = os.path.join(logfile_dir, 'DQ_Invalid_Sequences.log')
-    log_filename = os.path.join(logfile_dir, '%s.log' % (os.path.basename(__file__)))
-
-    info_logger = setup_logger('Seq Check', log_filename, debug=debug, log_frequency=log_frequency, log_interval=log_interval, log_backup_count=log_backup_count)
-    seq_logger = setup_logger('Sequences', seq_logfilename, debug=debug, log_frequency=log_frequency, log_interval=log_interval, log_backup_count=log_backup_count)
-
-    info_logger.info('*** Run Start ***')
+
+def load_flight_router(cfg):
+    """
+    Loads the MDS snapshot (refreshing it from the MDS database if it has expired) and returns a FlightRouter built from it
+    :param cfg:
+    :returns: FlightRouter
+    """
+    return build_flight_router(create_mds_snapshot_store(cfg).get())
+
+
+def create_parse_pool(cfg, flight_router):
+    """
+    Creates the worker pool (of MAX_PROCESSES workers, see create_phase_executor) - the classification tables are sent to each
+    worker once, by the pool initializer, not with every task. With SUPERVISE_WORKERS enabled, the pool is a SupervisedPool
+    (see DQ_IL2_Supervisor.py)
+    :param cfg:
+    :param flight_router:
+    :returns: multiprocessing.Pool, tuple (the initializer arguments)
+    """
+    worker_initargs = (cfg['root_dir'], PARSED_NS, flight_router, cfg['output_dirs'], cfg['ga_file_dir'], cfg['shard_hash_prefix_length'],
+                       cfg['dedup_index'])
+    if cfg['supervise_workers']:
+        task_timeouts = {mp_parse_xml: cfg['xml_task_timeout_secs'], mp_unzip_files: cfg['zip_task_timeout_secs'],
+                         mp_stream_parse_zip_task: cfg['zip_task_timeout_secs']}
+        pool = SupervisedPool(cfg['max_processes'], init_parse_worker, worker_initargs, task_timeouts=task_timeouts,
+                              timeout_handler=functools.partial(reject_timed_out_task, os.path.join(cfg['root_dir'], 'reject/')),
+                              max_tasks_per_child=cfg['max_tasks_per_child'], max_memory_mb=cfg['max_worker_memory_mb'], logger=info_logger)
+    else:
+        pool = multiprocessing.Pool(cfg['max_processes'], initializer=init_parse_worker, initargs=worker_initargs)
+    return pool, worker_initargs
+
+
+def create_phase_executor(pool, phase, cfg):
+    """
+    Returns the AutotuningExecutor for a phase of a batch (see DQ_IL2_Autotune.py). It starts from NO_OF_PROCESSES, or from
+    the concurrency chosen for the phase in the previous batch run on the same pool
+    :param pool:
+    :param phase:
+    :param cfg:
+    :returns: AutotuningExecutor
+    """
+    previous = phase_executors.get(phase)
+    initial = previous.window if previous is not None and previous.pool is pool else cfg['no_of_processes']
+    executor = AutotuningExecutor(pool, phase, initial, cfg['min_processes'], cfg['max_processes'], logger=info_logger)
+    phase_executors[phase] = executor
+    return executor
+
+
+def create_admission_scheduler(cfg):
+    """
+    Returns the AdmissionScheduler (see DQ_IL2_Scheduler.py), or None if ADMISSION_SCHEDULER is disabled
+    :param cfg:
+    :returns: AdmissionScheduler
+    """
+    if not cfg['admission_scheduler']:
+        return None
+    queue_dirs = {'out': cfg['output_file_dir'], 'xml': cfg['xml_dir'], 'xml_inprocess': cfg['xml_inprocess_dir'], 'ga': cfg['ga_file_dir']}
+    return AdmissionScheduler(queue_dirs, cfg['run_history'], target_latency_secs=cfg['target_latency_secs'], cycle_secs=cfg['scheduler_cycle_secs'],
+                              window_secs=cfg['scheduler_window_secs'], max_batch_size=cfg['max_batch_size'], max_output_batch_size=cfg['max_output_batch_size'])
+
+
+def get_metrics_settings(cfg):
+    """
+    Returns the settings recorded with each batch in the run history
+    :param cfg:
+    :returns: dict
+    """
+    return {'NO_OF_PROCESSES': cfg['no_of_processes'], 'MIN_PROCESSES': cfg['min_processes'], 'MAX_PROCESSES': cfg['max_processes'],
+            'MAX_BATCH_SIZE': cfg['max_batch_size'],
+            'MAX_OUTPUT_BATCH_SIZE': cfg['max_output_batch_size'], 'STREAM_PARSE': cfg['stream_parse'],
+            'PIPELINE_MODE': cfg['pipeline_mode'], 'SHARD_OUTPUT': cfg['shard_output'],
+            'AWS_STAGING_THREADS': cfg['aws_staging_threads'] if cfg['aws_data_feed'] else 0,
+            'ADMISSION_SCHEDULER': cfg['admission_scheduler'], 'DEDUP_INDEX': bool(cfg['dedup_index']),
+            'SUPERVISE_WORKERS': cfg['supervise_workers']}
+
+
+def write_run_metrics(metrics, history_file, status='ok'):
+    """
+    Logs the stage timings and appends them to the run history (see DQ_IL2_Metrics.py)
+    :param metrics: RunMetrics
+    :param history_file:
+    :param status:
+    :returns: None
+    """
+    for line in metrics.summary_lines():
+        info_logger.info('Stage %s' % (line))
+    for line in metrics.counter_lines():
+        info_logger.info('Counter %s' % (line))
+    if not metrics.write(history_file, status):
+        info_logger.warn('Error writing the run history: %s' % (history_file))
+
+
+def dedup_zip_files(cfg, source_dir_list, source_file_dir, zip_sizes):
+    """
+    Evicts the expired hashes from the dedup index, then looks up the sha1 of each zipfile
+    :param cfg:
+    :param source_dir_list: the PARSED zipfiles
+    :param source_file_dir:
+    :param zip_sizes: dict of zipfile to size
+    :returns: tuple (dict of each duplicate zipfile to the zipfile it duplicates, list of (filename, size, sha1) of the
+              others - to be recorded by record_dedup_zips once they have been parsed)
+    """
+    dedup = DedupIndex(cfg['dedup_index'], cfg['dedup_retention_secs'])
+    try:
+        evicted_zips, evicted_messages = dedup.evict()
+        if evicted_zips or evicted_messages:
+            info_logger.info('Dedup index: %s zipfile(s) and %s message(s) evicted' % (evicted_zips, evicted_messages))
+        entries = [(fname, zip_sizes[fname], file_sha1(os.path.join(source_file_dir, fname))) for fname in source_dir_list]
+        duplicates = dedup.check_zips(entries)
+        for fname in sorted(duplicates):
+            info_logger.info('Duplicate zipfile: %s (already received as %s)' % (fname, duplicates[fname]))
+        if dedup.errors:
+            info_logger.warn('Error using the dedup index: %s - zipfiles not deduplicated' % (cfg['dedup_index']))
+    finally:
+        dedup.close()
+    return duplicates, [entry for entry in entries if entry[0] not in duplicates]
+
+
+def record_dedup_zips(cfg, entries):
+    """
+    Records the sha1 of each zipfile parsed in the dedup index
+    :param cfg:
+    :param entries: list of (filename, size, sha1)
+    :returns: None
+    """
+    dedup = DedupIndex(cfg['dedup_index'], cfg['dedup_retention_secs'])
+    try:
+        if not dedup.record_zips(entries):
+            info_logger.warn('Error using the dedup index: %s - %s zipfile(s) not recorded' % (cfg['dedup_index'], len(entries)))
+    finally:
+        dedup.close()
+
+
+def process_batch(cfg, pool=None, worker_initargs=None, aws_stager=None, journal=None):
+    """
+    Prepares a batch from the landing zone, checks sequences, parses the xmls, then copies/archives the batch zipfiles
+    If no pool is given (i.e. a single scheduled run), the MDS snapshot is loaded and a pool is created for this batch only
+    (likewise the AWS stager and the checkpoint journal)
+    The stages completed for each zipfile are recorded in the checkpoint journal - those recorded by an interrupted run are
+    skipped
+    :param cfg:
+    :param pool:
+    :param worker_initargs:
+    :param aws_stager:
+    :param journal: CheckpointJournal
+    :returns: int (the number of zipfiles processed)
+    """
+    if journal is None:
+        journal = CheckpointJournal(cfg['checkpoint_journal'])
+    journal.load()
+    seq_info = get_seq_info()
+    dir_index = DirectoryIndex(dict([(filetype, seq_info[filetype]['regex']) for filetype in seq_info]))
+    source_file_dir = cfg['source_file_dir']
+    metrics = RunMetrics('DQ_IL2_Seq_Check', get_metrics_settings(cfg))
 
     info_logger.info('PREPARING BATCH')
 
-    if prepare_batch_files(output_file_dir, max_output_batch_size, ftp_landing_zone, source_file_dir, all_regex, max_batch_size, seq_info.keys()) > 0:
+    with metrics.stage('prepare batch') as stage:
+        stage.file_count = prepare_batch_files(dir_index, cfg['output_file_dir'], cfg['max_output_batch_size'], cfg['ftp_landing_zone'], source_file_dir, cfg['max_batch_size'], seq_info.keys(),
+                                              scheduler=create_admission_scheduler(cfg))
+
+    if stage.file_count > 0:
+
+        source_dir_list = dir_index.files(source_file_dir)
+        zip_sizes = dict([(fname, os.path.getsize(os.path.join(source_file_dir, fname))) for fname in source_dir_list])
+        stage.byte_count = sum(zip_sizes.values())
+        parsed_file_list = [fname for fname in source_dir_list if re.match(seq_info['PARSED']['regex'], fname)]
+        parsed_byte_count = sum([zip_sizes[fname] for fname in parsed_file_list])
+
+        resumed_file_list = journal.resumed(source_dir_list)
+        if resumed_file_list:
+            info_logger.info('RESUMING %s ZIPFILE(S) FROM THE CHECKPOINT JOURNAL' % (len(resumed_file_list)))
+
+        with metrics.stage('sequence check', len(source_dir_list)):
+            # The sequences of resumed zipfiles have already been recorded - checking them again would report them as invalid
+            seq_file_list = skip_completed(journal, source_dir_list, 'sequence')
+            if not seq_file_list:
+                pass
+            elif cfg['seq_ledger']:
+                info_logger.info('CHECKING SEQUENCES')
+                check_sequence_ledger(seq_file_list, cfg['seq_ledger'], cfg['max_seqs_log'], cfg['max_seqs_log_temp'],
+                                      cfg['archive_file_dir'], seq_info.keys())
+            else:
+                info_logger.info('READING MAX SEQUENCES FILE')
+                seq_config = check_sequence_config_file(cfg['max_seqs_log'], seq_info.keys())
+                seq_info = get_sequence_config_file_values(seq_info, seq_config, MAX_FILE_SEQ)
+
+                info_logger.info('CHECKING SEQUENCES')
+                seq_info = check_sequences(seq_file_list, seq_info, MAX_FILE_SEQ)
+                update_config_file(seq_info, seq_config, cfg['max_seqs_log_temp'], cfg['max_seqs_log'], cfg['archive_file_dir'])
+            journal.record_many(seq_file_list, 'sequence')
+
+        # PARSED zipfiles already received (e.g. re-delivered by upstream) are not unzipped or parsed, but are archived and
+        # staged for the AWS data feed as usual - they are recorded as unzipped/parsed in the checkpoint journal, so every
+        # parse mode skips them (see DQ_IL2_Dedup.py)
+        dedup_entries = []
+        if cfg['dedup_index']:
+            with metrics.stage('dedup zips') as stage:
+                dedup_file_list = [fname for fname in parsed_file_list if fname not in resumed_file_list]
+                duplicate_zips, dedup_entries = dedup_zip_files(cfg, dedup_file_list, source_file_dir, zip_sizes)
+                for fname in sorted(duplicate_zips):
+                    journal.record(fname, 'unzip', duplicate_of=duplicate_zips[fname])
+                    journal.record(fname, 'parse', duplicate_of=duplicate_zips[fname])
+                stage.file_count = len(dedup_file_list)
+                stage.byte_count = sum([zip_sizes[fname] for fname in dedup_file_list])
+            if duplicate_zips:
+                duplicate_bytes = sum([zip_sizes[fname] for fname in duplicate_zips])
+                info_logger.info('Duplicate zipfiles skipped: %s (%s byte(s))' % (len(duplicate_zips), duplicate_bytes))
+                metrics.count('duplicate zips', len(duplicate_zips))
+                metrics.count('duplicate zip bytes', duplicate_bytes)
+
+        # The AWS data feed is staged in the background while the xmls are parsed (see DQ_IL2_AWS_Staging.py)
+        batch_stager = aws_stager
+        aws_batch = None
+        if cfg['aws_data_feed'] and batch_stager is None:
+            batch_stager = AWSStager(cfg['aws_file_dir'], info_logger, no_of_threads=cfg['aws_staging_threads'])
+
+        # The xmls written by the batch are indexed for the downstream scripts (see DQ_IL2_Parse_Index.py) - any index left
+        # unpublished by an interrupted run is published first
+        parse_index = None
+        if cfg['parse_index']:
+            for index_base_dir in sorted(set(cfg['output_dirs'].values() + [cfg['ga_file_dir']])):
+                if recover_partial_indexes(index_base_dir):
+                    info_logger.info('Published the parse index(es) of an interrupted run in %s' % (index_base_dir))
+            parse_index = BatchParseIndex(cfg['output_dirs'], cfg['ga_file_dir'])
+
+        batch_pool = pool
+        completed = False
+        try:
+            if batch_pool is None:
+                info_logger.info('READING MDS SNAPSHOT')
+                with metrics.stage('read mds snapshot'):
+                    batch_pool, worker_initargs = create_parse_pool(cfg, load_flight_router(cfg))
+
+            if cfg['pipeline_mode']:
+                info_logger.info('PARSING XML, STAGING FILES FOR AWS DATA FEED AND ARCHIVING (PIPELINED)')
+                archive_dirs = {'RAW': cfg['raw_file_inprocess_dir'], 'PARSED': cfg['archive_parsed_file_dir'],
+                                'FAILED': cfg['archive_failed_file_dir'], 'STORED': cfg['archive_stored_file_dir']}
+                with metrics.stage('pipelined parse/archive', len(source_dir_list), sum(zip_sizes.values())) as stage:
+                    executor = create_phase_executor(batch_pool, 'pipelined parse/archive', cfg)
+                    aws_batch = process_pipelined_batch(executor, source_dir_list, source_file_dir, archive_dirs, worker_initargs, journal,
+                                                        aws_stager=batch_stager, log_freq=cfg['xml_parse_log_freq'], parse_index=parse_index,
+                                                        metrics=metrics, zip_sizes=zip_sizes)
+                    stage.concurrency = executor.stats()
+            else:
+                if batch_stager is not None:
+                    info_logger.info('STAGING FILES FOR AWS DATA FEED')
+                    aws_batch = stage_aws_batch(batch_stager, source_dir_list, source_file_dir, journal)
+
+                if cfg['stream_parse']:
+                    info_logger.info('STREAM PARSING XML')
+                    with metrics.stage('stream parse', byte_count=parsed_byte_count) as stage:
+                        executor = create_phase_executor(batch_pool, 'stream parse', cfg)
+                        stage.file_count = process_mp_stream_parse_zips(executor, source_dir_list, source_file_dir, seq_info['PARSED']['regex'], worker_initargs,
+                                                                        log_freq=cfg['xml_parse_log_freq'], journal=journal, parse_index=parse_index,
+                                                                        metrics=metrics, zip_sizes=zip_sizes)
+                        stage.concurrency = executor.stats()
+                else:
+                    with metrics.stage('unzip', byte_count=parsed_byte_count) as stage:
+                        executor = create_phase_executor(batch_pool, 'unzip', cfg)
+                        stage.file_count, unzipped_xml_count = process_mp_unzip_files(executor, source_dir_list, source_file_dir, cfg['target_file_dir'],
+                                                                                      seq_info['PARSED']['regex'], journal=journal, zip_sizes=zip_sizes)
+                        stage.concurrency = executor.stats()
+
+                    info_logger.info('PARSING XML')
+                    with metrics.stage('parse') as stage:
+                        executor = create_phase_executor(batch_pool, 'parse', cfg)
+                        stage.file_count = process_mp_parse_xml(executor, cfg['target_file_dir'], worker_initargs,
+                                                                chunksize=cfg['mp_chunksize'], log_freq=cfg['xml_parse_log_freq'], parse_index=parse_index,
+                                                                metrics=metrics, xml_count=None if resumed_file_list else unzipped_xml_count,
+                                                                dedup_index=cfg['dedup_index'])
+                        stage.concurrency = executor.stats()
+                    # The xmls are moved out of the tmp folder as they are parsed, so the parse stage is only recorded once
+                    # the tmp folder has been worked through (a resumed run parses whatever is left in it)
+                    journal.record_many(journal.pending(parsed_file_list, 'parse'), 'parse')
+
+                # Zipfiles are only archived once they are in the AWS data feed folder - any which could not be staged are
+                # left in the batch folder
+                aws_failed = set()
+                if aws_batch is not None:
+                    with metrics.stage('aws staging wait', len(source_dir_list)):
+                        aws_failed = aws_batch.wait_staged()
+                    if aws_failed:
+                        info_logger.warn('%s zipfile(s) could not be staged for the AWS data feed - left in %s' % (len(aws_failed), source_file_dir))
+
+                with metrics.stage('archive') as stage:
+                    archive_file_list = [fname for fname in source_dir_list if fname not in aws_failed]
+                    stage.byte_count = sum([zip_sizes[fname] for fname in archive_file_list])
+
+                    info_logger.info('MOVING RAW FILES')
+                    stage.file_count += move_files([f for f in dir_index.files(source_file_dir, 'RAW') if f not in aws_failed], source_file_dir, cfg['raw_file_inprocess_dir'])
+
+                    info_logger.info('ARCHIVING')
+                    stage.file_count += move_files([f for f in dir_index.files(source_file_dir, 'PARSED') if f not in aws_failed], source_file_dir, cfg['archive_parsed_file_dir'])
+                    stage.file_count += move_files([f for f in dir_index.files(source_file_dir, 'FAILED') if f not in aws_failed], source_file_dir, cfg['archive_failed_file_dir'])
+                    stage.file_count += move_files([f for f in dir_index.files(source_file_dir, 'STORED') if f not in aws_failed], source_file_dir, cfg['archive_stored_file_dir'])
+
+                if not cfg['stream_parse']:
+                    info_logger.info('CLEANING UP')
+                    with metrics.stage('cleanup'):
+                        remove_temp_folders(cfg['target_file_dir'], '^RAW|^PARSED|^STORED|^FAILED')
+
+            # The zipfiles are only recorded in the dedup index once they have been parsed and archived, so a zipfile left
+            # in the batch folder (or whose batch failed) is not skipped as a duplicate when it is processed again
+            archived_entries = [entry for entry in dedup_entries if not os.path.exists(os.path.join(source_file_dir, entry[0]))]
+            if archived_entries:
+                record_dedup_zips(cfg, archived_entries)
+
+            if aws_batch is not None and cfg['aws_staging_wait']:
+                info_logger.info('WAITING FOR AWS DATA FEED MANIFEST')
+                with metrics.stage('aws manifest wait', len(source_dir_list)):
+                    aws_batch.wait()
+            completed = True
+        finally:
+            # The xmls written so far are indexed even if the batch failed
+            if parse_index is not None:
+                for index_base_dir, index_count in parse_index.publish().items():
+                    info_logger.info('Parse index: %s file(s) indexed in %s' % (index_count, index_base_dir))
+
+            if isinstance(batch_pool, SupervisedPool):
+                for name, count in sorted(batch_pool.take_counts().items()):
+                    if count:
+                        metrics.count(name, count)
+
+            if pool is None and batch_pool is not None:
+                batch_pool.close()
+                batch_pool.join()
+            # A single run's stager is closed here, i.e. the process waits for the manifest before it exits (after archiving
+            # and cleaning up). In watch mode, the stager carries on in the background while the next batch is processed
+            if aws_stager is None and batch_stager is not None:
+                batch_stager.close()
+
+            # The staging of the batch is only recorded if it has completed (in watch mode it may still be running)
+            if aws_batch is not None and aws_batch.done_event.is_set():
+                metrics.record_stage('aws staging', *aws_batch.stats())
+            write_run_metrics(metrics, cfg['run_history'], 'ok' if completed else 'failed')
+
+            # Only the records of zipfiles left in the batch folder (e.g. those which could not be staged) are kept
+            if completed:
+                journal.compact(os.listdir(source_file_dir))
+
+        return len(source_dir_list)
+
+    info_logger.info('No files to process')
+    return 0
+
+
+def run_watch_mode(cfg):
+    """
+    Runs as a long-running process: keeps a warm worker pool and the MDS carrier tables in memory, polls the landing zone
+    every WATCH_POLL_INTERVAL_SECS and processes zipfiles as soon as they arrive. On SIGINT/SIGTERM (or SIGBREAK on
+    Windows) the batch in progress is completed, the pool is drained and the process exits.
+    The MDS snapshot is refreshed in the background and checked before each batch - if its content has changed, the pool is
+    drained and recreated with the new tables.
+    :param cfg:
+    :returns: None
+    """
+    shutdown = {'requested': False}
+
+    def request_shutdown(signum, frame):
+        if not shutdown['requested']:
+            info_logger.info('Shutdown requested (signal %s) - draining' % (signum))
+        shutdown['requested'] = True
+
+    for signame in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+        if hasattr(signal, signame):
+            signal.signal(getattr(signal, signame), request_shutdown)
 
-        info_logger.info('READING MAX SEQUENCES FILE')
-        seq_config = check_sequence_config_file(max_seqs_log, seq_info.keys())
-        seq_info = get_sequence_config_file_values(seq_info, seq_config, max_file_seq)
+    def wait_for_next_poll():
+        poll_end = time.time() + cfg['watch_poll_interval_secs']
+        while time.time() < poll_end and not shutdown['requested']:
+            time.sleep(min(0.5, cfg['watch_poll_interval_secs']))
 
-        source_dir_list = [f for f in os.listdir(source_file_dir) if re.match(all_regex, f)]
-        source_dir_list.sort()
+    filetype_regexes = dict([(filetype, info['regex']) for filetype, info in get_seq_info().items()])
+    pool = None
+    worker_initargs = None
+    mds_version = None
+    batch_count = 0
 
-        info_logger.info('CHECKING SEQUENCES')
-        seq_info = check_sequences(source_dir_list, seq_info, max_file_seq)
-        update_config_file(seq_info, seq_config, max_seqs_log_temp, max_seqs_log, archive_file_dir)
+    # The snapshot is loaded (and refreshed if expired) once here, then refreshed in the background - parsing carries on
+    # with the active snapshot while the MDS database is queried, and with the last good snapshot if the query fails
+    mds_store = create_mds_snapshot_store(cfg)
+    mds_store.get()
+    mds_store.start_background_refresh()
 
-        pool = multiprocessing.Pool(no_of_processes)
-        process_mp_unzip_files(pool, source_dir_list, source_file_dir, target_file_dir, seq_info['PARSED']['regex'], no_of_processes=no_of_processes)
+    aws_stager = None
+    if cfg['aws_data_feed']:
+        aws_stager = AWSStager(cfg['aws_file_dir'], info_logger, no_of_threads=cfg['aws_staging_threads'])
 
-        info_logger.info('READING MDS EXTRACT')
-        check_mds_file(mds_extract, mds_db_sql, mds_db_host, mds_db_database, mds_db_user, mds_db_password, mds_refresh_hrs=mds_refresh_hrs)
-        iata_executive_carriers, icao_executive_carriers = read_mds_extract(mds_extract)
+    # A single journal is shared by every batch, as the AWS staging of a batch may still be recording to it in the background
+    journal = CheckpointJournal(cfg['checkpoint_journal'])
 
-        info_logger.info('PARSING XML')
-        process_mp_parse_xml(pool, target_file_dir, root_dir, parsed_ns, iata_executive_carriers, icao_executive_carriers, ga_inprocess_dir, ga_file_dir, no_of_processes=no_of_processes)
+    info_logger.info('Watching %s (poll interval: %s sec(s))' % (cfg['ftp_landing_zone'], cfg['watch_poll_interval_secs']))
 
-        if aws_data_feed:
-            info_logger.info("COPYING FILES FOR AWS DATA FEED")
-            copy_files_for_aws([f for f in source_dir_list if re.match(all_regex, f)], source_file_dir, aws_file_dir)
+    try:
+        while not shutdown['requested']:
+            poll_index = DirectoryIndex(filetype_regexes)
+            pending = poll_index.matched_count(cfg['ftp_landing_zone']) or poll_index.matched_count(cfg['source_file_dir'])
+
+            if not pending:
+                wait_for_next_poll()
+                continue
+
+            snapshot = mds_store.current()
+            if snapshot.content_hash != mds_version:
+                info_logger.info('READING MDS SNAPSHOT')
+                mds_version = snapshot.content_hash
+                flight_router = build_flight_router(snapshot)
+                if pool is not None:
+                    info_logger.info('MDS snapshot changed - recreating worker pool')
+                    pool.close()
+                    pool.join()
+                pool, worker_initargs = create_parse_pool(cfg, flight_router)
+
+            batch_starttime = datetime.datetime.now()
+            try:
+                processed = process_batch(cfg, pool, worker_initargs, aws_stager, journal)
+            except Exception:
+                # e.g. a locked file or a full disk - the files left in the landing zone are picked up at the next poll
+                info_logger.exception('Error processing batch - retrying at the next poll')
+                wait_for_next_poll()
+                continue
+            if processed > 0:
+                batch_count += 1
+                info_logger.info('*** Batch %s Complete *** (Elapsed time: %s)' % (batch_count, get_time_delta_in_secs(batch_starttime)))
+            else:
+                wait_for_next_poll()
+    finally:
+        mds_store.stop_background_refresh()
+        if pool is not None:
+            info_logger.info('Draining worker pool')
+            pool.close()
+            pool.join()
+        if aws_stager is not None:
+            info_logger.info('Waiting for AWS data feed staging')
+            aws_stager.close()
+
+    info_logger.info('Stopped watching after %s batch(es)' % (batch_count))
+
+
+def main(argv):
+    starttime = datetime.datetime.now()
+    config_file = os.path.join(os.path.dirname(__file__), 'DQ_IL2_Config.ini')
+    default_section = 'DEFAULT'
+    custom_section = os.path.basename(__file__).replace('.py', '')
+    watch = False
+
+    try:
+        opts, args = getopt.getopt(argv, "w", ["watch"])
+    except getopt.GetoptError:
+        print 'Usage: %s [-w|--watch]' % (os.path.basename(__file__))
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ('-w', '--watch'):
+            watch = True
 
-        info_logger.info('MOVING RAW FILES')
-        move_files([f for f in source_dir_list if re.match(seq_info['RAW']['regex'], f)], source_file_dir, raw_file_inprocess_dir)
+    cfg = read_config(config_file, default_section, custom_section)
 
-        info_logger.info('ARCHIVING')
-        move_files([f for f in source_dir_list if re.match(seq_info['PARSED']['regex'], f)], source_file_dir, archive_parsed_file_dir)
-        move_files([f for f in source_dir_list if re.match(seq_info['FAILED']['regex'], f)], source_file_dir, archive_failed_file_dir)
-        move_files([f for f in source_dir_list if re.match(seq_info['STORED']['regex'], f)], source_file_dir, archive_stored_file_dir)
+    info_logger = setup_logger('Seq Check', cfg['log_filename'], debug=cfg['debug'], log_frequency=cfg['log_frequency'], log_interval=cfg['log_interval'], log_backup_count=cfg['log_backup_count'])
+    seq_logger = setup_logger('Sequences', cfg['seq_logfilename'], debug=cfg['debug'], log_frequency=cfg['log_frequency'], log_interval=cfg['log_interval'], log_backup_count=cfg['log_backup_count'])
 
-        info_logger.info('CLEANING UP')
-        remove_temp_folders(target_file_dir, '^RAW|^PARSED|^STORED|^FAILED')
+    info_logger.info('*** Run Start ***%s' % (' (watch mode)' if watch else ''))
 
+    if watch:
+        run_watch_mode(cfg)
     else:
-        info_logger.info('No files to process')
+        process_batch(cfg)
 
     info_logger.info('*** Run Complete *** (Elapsed time: %s)' % (get_time_delta_in_secs(starttime)))
 
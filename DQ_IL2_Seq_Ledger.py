@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Seq_Ledger.py
+
+DESCRIPTION:
+
+An SQLite ledger of every zipfile sequence received by DQ_IL2_Seq_Check (used to check the sequences when SEQ_LEDGER is
+set - MAX_SEQS.ini is still written, from last_sequences). Zipfiles are named <filetype>_<yyyymmdd>_<hhmi>_<seq>.zip and sequences restart at 0001 each day.
+
+Tables:
+
+    received        (filetype, filedate, seq, filename, received_at) - one row per zipfile received
+    dates           (filetype, filedate, max_seq, received_count)   - the highest sequence received for each date
+    missing_ranges  (filetype, filedate, first_seq, last_seq)        - the gaps below max_seq, as ranges
+
+Sequences are held as ordinals (0001 - 9999, with 0000 - the sequence after 9999, see modulo_seq_add - held as 10000), so
+a gap of any size is a single missing_ranges row. A late (out of order) arrival splits or shrinks the range it falls in.
+All the zipfiles of a run are recorded in a single transaction.
+
+The missing sequences for a date can be listed with:
+
+    python DQ_IL2_Seq_Ledger.py -l <ledger file> -d <yyyymmdd> [-t <filetype>]
+"""
+
+import re
+import sys
+import time
+import getopt
+import sqlite3
+
+MAX_FILE_SEQ = 10000
+
+FILENAME_REGEX = re.compile(r'^(RAW|PARSED|STORED|FAILED)_([0-9]{8})_[0-9]{4}_([0-9]{4})')
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS received (filetype TEXT NOT NULL, filedate TEXT NOT NULL, seq INTEGER NOT NULL, '
+          'filename TEXT NOT NULL, received_at TEXT NOT NULL, PRIMARY KEY (filetype, filedate, seq))',
+          'CREATE TABLE IF NOT EXISTS dates (filetype TEXT NOT NULL, filedate TEXT NOT NULL, max_seq INTEGER NOT NULL, '
+          'received_count INTEGER NOT NULL, PRIMARY KEY (filetype, filedate))',
+          'CREATE TABLE IF NOT EXISTS missing_ranges (filetype TEXT NOT NULL, filedate TEXT NOT NULL, first_seq INTEGER NOT NULL, '
+          'last_seq INTEGER NOT NULL, PRIMARY KEY (filetype, filedate, first_seq))']
+
+
+def format_seq(ordinal, max_file_seq=MAX_FILE_SEQ):
+    """
+    Returns the 4 digit sequence of an ordinal, e.g. 7 -> '0007', 10000 -> '0000'
+    :param ordinal:
+    :param max_file_seq:
+    :returns: string
+    """
+    return str(ordinal % max_file_seq).zfill(4)
+
+
+def format_range(first_seq, last_seq, max_file_seq=MAX_FILE_SEQ):
+    """
+    Returns a range of ordinals as a string, e.g. '0004-0007' or '0004'
+    :param first_seq:
+    :param last_seq:
+    :param max_file_seq:
+    :returns: string
+    """
+    if first_seq == last_seq:
+        return format_seq(first_seq, max_file_seq)
+    return '%s-%s' % (format_seq(first_seq, max_file_seq), format_seq(last_seq, max_file_seq))
+
+
+class SeqLedger(object):
+    """
+    The sequence ledger - see the module description
+    """
+
+    def __init__(self, ledger_filename, max_file_seq=MAX_FILE_SEQ):
+        """
+        Opens (and creates, if needed) the ledger
+        :param ledger_filename:
+        :param max_file_seq:
+        """
+        self.max_file_seq = max_file_seq
+        self.conn = sqlite3.connect(ledger_filename)
+        with self.conn:
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        self.conn.close()
+
+    def is_empty(self, filetype):
+        """
+        Returns True if nothing has been recorded for the filetype
+        :param filetype:
+        :returns: bool
+        """
+        return self.conn.execute('SELECT 1 FROM dates WHERE filetype = ? LIMIT 1', (filetype,)).fetchone() is None
+
+    def seed(self, filetype, filedate, last_sequence):
+        """
+        Records the last sequence of a date without any received rows (e.g. taken from MAX_SEQS.ini when the ledger is
+        first used), so the next file of that date is checked against it rather than against 0001
+        :param filetype:
+        :param filedate: yyyymmdd
+        :param last_sequence: 4 digit sequence
+        :returns: None
+        """
+        ordinal = int(last_sequence) or self.max_file_seq
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO dates (filetype, filedate, max_seq, received_count) VALUES (?, ?, ?, 0)',
+                              (filetype, filedate, ordinal))
+
+    def record_files(self, filenames):
+        """
+        Records the zipfiles received in a run (in a single transaction) and returns what was found
+        :param filenames: zipfile names, in the order received (i.e. sorted)
+        :returns: dict with lists of:
+                  'gaps' - (filetype, filedate, first_seq, last_seq, filename) for each new missing range, found before filename
+                  'late' - filenames which filled (part of) a missing range
+                  'duplicates' - filenames with a sequence already received
+                  'ignored' - filenames not in the expected format
+        """
+        results = {'gaps': [], 'late': [], 'duplicates': [], 'ignored': [], 'received': 0}
+        received_at = time.strftime('%Y%m%d%H%M%S')
+
+        with self.conn:
+            for filename in filenames:
+                m = FILENAME_REGEX.match(filename)
+                if not m:
+                    results['ignored'].append(filename)
+                    continue
+                filetype, filedate, seq = m.group(1), m.group(2), m.group(3)
+                ordinal = int(seq) or self.max_file_seq
+
+                cursor = self.conn.execute('INSERT OR IGNORE INTO received (filetype, filedate, seq, filename, received_at) VALUES (?, ?, ?, ?, ?)',
+                                           (filetype, filedate, ordinal, filename, received_at))
+                if cursor.rowcount == 0:
+                    results['duplicates'].append(filename)
+                    continue
+
+                row = self.conn.execute('SELECT max_seq FROM dates WHERE filetype = ? AND filedate = ?', (filetype, filedate)).fetchone()
+                if row is None:
+                    max_seq = 0
+                    self.conn.execute('INSERT INTO dates (filetype, filedate, max_seq, received_count) VALUES (?, ?, 0, 0)', (filetype, filedate))
+                else:
+                    max_seq = row[0]
+
+                if ordinal > max_seq:
+                    if ordinal > max_seq + 1:
+                        self.conn.execute('INSERT INTO missing_ranges (filetype, filedate, first_seq, last_seq) VALUES (?, ?, ?, ?)',
+                                          (filetype, filedate, max_seq + 1, ordinal - 1))
+                        results['gaps'].append((filetype, filedate, max_seq + 1, ordinal - 1, filename))
+                    self.conn.execute('UPDATE dates SET max_seq = ?, received_count = received_count + 1 WHERE filetype = ? AND filedate = ?',
+                                      (ordinal, filetype, filedate))
+                else:
+                    self.conn.execute('UPDATE dates SET received_count = received_count + 1 WHERE filetype = ? AND filedate = ?', (filetype, filedate))
+                    if self._fill_missing(filetype, filedate, ordinal):
+                        results['late'].append(filename)
+                    else:
+                        # At or below a sequence seeded from MAX_SEQS.ini, i.e. already processed before the ledger was used
+                        results['duplicates'].append(filename)
+
+                results['received'] += 1
+
+        return results
+
+    def _fill_missing(self, filetype, filedate, ordinal):
+        """
+        Removes a sequence from the missing range it falls in (splitting the range if needed)
+        :param filetype:
+        :param filedate:
+        :param ordinal:
+        :returns: bool (False if the sequence was not missing)
+        """
+        row = self.conn.execute('SELECT first_seq, last_seq FROM missing_ranges WHERE filetype = ? AND filedate = ? AND first_seq <= ? AND last_seq >= ?',
+                                (filetype, filedate, ordinal, ordinal)).fetchone()
+        if row is None:
+            return False
+
+        first_seq, last_seq = row
+        self.conn.execute('DELETE FROM missing_ranges WHERE filetype = ? AND filedate = ? AND first_seq = ?', (filetype, filedate, first_seq))
+        for new_first_seq, new_last_seq in ((first_seq, ordinal - 1), (ordinal + 1, last_seq)):
+            if new_first_seq <= new_last_seq:
+                self.conn.execute('INSERT INTO missing_ranges (filetype, filedate, first_seq, last_seq) VALUES (?, ?, ?, ?)',
+                                  (filetype, filedate, new_first_seq, new_last_seq))
+        return True
+
+    def missing_ranges(self, filedate, filetype=None):
+        """
+        Returns the missing sequence ranges for a date
+        :param filedate: yyyymmdd
+        :param filetype: all filetypes if None
+        :returns: list of (filetype, first_seq, last_seq)
+        """
+        if filetype is None:
+            return self.conn.execute('SELECT filetype, first_seq, last_seq FROM missing_ranges WHERE filedate = ? ORDER BY filetype, first_seq',
+                                     (filedate,)).fetchall()
+        return self.conn.execute('SELECT filetype, first_seq, last_seq FROM missing_ranges WHERE filedate = ? AND filetype = ? ORDER BY first_seq',
+                                 (filedate, filetype)).fetchall()
+
+    def last_sequences(self):
+        """
+        Returns the latest date and its highest sequence for each filetype
+        :returns: dict of filetype to (filedate, 4 digit sequence)
+        """
+        last_sequences = {}
+        for filetype, filedate, max_seq in self.conn.execute('SELECT filetype, filedate, max_seq FROM dates ORDER BY filetype, filedate'):
+            last_sequences[filetype] = (filedate, format_seq(max_seq, self.max_file_seq))
+        return last_sequences
+
+
+def main(argv):
+    ledger_filename = None
+    filedate = None
+    filetype = None
+
+    try:
+        opts, args = getopt.getopt(argv, "l:d:t:")
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-l':
+            ledger_filename = arg
+        elif opt == '-d':
+            filedate = arg
+        elif opt == '-t':
+            filetype = arg
+
+    if not ledger_filename or not filedate:
+        print __doc__
+        sys.exit(2)
+
+    ledger = SeqLedger(ledger_filename)
+    missing = ledger.missing_ranges(filedate, filetype)
+    for missing_filetype, first_seq, last_seq in missing:
+        print '%s\t%s\t%s\t(%s file(s))' % (missing_filetype, filedate, format_range(first_seq, last_seq), last_seq - first_seq + 1)
+    if not missing:
+        print 'No missing sequences for %s' % (filedate)
+    ledger.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
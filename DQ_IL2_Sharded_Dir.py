@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Sharded_Dir.py
+
+DESCRIPTION:
+
+Shard-aware helpers for the xml queue folders ("out", "xml", "ga"), which can hold hundreds of thousands of files.
+
+When sharding is enabled (SHARD_OUTPUT in DQ_IL2_Seq_Check), each file is written to a subfolder of the queue folder:
+
+    out/<yyyymmddhh>/<hash prefix>/<filename>
+
+where <yyyymmddhh> is the hour the file was written and <hash prefix> is the first SHARD_HASH_PREFIX_LENGTH hex digits of
+the crc32 of the filename, so no single folder grows beyond a few thousand entries.
+
+Consumers list and move files with the helpers below, which return paths relative to the queue folder and handle both
+layouts (flat files and shard subfolders are listed together), so producers can be switched over without a drain:
+- iter_files / list_files / count_files list the files of a queue folder (only shard subfolders are descended into)
+- move_file moves a file to another queue folder, keeping its shard subfolder
+- remove_empty_shards removes emptied shard subfolders from earlier hours
+"""
+
+import os
+import re
+import time
+import errno
+import shutil
+import zlib
+
+from DQ_IL2_Dir_Index import scandir, iter_dir_names
+
+HOUR_DIR_REGEX = re.compile(r'^[0-9]{10}$')
+HASH_DIR_REGEX = re.compile(r'^[0-9a-f]{1,8}$')
+
+
+def shard_subdir(filename, hash_prefix_length, write_time=None):
+    """
+    Returns the shard subfolder (relative to the queue folder) for a file, e.g. 2017110612/3f
+    :param filename:
+    :param hash_prefix_length: the number of hex digits of the filename crc32 used for the second level
+    :param write_time: seconds since the epoch (defaults to now)
+    :returns: string
+    """
+    hour = time.strftime('%Y%m%d%H', time.localtime(write_time))
+    hash_prefix = ('%08x' % (zlib.crc32(os.path.basename(filename)) & 0xffffffff))[:hash_prefix_length]
+    return os.path.join(hour, hash_prefix)
+
+
+def output_dir(base_dir, filename, hash_prefix_length=0):
+    """
+    Returns (and creates, if needed) the folder a new file is written to - base_dir itself when sharding is disabled
+    :param base_dir:
+    :param filename:
+    :param hash_prefix_length: 0 (sharding disabled) or the number of hex digits used for the second level
+    :returns: string
+    """
+    if not hash_prefix_length:
+        return base_dir
+    target_dir = os.path.join(base_dir, shard_subdir(filename, hash_prefix_length))
+    make_dirs(target_dir)
+    return target_dir
+
+
+def make_dirs(path):
+    """
+    Creates a folder (and its parents), ignoring the error if it already exists (e.g. created by another worker)
+    :param path:
+    :returns: None
+    """
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def _split_dir(path, subdir_regex=None):
+    """
+    Lists a folder once and splits it into the files and the shard subfolders (the folders whose names match subdir_regex).
+    Without scandir, only the names matching subdir_regex are stat'ed - any other entry is taken to be a file, so a flat
+    folder of hundreds of thousands of files is listed without a stat per file
+    :param path:
+    :param subdir_regex: HOUR_DIR_REGEX, HASH_DIR_REGEX or None (every entry is a file)
+    :returns: tuple (list of file names, sorted list of shard subfolder names)
+    """
+    filenames = []
+    subdirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if not entry.is_dir():
+                filenames.append(entry.name)
+            elif subdir_regex is not None and subdir_regex.match(entry.name):
+                subdirs.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            if subdir_regex is not None and subdir_regex.match(name) and os.path.isdir(os.path.join(path, name)):
+                subdirs.append(name)
+            else:
+                filenames.append(name)
+    return filenames, sorted(subdirs)
+
+
+def _iter_dir_files(base_dir):
+    """
+    Yields the files in a queue folder (see iter_files), as paths relative to base_dir
+    :param base_dir:
+    :returns: generator
+    """
+    filenames, hours = _split_dir(base_dir, HOUR_DIR_REGEX)
+    for name in filenames:
+        yield name
+    for hour in hours:
+        for hash_prefix in _split_dir(os.path.join(base_dir, hour), HASH_DIR_REGEX)[1]:
+            subdir = os.path.join(hour, hash_prefix)
+            for name in _split_dir(os.path.join(base_dir, subdir))[0]:
+                yield os.path.join(subdir, name)
+
+
+def iter_files(base_dir, suffix=None):
+    """
+    Yields the files in a queue folder, as paths relative to base_dir - flat files first, then the files in each shard
+    subfolder (oldest hour first). The folder is listed once, and only <yyyymmddhh> shard subfolders are descended into
+    (see _split_dir)
+    :param base_dir:
+    :param suffix: only files ending with suffix (case insensitive), e.g. '.xml'
+    :returns: generator
+    """
+    suffix = suffix.lower() if suffix else None
+    for relative_filename in _iter_dir_files(base_dir):
+        if suffix is None or relative_filename.lower().endswith(suffix):
+            yield relative_filename
+
+
+def list_files(base_dir, suffix=None):
+    """
+    Returns the files in a queue folder as a list of paths relative to base_dir (see iter_files)
+    :param base_dir:
+    :param suffix:
+    :returns: list
+    """
+    return list(iter_files(base_dir, suffix))
+
+
+def count_files(base_dir, suffix=None):
+    """
+    Returns the number of files in a queue folder (see iter_files) without building a list
+    :param base_dir:
+    :param suffix:
+    :returns: int
+    """
+    count = 0
+    for relative_filename in iter_files(base_dir, suffix):
+        count += 1
+    return count
+
+
+def move_file(relative_filename, from_dir, to_dir):
+    """
+    Moves a file (given relative to from_dir, as returned by iter_files) to the same relative path in to_dir, creating the
+    shard subfolder if needed
+    :param relative_filename:
+    :param from_dir:
+    :param to_dir:
+    :returns: string (the new full filename)
+    """
+    to_filename = os.path.join(to_dir, relative_filename)
+    subdir = os.path.dirname(relative_filename)
+    if subdir:
+        make_dirs(os.path.join(to_dir, subdir))
+    shutil.move(os.path.join(from_dir, relative_filename), to_filename)
+    return to_filename
+
+
+def remove_empty_shards(base_dir):
+    """
+    Removes empty shard subfolders from hours before the previous hour (the current hour's folders may still be written to)
+    :param base_dir:
+    :returns: int (the number of folders removed)
+    """
+    oldest_open_hour = time.strftime('%Y%m%d%H', time.localtime(time.time() - 3600))
+    removed = 0
+    for hour in [name for name in iter_dir_names(base_dir) if HOUR_DIR_REGEX.match(name) and name < oldest_open_hour]:
+        hour_dir = os.path.join(base_dir, hour)
+        for hash_prefix in [name for name in iter_dir_names(hour_dir) if HASH_DIR_REGEX.match(name)]:
+            try:
+                os.rmdir(os.path.join(hour_dir, hash_prefix))
+                removed += 1
+            except OSError:
+                pass
+        try:
+            os.rmdir(hour_dir)
+            removed += 1
+        except OSError:
+            pass
+    return removed
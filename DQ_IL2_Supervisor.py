@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Supervisor.py
+
+DESCRIPTION:
+
+A supervised worker pool for DQ_IL2_Seq_Check (used when SUPERVISE_WORKERS is enabled), so that a single pathological
+file (huge, deeply nested, or hanging the parser) or a crashed worker cannot stall or stop a 500k file batch.
+
+It takes the place of the multiprocessing.Pool under the AutotuningExecutor (see DQ_IL2_Autotune.py). Each chunk of items
+is sent to an idle worker, which reports the result of each item as soon as it is done (and the start time of the item it
+is working on, in shared memory):
+- each item has a time budget, set per task function (e.g. XML_TASK_TIMEOUT_SECS for an xml, ZIP_TASK_TIMEOUT_SECS for a
+  zipfile). A worker over budget is killed and replaced, the item is handed to the timeout handler (which routes the file
+  to reject/ and returns its error result) and the rest of the chunk is sent to another worker
+- a worker which exits in the middle of a chunk (e.g. crashed) is handled in the same way
+- a worker is recycled (exits once idle and is replaced) after MAX_TASKS_PER_CHILD chunks, or once its memory is over
+  MAX_WORKER_MEMORY_MB
+The other workers carry on meanwhile. The timeouts, crashes and recycled workers are logged and counted (see take_counts).
+
+The results are sent one item at a time (rather than one chunk at a time, as by multiprocessing.Pool), so that none are
+lost when a worker is killed - this costs a little more IPC per item.
+"""
+
+import sys
+import time
+import threading
+import traceback
+import collections
+import multiprocessing
+
+from DQ_IL2_Autotune import task_cpu_secs
+
+POLL_SECS = 0.5
+
+
+def worker_memory_mb():
+    """
+    Returns the memory used by the current process in MB (the peak resident set size on Unix, the working set on
+    Windows), or None if it cannot be measured
+    :returns: float or None
+    """
+    if sys.platform == 'win32':
+        return windows_working_set_mb()
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux, in bytes on Mac OS X
+    return peak / 1048576.0 if sys.platform == 'darwin' else peak / 1024.0
+
+
+def windows_working_set_mb():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.WorkingSetSize / 1048576.0
+
+
+def supervised_worker(task_conn, result_conn, progress, slot, initializer, initargs, max_tasks, max_memory_mb):
+    """
+    The worker process loop - runs the chunks received on task_conn, sending each result on result_conn. Before each item,
+    its start time and index are written to progress[2 * slot] and progress[2 * slot + 1]
+    :param task_conn: receives (task id, func, items, offset) tuples, or None to exit
+    :param result_conn: sends a ('result', task id, index, result) message per item, then ('done', task id, cpu secs, wall
+                        secs, exit reason) or ('error', task id, formatted exception, exit reason) - the exit reason is
+                        None unless the worker is about to exit
+    :param progress: multiprocessing.Array shared with the supervisor
+    :param slot:
+    :param initializer: called with initargs when the worker starts
+    :param initargs:
+    :param max_tasks: the no. of chunks after which the worker exits (None to never exit)
+    :param max_memory_mb: the memory after which the worker exits (None for no limit)
+    :returns: None
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    task_count = 0
+    while True:
+        try:
+            task = task_conn.recv()
+        except (EOFError, IOError):
+            break
+        if task is None:
+            break
+        task_id, func, items, offset = task
+        start_wall = time.time()
+        start_cpu = task_cpu_secs()
+        error = None
+        for index, item in enumerate(items, offset):
+            progress[2 * slot + 1] = index
+            progress[2 * slot] = time.time()
+            try:
+                result = func(item)
+            except Exception:
+                error = traceback.format_exc()
+                break
+            result_conn.send(('result', task_id, index, result))
+        progress[2 * slot] = 0.0
+
+        task_count += 1
+        exit_reason = None
+        memory_mb = worker_memory_mb() if max_memory_mb else None
+        if max_tasks and task_count >= max_tasks:
+            exit_reason = '%s task(s) run' % (task_count)
+        elif memory_mb is not None and memory_mb > max_memory_mb:
+            exit_reason = 'memory %.0fMB over %sMB' % (memory_mb, max_memory_mb)
+
+        if error is not None:
+            result_conn.send(('error', task_id, error, exit_reason))
+        else:
+            result_conn.send(('done', task_id, task_cpu_secs() - start_cpu, time.time() - start_wall, exit_reason))
+        if exit_reason is not None:
+            break
+    result_conn.close()
+
+
+class SupervisedWorker(object):
+    """
+    A worker process, as seen by the supervisor
+    """
+
+    def __init__(self, slot, process, task_conn, result_conn):
+        self.slot = slot
+        self.process = process
+        self.task_conn = task_conn
+        self.result_conn = result_conn
+        self.reader_thread = None
+        self.segment = None
+        self.stopping = None
+
+    def idle(self):
+        return self.segment is None and self.stopping is None
+
+
+class SupervisedPool(object):
+    """
+    A process pool which supervises each item of each task (see the module description). It has the apply_chunk method
+    used by the AutotuningExecutor, and the close/join/terminate methods of multiprocessing.Pool
+    """
+
+    def __init__(self, processes, initializer=None, initargs=(), task_timeouts=None, timeout_handler=None,
+                 max_tasks_per_child=None, max_memory_mb=None, logger=None):
+        """
+        :param processes: the no. of worker processes
+        :param initializer: called with initargs in each worker when it starts
+        :param initargs:
+        :param task_timeouts: dict of task function to the time budget of each of its items in secs - items of other
+                              functions have no budget
+        :param timeout_handler: called with (func, item, reason) for an item which timed out (or whose worker exited) and
+                                returns its result - the item is left out of the results if None
+        :param max_tasks_per_child: the no. of chunks after which a worker is replaced (None to never replace)
+        :param max_memory_mb: the memory after which a worker is replaced (None for no limit)
+        :param logger:
+        """
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.task_timeouts = task_timeouts or {}
+        self.timeout_handler = timeout_handler
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_memory_mb = max_memory_mb
+        self.logger = logger
+        self.progress = multiprocessing.Array('d', 2 * processes, lock=False)
+        self.lock = threading.RLock()
+        self.pending = collections.deque()
+        self.tasks = {}
+        self.next_task_id = 0
+        self.counts = {'task timeouts': 0, 'worker crashes': 0, 'workers recycled': 0}
+        self.closed = False
+        self.stopped = threading.Event()
+        self.workers = [self._start_worker(slot) for slot in range(processes)]
+        self.supervisor_thread = threading.Thread(target=self._supervise, name='supervisor')
+        self.supervisor_thread.daemon = True
+        self.supervisor_thread.start()
+
+    def _start_worker(self, slot):
+        child_task_conn, task_conn = multiprocessing.Pipe(duplex=False)
+        result_conn, child_result_conn = multiprocessing.Pipe(duplex=False)
+        self.progress[2 * slot] = 0.0
+        process = multiprocessing.Process(target=supervised_worker,
+                                          args=(child_task_conn, child_result_conn, self.progress, slot, self.initializer, self.initargs,
+                                                self.max_tasks_per_child, self.max_memory_mb))
+        process.daemon = True
+        process.start()
+        # The worker's ends are closed here, so that the reader sees EOF as soon as the worker exits
+        child_task_conn.close()
+        child_result_conn.close()
+        worker = SupervisedWorker(slot, process, task_conn, result_conn)
+        worker.reader_thread = threading.Thread(target=self._read_results, args=(worker,), name='supervisor-reader-%s' % (slot))
+        worker.reader_thread.daemon = True
+        worker.reader_thread.start()
+        return worker
+
+    def _read_results(self, worker):
+        # Each worker's messages are handled by its own reader thread, as they arrive
+        while True:
+            try:
+                message = worker.result_conn.recv()
+            except (EOFError, IOError):
+                break
+            with self.lock:
+                self._handle(worker, message)
+                self._dispatch()
+        with self.lock:
+            self._worker_exited(worker)
+            self._dispatch()
+
+    def _log(self, level, message):
+        if self.logger is not None:
+            getattr(self.logger, level)(message)
+
+    def apply_chunk(self, func, items, callback):
+        """
+        Runs func on each item of a chunk, then calls callback with (list of results, cpu secs, wall secs, error, worker
+        pid) - the results are in any order and error is the formatted exception if func raised (see run_timed_task)
+        :param func: a module level function (it is pickled by reference)
+        :param items:
+        :param callback:
+        :returns: None
+        """
+        with self.lock:
+            if self.closed:
+                raise ValueError('Pool not running')
+            task_id = self.next_task_id
+            self.next_task_id += 1
+            self.tasks[task_id] = {'func': func, 'items': items, 'callback': callback, 'results': [], 'resolved': 0,
+                                   'cpu_secs': 0.0, 'wall_secs': 0.0, 'segments': 0}
+            self.pending.append((task_id, 0))
+            self._dispatch()
+
+    def _dispatch(self):
+        for worker in self.workers:
+            if not self.pending:
+                break
+            if not worker.idle():
+                continue
+            task_id, offset = self.pending.popleft()
+            task = self.tasks[task_id]
+            try:
+                worker.task_conn.send((task_id, task['func'], task['items'][offset:], offset))
+            except (IOError, OSError, ValueError):
+                # The worker has gone - its EOF is on its way, and the segment goes to another worker
+                self.pending.appendleft((task_id, offset))
+                worker.stopping = 'gone'
+                continue
+            worker.segment = {'task_id': task_id, 'next': offset, 'sent_at': time.time()}
+            task['segments'] += 1
+
+    def _supervise(self):
+        while not self.stopped.wait(POLL_SECS):
+            with self.lock:
+                self._check_timeouts()
+
+    def _handle(self, worker, message):
+        kind = message[0]
+        if kind == 'result':
+            task_id, index, result = message[1:]
+            task = self.tasks.get(task_id)
+            if task is not None:
+                task['results'].append(result)
+                task['resolved'] += 1
+                worker.segment['next'] = index + 1
+        elif kind == 'done':
+            task_id, cpu_secs, wall_secs, exit_reason = message[1:]
+            self._segment_done(worker, exit_reason)
+            task = self.tasks.get(task_id)
+            if task is not None:
+                task['cpu_secs'] += cpu_secs
+                task['wall_secs'] += wall_secs
+                task['segments'] -= 1
+                self._complete_if_done(task_id, worker)
+        elif kind == 'error':
+            task_id, error, exit_reason = message[1:]
+            self._segment_done(worker, exit_reason)
+            task = self.tasks.pop(task_id, None)
+            if task is not None:
+                task['callback']((task['results'], task['cpu_secs'], task['wall_secs'], error, worker.process.pid))
+
+    def _segment_done(self, worker, exit_reason):
+        worker.segment = None
+        if exit_reason is not None and worker.stopping is None:
+            worker.stopping = exit_reason
+            self.counts['workers recycled'] += 1
+            self._log('info', 'Supervisor: worker recycled (%s)' % (exit_reason))
+
+    def _complete_if_done(self, task_id, worker):
+        task = self.tasks[task_id]
+        if task['resolved'] >= len(task['items']) and not task['segments']:
+            del self.tasks[task_id]
+            task['callback']((task['results'], task['cpu_secs'], task['wall_secs'], None, worker.process.pid))
+
+    def _check_timeouts(self):
+        now = time.time()
+        for worker in self.workers:
+            if worker.segment is None or worker.stopping is not None or worker.segment['task_id'] not in self.tasks:
+                continue
+            task_timeout = self.task_timeouts.get(self.tasks[worker.segment['task_id']]['func'])
+            started_at = self.progress[2 * worker.slot]
+            if task_timeout and started_at and now - started_at > task_timeout:
+                worker.stopping = 'timed out after %s sec(s)' % (task_timeout)
+                self.counts['task timeouts'] += 1
+                worker.process.terminate()
+
+    def _worker_exited(self, worker):
+        """
+        Handles the exit of a worker (recycled, killed or crashed) once its results have all been read - the item it was
+        working on is handed to the timeout handler and the rest of its chunk is sent to another worker. The worker is
+        then replaced, unless the pool is closed
+        :param worker:
+        :returns: None
+        """
+        worker.process.join()
+        if worker.segment is not None and worker.segment['task_id'] in self.tasks:
+            task_id = worker.segment['task_id']
+            task = self.tasks[task_id]
+            task['segments'] -= 1
+            task['wall_secs'] += time.time() - worker.segment['sent_at']
+            reason = worker.stopping
+            if reason is None or reason == 'gone':
+                reason = 'worker exited (exit code %s)' % (worker.process.exitcode)
+                self.counts['worker crashes'] += 1
+            # The item the worker was working on, if it had not reported it
+            next_index = worker.segment['next']
+            if self.progress[2 * worker.slot] and int(self.progress[2 * worker.slot + 1]) == next_index:
+                item = task['items'][next_index]
+                self._log('warn', 'Supervisor: %s: %s' % (item, reason))
+                if self.timeout_handler is not None:
+                    task['results'].append(self.timeout_handler(task['func'], item, reason))
+                task['resolved'] += 1
+                next_index += 1
+            if next_index < len(task['items']):
+                self.pending.appendleft((task_id, next_index))
+            else:
+                self._complete_if_done(task_id, worker)
+        elif worker.stopping in (None, 'gone') and not self.closed:
+            self.counts['worker crashes'] += 1
+            self._log('warn', 'Supervisor: idle worker exited (exit code %s)' % (worker.process.exitcode))
+        worker.segment = None
+
+        if not self.closed:
+            self.workers[worker.slot] = self._start_worker(worker.slot)
+
+    def take_counts(self):
+        """
+        Returns the no. of items timed out, workers crashed and workers recycled since the last call
+        :returns: dict (task timeouts, worker crashes, workers recycled)
+        """
+        with self.lock:
+            counts = self.counts
+            self.counts = dict([(key, 0) for key in counts])
+            return counts
+
+    def close(self):
+        """
+        Stops the workers once they are idle - the tasks already submitted are completed
+        :returns: None
+        """
+        with self.lock:
+            self.closed = True
+        while True:
+            with self.lock:
+                if not self.tasks:
+                    for worker in self.workers:
+                        if worker.stopping is None:
+                            worker.stopping = 'closed'
+                            try:
+                                worker.task_conn.send(None)
+                            except (IOError, OSError, ValueError):
+                                pass
+                    return
+            time.sleep(0.1)
+
+    def join(self):
+        for worker in self.workers:
+            worker.reader_thread.join()
+            worker.process.join()
+        self.stopped.set()
+        self.supervisor_thread.join()
+
+    def terminate(self):
+        """
+        Stops the workers straight away - the tasks in progress are abandoned (their items are not handed to the timeout
+        handler)
+        :returns: None
+        """
+        with self.lock:
+            self.closed = True
+            self.tasks = {}
+            self.pending.clear()
+            for worker in self.workers:
+                worker.stopping = 'closed'
+                worker.process.terminate()
+        self.join()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_Synthetic_Workload.py
+
+DESCRIPTION:
+
+Generates a synthetic workload for load testing the DQ_IL2 pipeline offline:
+
+- RAW_/PARSED_/STORED_/FAILED_<yyyymmdd>_<hhmi>_<seq>.zip files as received in the FTP landing zone. The PARSED zipfiles hold
+  commonAPI xml messages - GA, commercial and unknown carrier API messages, PNR messages and malformed messages in the given
+  ratios, with a long tailed (lognormal) number of passengers per message. Sequences can be skipped at a given rate, to
+  exercise the sequence checks
+- NATS FPL json messages (FLIGHTPLAN, DEPARTURE, ARRIVAL, etc. as read by DQ_IL2_DB_GA_Postgres_Load_FPL)
+- the MDS carrier extract (mds/MDS_EXTRACT.csv, see DQ_IL2_MDS_Snapshot.py) matching the carrier codes used in the messages
+
+Usage:
+
+    python DQ_IL2_Synthetic_Workload.py -o <output folder> [-z <zipfiles per filetype>] [-m <messages per zip>]
+                                        [-g <GA ratio>] [-c <commercial ratio>] [-p <PNR ratio>] [-x <malformed ratio>]
+                                        [-q <sequence gap ratio>] [-s <random seed>]
+
+The zipfiles are written to <output folder>/FTP_landingzone/done, the FPL files to <output folder>/fpl and the MDS extract to
+<output folder>/mds (i.e. the folders used under ROOT_DIR). Messages which are not GA, commercial, PNR or malformed use
+unknown carrier codes.
+"""
+
+import os
+import sys
+import json
+import getopt
+import random
+import string
+import zipfile
+
+from DQ_IL2_MDS_Snapshot import MDSSnapshot
+
+PARSED_NS = 'http://www.ibm.com/semaphore/commonAPI/'
+
+FILETYPES = ['PARSED', 'RAW', 'STORED', 'FAILED']
+
+FPL_MESSAGETYPES = ['FLIGHTPLAN', 'DEPARTURE', 'ARRIVAL', 'DELAY', 'CHANGE', 'CANCELLATION']
+
+DEFAULT_SPEC = {'zipfiles_per_filetype': 10,
+                'messages_per_zip': 200,
+                'ga_ratio': 0.05,
+                'commercial_ratio': 0.75,
+                'pnr_ratio': 0.1,
+                'malformed_ratio': 0.01,
+                'seq_gap_ratio': 0.0,
+                'passengers_mu': 3.5,
+                'passengers_sigma': 1.0,
+                'fpl_messages': 100,
+                'filedate': '20171106',
+                'seed': 1}
+
+API_MESSAGE_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<commonAPIPlus xmlns="%(ns)s">'
+                        '<messageHeader><messageId>%(message_id)s</messageId><sourceSystem>S4</sourceSystem>'
+                        '<receivedDateTime>%(received)s</receivedDateTime></messageHeader>'
+                        '<APIData>'
+                        '<flightDetails><flightId>%(flight_id)s</flightId><direction>I</direction>'
+                        '<departureAirport>%(departure)s</departureAirport><arrivalAirport>LHR</arrivalAirport>'
+                        '<scheduledDepartureDateTime>%(received)s</scheduledDepartureDateTime></flightDetails>'
+                        '%(passengers)s'
+                        '</APIData>'
+                        '</commonAPIPlus>')
+
+PASSENGER_TEMPLATE = ('<passengerDetails><personType>P</personType><surname>SURNAME%(n)05d</surname>'
+                      '<givenNames>GIVEN NAMES %(n)05d</givenNames><dateOfBirth>1970-01-01</dateOfBirth><gender>M</gender>'
+                      '<nationality>GBR</nationality><document><documentType>P</documentType>'
+                      '<documentNo>%(n)09d</documentNo><expiryDate>2030-01-01</expiryDate><issuingState>GBR</issuingState>'
+                      '</document><seatNumber>%(seat)s</seatNumber></passengerDetails>')
+
+PNR_MESSAGE_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<commonAPIPlus xmlns="%(ns)s">'
+                        '<messageHeader><messageId>%(message_id)s</messageId><sourceSystem>S4</sourceSystem>'
+                        '<receivedDateTime>%(received)s</receivedDateTime></messageHeader>'
+                        '<PNRData><bookingReference>%(booking)s</bookingReference>%(passengers)s</PNRData>'
+                        '</commonAPIPlus>')
+
+
+def build_api_message(message_id, flight_id, no_of_passengers, received='2017-11-06T12:00:00'):
+    """
+    Returns a commonAPI API message with the given flightId and number of passengers
+    :param message_id:
+    :param flight_id:
+    :param no_of_passengers:
+    :param received:
+    :returns: string
+    """
+    passengers = ''.join([PASSENGER_TEMPLATE % {'n': n, 'seat': '%s%s' % (n % 60 + 1, 'ABCDEF'[n % 6])} for n in range(no_of_passengers)])
+    return API_MESSAGE_TEMPLATE % {'ns': PARSED_NS, 'message_id': message_id, 'flight_id': flight_id, 'departure': 'CDG',
+                                   'received': received, 'passengers': passengers}
+
+
+def build_pnr_message(message_id, no_of_passengers, received='2017-11-06T12:00:00'):
+    """
+    Returns a commonAPI PNR message (i.e. no APIData element) with the given number of passengers
+    :param message_id:
+    :param no_of_passengers:
+    :param received:
+    :returns: string
+    """
+    passengers = ''.join([PASSENGER_TEMPLATE % {'n': n, 'seat': ''} for n in range(no_of_passengers)])
+    return PNR_MESSAGE_TEMPLATE % {'ns': PARSED_NS, 'message_id': message_id, 'booking': 'ABC%03d' % (message_id % 1000),
+                                   'received': received, 'passengers': passengers}
+
+
+def random_passenger_count(rnd, mu=3.5, sigma=1.0):
+    """
+    Returns a passenger count following a long tailed distribution (mostly small GA/short haul, some wide-body flights)
+    :param rnd:
+    :param mu:
+    :param sigma:
+    :returns: int
+    """
+    return max(1, min(500, int(rnd.lognormvariate(mu, sigma))))
+
+
+def random_carrier_codes(rnd, length, count):
+    """
+    Returns a list of unique random carrier codes of the given length
+    """
+    codes = set()
+    while len(codes) < count:
+        codes.add(''.join([rnd.choice(string.ascii_uppercase) for i in range(length)]))
+    return sorted(codes)
+
+
+def random_carriers(rnd, scale=1):
+    """
+    Returns MDS carrier codes by code standard, roughly the size of the MDS carriers view when scale is 1
+    :param rnd:
+    :param scale:
+    :returns: dict
+    """
+    iata_codes = random_carrier_codes(rnd, 2, 600 * scale)
+    icao_codes = random_carrier_codes(rnd, 3, 4000 * scale)
+    rnd.shuffle(iata_codes)
+    rnd.shuffle(icao_codes)
+    return {'IATA': iata_codes[:150 * scale], 'COMMERCIAL_IATA': iata_codes[150 * scale:],
+            'ICAO': icao_codes[:2500 * scale], 'COMMERCIAL_ICAO': icao_codes[2500 * scale:]}
+
+
+def random_flight_id(rnd, codes):
+    """
+    Returns a flightId for a carrier code (chosen from codes), e.g. BA1234 or BAW123
+    :param rnd:
+    :param codes:
+    :returns: string
+    """
+    code = rnd.choice(codes)
+    return '%s%s' % (code, rnd.randint(1, 9999 if len(code) == 2 else 999))
+
+
+def random_unknown_flight_id(rnd, known_codes):
+    """
+    Returns a flightId with a carrier code which is not in the MDS carriers
+    :param rnd:
+    :param known_codes: set of the MDS carrier codes
+    :returns: string
+    """
+    while True:
+        code = ''.join([rnd.choice(string.ascii_uppercase) for i in range(rnd.choice([2, 3]))])
+        if code not in known_codes:
+            return '%s%s' % (code, rnd.randint(1, 999))
+
+
+def build_parsed_zip_messages(rnd, spec, carriers, first_message_id):
+    """
+    Returns the messages of a PARSED zipfile, and the count of each message class
+    :param rnd:
+    :param spec:
+    :param carriers:
+    :param first_message_id:
+    :returns: list of (member name, data), dict of message class to count
+    """
+    ga_codes = carriers['IATA'] + carriers['ICAO']
+    commercial_codes = carriers['COMMERCIAL_IATA'] + carriers['COMMERCIAL_ICAO']
+    known_codes = set(ga_codes + commercial_codes)
+    ga_bound = spec['ga_ratio']
+    commercial_bound = ga_bound + spec['commercial_ratio']
+    pnr_bound = commercial_bound + spec['pnr_ratio']
+    malformed_bound = pnr_bound + spec['malformed_ratio']
+
+    messages = []
+    counts = {'GA': 0, 'COMMERCIAL': 0, 'UNKNOWN': 0, 'PNR': 0, 'MALFORMED': 0}
+    for message_id in range(first_message_id, first_message_id + spec['messages_per_zip']):
+        no_of_passengers = random_passenger_count(rnd, spec['passengers_mu'], spec['passengers_sigma'])
+        r = rnd.random()
+        if r < ga_bound:
+            message_class = 'GA'
+            # Some GA flights are reported with a "_GA" flightId rather than a GA carrier code
+            flight_id = '_GA%s' % (message_id) if rnd.random() < 0.3 else random_flight_id(rnd, ga_codes)
+            data = build_api_message(message_id, flight_id, no_of_passengers)
+        elif r < commercial_bound:
+            message_class = 'COMMERCIAL'
+            data = build_api_message(message_id, random_flight_id(rnd, commercial_codes), no_of_passengers)
+        elif r < pnr_bound:
+            message_class = 'PNR'
+            data = build_pnr_message(message_id, no_of_passengers)
+        elif r < malformed_bound:
+            message_class = 'MALFORMED'
+            # Truncated before the flightId, i.e. cannot be classified (and is rejected)
+            data = build_api_message(message_id, random_flight_id(rnd, commercial_codes), no_of_passengers)
+            data = data[:rnd.randint(1, data.index('<flightId>'))]
+        else:
+            message_class = 'UNKNOWN'
+            data = build_api_message(message_id, random_unknown_flight_id(rnd, known_codes), no_of_passengers)
+        counts[message_class] += 1
+        messages.append(('%s/%s_%08d.xml' % (spec['filedate'], spec['filedate'], message_id), data))
+    return messages, counts
+
+
+def build_raw_zip_messages(rnd, spec, first_message_id):
+    """
+    Returns the (EDIFACT-like) raw messages of a RAW, STORED or FAILED zipfile
+    :param rnd:
+    :param spec:
+    :param first_message_id:
+    :returns: list of (member name, data)
+    """
+    messages = []
+    for message_id in range(first_message_id, first_message_id + spec['messages_per_zip']):
+        segments = ["UNA:+.? '", "UNB+UNOA:4+AIRLINE+UKBA+171106:1200+%08d'" % (message_id)]
+        for n in range(random_passenger_count(rnd, spec['passengers_mu'], spec['passengers_sigma'])):
+            segments.append("NAD+FL+++SURNAME%05d:GIVEN NAMES %05d'DOC+P:110:111+%09d'" % (n, n, n))
+        segments.append("UNZ+1+%08d'" % (message_id))
+        messages.append(('%s_%08d.txt' % (spec['filedate'], message_id), ''.join(segments)))
+    return messages
+
+
+def write_zipfile(filename, messages):
+    """
+    Writes the messages to a zipfile, via a ".part" file so the pipeline never picks up a partially written zipfile
+    :param filename:
+    :param messages: list of (member name, data)
+    :returns: int (the zipfile size in bytes)
+    """
+    part_filename = filename + '.part'
+    zf = zipfile.ZipFile(part_filename, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        for member_name, data in messages:
+            zf.writestr(member_name, data)
+    finally:
+        zf.close()
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(part_filename, filename)
+    return os.path.getsize(filename)
+
+
+def generate_zipfiles(landing_zone, spec, carriers, rnd):
+    """
+    Writes zipfiles_per_filetype zipfiles of each filetype to the landing zone, skipping sequences at seq_gap_ratio
+    :param landing_zone:
+    :param spec:
+    :param carriers:
+    :param rnd:
+    :returns: dict (zipfiles, bytes, skipped sequences and the count of each message class)
+    """
+    summary = {'zipfiles': 0, 'bytes': 0, 'messages': 0, 'skipped_sequences': 0,
+               'GA': 0, 'COMMERCIAL': 0, 'UNKNOWN': 0, 'PNR': 0, 'MALFORMED': 0}
+    message_id = 1
+    for filetype in FILETYPES:
+        seq = 0
+        for n in range(spec['zipfiles_per_filetype']):
+            seq += 1
+            while spec['seq_gap_ratio'] and rnd.random() < spec['seq_gap_ratio']:
+                seq += 1
+                summary['skipped_sequences'] += 1
+            hhmi = '%02d%02d' % ((n // 60) % 24, n % 60)
+            filename = os.path.join(landing_zone, '%s_%s_%s_%04d.zip' % (filetype, spec['filedate'], hhmi, seq % 10000))
+
+            if filetype == 'PARSED':
+                messages, counts = build_parsed_zip_messages(rnd, spec, carriers, message_id)
+                for message_class, count in counts.items():
+                    summary[message_class] += count
+                summary['messages'] += len(messages)
+            else:
+                messages = build_raw_zip_messages(rnd, spec, message_id)
+            message_id += len(messages)
+
+            summary['bytes'] += write_zipfile(filename, messages)
+            summary['zipfiles'] += 1
+    return summary
+
+
+def build_fpl_message(rnd, message_id, flight_id):
+    """
+    Returns a NATS FPL json message
+    :param rnd:
+    :param message_id:
+    :param flight_id:
+    :returns: string
+    """
+    messagetype = rnd.choice(FPL_MESSAGETYPES)
+    aerodromes = ['EGLL', 'EGKK', 'EGSS', 'EGGW', 'LFPG', 'EHAM', 'EDDF', 'LEMD']
+    message = {'X400Message': {'envelope': {'submissionTime': '2017-11-06T12:00:00Z', 'messageDeliveryTime': '2017-11-06T12:00:01Z'}},
+               messagetype: {'ADEP': rnd.choice(aerodromes), 'ADES': rnd.choice(aerodromes), 'CALLSIGN': flight_id,
+                             'DOF': '171106', 'EOBD': '171106', 'EOBT': '%02d%02d' % (rnd.randint(0, 23), rnd.randint(0, 59)),
+                             'TYPE': rnd.choice(['G', 'N', 'S']), 'IFPLID': 'AA%08d' % (message_id),
+                             'REG': 'G%s' % (''.join([rnd.choice(string.ascii_uppercase) for i in range(4)])),
+                             'TITLE': messagetype[:3], 'CONTENT': '(FPL-%s-IG -C525/L-SDFGRY/S)' % (flight_id)}}
+    return json.dumps(message)
+
+
+def generate_fpl_files(fpl_dir, spec, carriers, rnd):
+    """
+    Writes fpl_messages NATS FPL json files (named as received from NATS)
+    :param fpl_dir:
+    :param spec:
+    :param carriers:
+    :param rnd:
+    :returns: int (the number of files written)
+    """
+    ga_codes = carriers['IATA'] + carriers['ICAO']
+    for message_id in range(1, spec['fpl_messages'] + 1):
+        flight_id = random_flight_id(rnd, ga_codes)
+        mtcu = ''.join([rnd.choice(string.ascii_uppercase + string.digits) for i in range(16)])
+        with open(os.path.join(fpl_dir, '[-PRMD=EG-ADMD=ICAO-C=XX-;MTA-EGGG-1-MTCU_%s].json' % (mtcu)), 'wb') as f:
+            f.write(build_fpl_message(rnd, message_id, flight_id))
+    return spec['fpl_messages']
+
+
+def make_dir(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def generate_workload(output_dir, spec=None):
+    """
+    Writes the zipfiles, FPL files and MDS extract for a workload (see the module description)
+    :param output_dir: the ROOT_DIR of the test environment
+    :param spec: dict of settings overriding DEFAULT_SPEC
+    :returns: dict (a summary of what was written)
+    """
+    workload_spec = dict(DEFAULT_SPEC)
+    workload_spec.update(spec or {})
+    rnd = random.Random(workload_spec['seed'])
+
+    carriers = random_carriers(rnd)
+    MDSSnapshot(carriers).write_csv_extract(os.path.join(make_dir(os.path.join(output_dir, 'mds')), 'MDS_EXTRACT.csv'))
+
+    summary = generate_zipfiles(make_dir(os.path.join(output_dir, 'FTP_landingzone', 'done')), workload_spec, carriers, rnd)
+    summary['fpl_files'] = generate_fpl_files(make_dir(os.path.join(output_dir, 'fpl')), workload_spec, carriers, rnd)
+    return summary
+
+
+def main(argv):
+    output_dir = None
+    spec = {}
+    options = {'-z': ('zipfiles_per_filetype', int), '-m': ('messages_per_zip', int), '-g': ('ga_ratio', float),
+               '-c': ('commercial_ratio', float), '-p': ('pnr_ratio', float), '-x': ('malformed_ratio', float),
+               '-q': ('seq_gap_ratio', float), '-s': ('seed', int)}
+
+    try:
+        opts, args = getopt.getopt(argv, "o:z:m:g:c:p:x:q:s:")
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-o':
+            output_dir = arg
+        else:
+            key, convert = options[opt]
+            spec[key] = convert(arg)
+
+    if not output_dir:
+        print __doc__
+        sys.exit(2)
+
+    summary = generate_workload(output_dir, spec)
+    print 'Zipfiles: %s (%.1f MB), sequences skipped: %s' % (summary['zipfiles'], summary['bytes'] / 1048576.0, summary['skipped_sequences'])
+    print 'PARSED messages: %s (%s)' % (summary['messages'], ', '.join(['%s %s' % (summary[message_class], message_class)
+                                                                        for message_class in ['GA', 'COMMERCIAL', 'UNKNOWN', 'PNR', 'MALFORMED']]))
+    print 'FPL files: %s' % (summary['fpl_files'])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+DQ_IL2_XML_Classifier.py
+
+DESCRIPTION:
+
+Classifies commonAPI messages for DQ_IL2_Seq_Check without building the full element tree.
+
+Only two facts are needed from each message:
+- whether the root element has an {ns}APIData child (API message) or not (PNR message)
+- the text of the {ns}APIData/{ns}flightDetails/{ns}flightId element(s)
+
+        #<commonAPIPlus>
+        #    <APIData>
+        #        <flightDetails>
+        #            <flightId>XXX_GA</flightId>
+        #        </flightDetails>
+        #        ... passenger details (the bulk of the message) ...
+        #    </APIData>
+        #</commonAPIPlus>
+
+The message is read incrementally (iterparse) using the fastest C parser available - the flightIds are taken from every
+flightDetails element of every APIData element (as the full parse does), and everything else is only read through (nothing
+is kept), so the whole message is still checked to be well-formed. Elements are cleared as they are read so memory stays
+flat for large messages.
+
+If the incremental parse fails, the message is re-parsed in full with xml.etree.ElementTree, so that malformed messages
+(including those only malformed after the flightDetails element) raise the same exception, and are rejected in the same
+way, as before.
+"""
+
+import io
+
+try:
+    import xml.etree.cElementTree as fast_ET
+except ImportError:
+    import xml.etree.ElementTree as fast_ET
+import xml.etree.ElementTree as ET
+
+PARSER_BACKEND = fast_ET.__name__
+
+
+def classify_xml_file(filename, parsed_ns):
+    """
+    Returns whether the message is an API message and the flightIds found in its APIData/flightDetails elements
+    :param filename:
+    :param parsed_ns: the commonAPI namespace, e.g. http://www.ibm.com/semaphore/commonAPI/
+    :returns: bool, list
+    """
+    with open(filename, 'rb') as f:
+        return _classify_file(f, parsed_ns)
+
+
+def classify_xml_string(data, parsed_ns):
+    """
+    Returns whether the message is an API message and the flightIds found in its APIData/flightDetails elements
+    :param data: the message as read from a zipfile member
+    :param parsed_ns: the commonAPI namespace, e.g. http://www.ibm.com/semaphore/commonAPI/
+    :returns: bool, list
+    """
+    return _classify_file(io.BytesIO(data), parsed_ns)
+
+
+def _classify_file(f, parsed_ns):
+    """
+    Incrementally parses the open file, falling back to a full parse on error
+    :param f:
+    :param parsed_ns:
+    :returns: bool, list
+    """
+    start_pos = f.tell()
+    try:
+        return _iterparse_classify(f, parsed_ns)
+    except Exception:
+        f.seek(start_pos)
+        return _tree_classify(ET.parse(f).getroot(), parsed_ns)
+
+
+def _iterparse_classify(f, parsed_ns):
+    """
+    Reads the message with iterparse, taking the flightIds of every flightDetails element of every APIData element - the
+    rest of the message is read through without being kept, so a malformed message still raises
+    :param f:
+    :param parsed_ns:
+    :returns: bool, list
+    """
+    api_tag = '{%s}APIData' % (parsed_ns)
+    flight_details_tag = '{%s}flightDetails' % (parsed_ns)
+    flight_id_tag = '{%s}flightId' % (parsed_ns)
+
+    is_api = False
+    in_api = False
+    in_flight_details = False
+    flight_ids = []
+    depth = 0
+    root = None
+    parent = None
+
+    for event, elem in fast_ET.iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = elem
+            elif depth == 2:
+                parent = elem
+                if elem.tag == api_tag:
+                    is_api = True
+                    in_api = True
+            elif depth == 3 and in_api and elem.tag == flight_details_tag:
+                in_flight_details = True
+        else:
+            if depth == 4 and in_flight_details and elem.tag == flight_id_tag:
+                if elem.text is not None:
+                    flight_ids.append(elem.text.strip())
+            elif depth == 3:
+                in_flight_details = False
+                elem.clear()
+                del parent[:]
+            elif depth == 2:
+                in_api = False
+                root.clear()
+            elif depth > 3:
+                elem.clear()
+            depth -= 1
+
+    return is_api, flight_ids
+
+
+def _tree_classify(root, parsed_ns):
+    """
+    Classifies an already parsed message in the same way as DQ_IL2_Seq_Check.mp_parse_xml did
+    :param root:
+    :param parsed_ns:
+    :returns: bool, list
+    """
+    api_xml_path = '{%s}APIData' % (parsed_ns)
+    flight_id_xml_path = api_xml_path + '/{%s}flightDetails/{%s}flightId' % (parsed_ns, parsed_ns)
+
+    if not len(root.findall(api_xml_path)):
+        return False, []
+    return True, [flightId.text.strip() for flightId in root.findall(flight_id_xml_path) if flightId.text is not None]
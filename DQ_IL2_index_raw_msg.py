@@ -12,57 +12,85 @@
 #
 # - Indexes raw files in a csv (guid, filepath, zipfile, filename)
 # - GPLOADs the files into the load_raw_message_guid table in GP
+# - With LOAD_BACKEND = copy, the index rows are streamed with COPY (in chunks of COPY_CHUNK_ROWS rows) into a temporary
+#   table while the zipfiles are indexed, then loaded into GP_LOAD_TABLE with TRUNCATE and INSERT ... SELECT in one
+#   transaction, instead - no csv is written and gpload.py is not run (see DQ_IL2_Copy_Loader.py).  The table is only
+#   locked (ACCESS EXCLUSIVE, by the TRUNCATE) while the rows are inserted, and the database is only connected to when the
+#   first chunk is sent.  Unlike gpload, which tolerates up to 6 bad rows (ERROR_LIMIT: 6 in
+#   gpload_load_raw_message_guid.yml, written to the error table), COPY fails the whole load on a single bad row - it is
+#   rolled back and the zipfiles are left for the next run.  If psycopg2 is not installed or the database cannot be
+#   reached, the rows are written to the csv and gpload is used
 # - Due to an issue with the GPLOAD command intermittently hanging, logic was introduced to have an upper limit on the
-#   subprocess (gpload.py).  This subprocess time limit can be configured DQ_IL2_Config.ini.  Parameters are as follows:
+#   subprocess (gpload.py).  This subprocess time limit can be configured DQ_IL2_Config.ini.  The batch file is run under
+#   DQ_IL2_Loader_Supervisor.py, which waits on the process directly, tails the gpload last-run log and kills the whole
+#   process group once it has run for GPLOAD_MAX_RUNTIME_SECS.  Parameters are as follows:
 #
 #    LOG_DIR                     <log directory for gpload and subprocess scripts>
 #    SCRIPTS_DIR                 <.py scripts directory>
 #    SOURCE_FILE_DIR             <RAW zipfile directory>
 #    RAW_MESSAGE_GUID_CSV_DIR    <Directory to generate the csv>
 #    RAW_DONE_PATH               <File index done full file path>
-#    LOG_FREQUENCY               <Frequency to log the polling of the process to find if it has completed>
-#    SLEEPTIME                   <Time to sleep in sec(s) when polling the success/failure of gpload.py>
+#    LOG_FREQUENCY               <Log that gpload.py is still running every LOG_FREQUENCY * SLEEPTIME sec(s)>
+#    SLEEPTIME                   <Time to sleep in sec(s) between retries of gpload.py>
 #    GPLOAD_MAX_RUNTIME_SECS     <gpload.py threshold>
 #    GPLOAD_RETRIES              <no. of retries for running the gpload.py script>
 #    DOS_BATCH_FILE              <the batch file which runs gpload.py>
+#    LOAD_BACKEND                <gpload (default) or copy>
+#    GP_HOST, GP_PORT, GP_DB, GP_USER  <the Greenplum database loaded by the copy backend>
+#    GP_LOAD_TABLE               <the table loaded by the copy backend (default: stage.load_raw_message_guid)>
+#    COPY_CHUNK_ROWS             <no. of rows sent per COPY by the copy backend (default: 10000)>
 #
 ##############################################################################################################################
 
 ### IMPORT PYTHON MODULES ####################################################################################################
 from __future__ import with_statement
-import os, zipfile, re, time, sys, shutil, fileinput, datetime, ConfigParser, subprocess, boto3
+import os, zipfile, re, time, sys, shutil, fileinput, datetime, ConfigParser, boto3
+import DQ_IL2_Loader_Supervisor
+from DQ_IL2_Copy_Loader import CopyStreamLoader, DEFAULT_CHUNK_ROWS
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
 
 #from datetime import datetime
 
 ### GLOBAL VARIABLES #########################################################################################################
 YYYYMMDDSTR = time.strftime("%Y%m%d")
 YYYYMMDDHHMISSSTR = time.strftime("%Y%m%d%H%M%S")
+RAW_MESSAGE_GUID_COLUMNS = ['guid', 'zipfile', 'filepath', 'filename'] # In the order of the csv (see gpload_load_raw_message_guid.yml)
 ##############################################################################################################################
 
 def add_raw_index_entry(log_obj, filepath, guid, zipfile, filename):
     log_obj.write(guid + ',' + zipfile + ',' + filepath + ',' + filename + '\n')
 
-def process_is_running(pid, name):
-    a = os.popen("tasklist").readlines()
-    for line in a:
-          try:
-              TASKLIST_PID = int(line[29:34])
-          except:
-              TASKLIST_PID = None
-          try:
-              TASKLIST_NAME = line[0:7]
-          except:
-              TASKLIST_NAME = None
-          if TASKLIST_PID is not None and TASKLIST_NAME is not None:
-              if int(TASKLIST_PID) == int(pid) and TASKLIST_NAME.strip() == name.strip():
-                  return True
-    return False
-
 def add_log_entry(log_summary, log_msg):
     curr_time = time.strftime("%Y%m%d%H%M%S")
     if DEBUG: print curr_time + '\t' + log_summary.ljust(28,' ') + '\t' + log_msg
     LOGFILE.write(curr_time + '\t' + log_summary.ljust(28,' ') + '\t' + log_msg + '\n')
 
+# Connects to the database (copy backend), retrying DB_CONNECT_RETRIES times - the last error is raised
+def connect_to_database(CONN_STRING, DB_CONNECT_RETRIES, DB_CONNECT_RETRY_DELAY):
+    RETRY_COUNT=0
+    while True: # connect to the database a retry
+        try:
+            conn = psycopg2.connect(CONN_STRING)
+            add_log_entry('CONNECTING TO DATABASE', 'Connection successful')
+            return conn
+        except Exception, e:
+            if RETRY_COUNT<DB_CONNECT_RETRIES:
+                RETRY_COUNT+=1
+                add_log_entry('CONNECTING TO DATABASE', 'Connection failed... retrying attempt ' + str(RETRY_COUNT) + ' of ' + str(DB_CONNECT_RETRIES) )
+                time.sleep(DB_CONNECT_RETRY_DELAY) # Delay for n seconds between connection retries
+            else:
+                raise
+
+# Opens the csv loaded by gpload - with the rows buffered by the copy backend (if given), when it falls back to gpload
+def open_raw_file_index(RAW_MESSAGE_GUID_CSV_DIR, LOADER=None):
+    RAW_FILE_INDEX_LOGFILE = open(RAW_MESSAGE_GUID_CSV_DIR + 'raw_message_guid.csv', 'wb')
+    if LOADER is not None:
+        LOADER.write_pending(RAW_FILE_INDEX_LOGFILE)
+    return RAW_FILE_INDEX_LOGFILE
+
 def main(argv):
 
     ### GLOBAL DEBUG VARIABLE### #################################################################################################
@@ -75,7 +103,6 @@ def main(argv):
     CONFIG_FILE='DQ_IL2_Config.ini'
     DEFAULT_SECTION='DEFAULT'
     CUSTOM_SECTION='DQ_IL2_index_raw_msg'
-    GPLOAD_PROCESS_NAME='cmd.exe' # The tasklist name which runs the gpload.py process
 
     config = ConfigParser.ConfigParser()
     config.read(CONFIG_FILE)
@@ -92,6 +119,15 @@ def main(argv):
     DOS_BATCH_FILE              = config.get(CUSTOM_SECTION,'DOS_BATCH_FILE')
     s3                          = boto3.client('s3')
     BUCKET_NAME                 = str(config.get(CUSTOM_SECTION,'BUCKET_NAME'))
+    LOAD_BACKEND                = config.get(CUSTOM_SECTION,'LOAD_BACKEND').strip().lower() if config.has_option(CUSTOM_SECTION,'LOAD_BACKEND') else 'gpload'
+    GP_HOST                     = config.get(CUSTOM_SECTION,'GP_HOST') if config.has_option(CUSTOM_SECTION,'GP_HOST') else ''
+    GP_PORT                     = config.get(CUSTOM_SECTION,'GP_PORT') if config.has_option(CUSTOM_SECTION,'GP_PORT') else '5432'
+    GP_DB                       = config.get(CUSTOM_SECTION,'GP_DB') if config.has_option(CUSTOM_SECTION,'GP_DB') else ''
+    GP_USER                     = config.get(CUSTOM_SECTION,'GP_USER') if config.has_option(CUSTOM_SECTION,'GP_USER') else ''
+    GP_LOAD_TABLE               = config.get(CUSTOM_SECTION,'GP_LOAD_TABLE') if config.has_option(CUSTOM_SECTION,'GP_LOAD_TABLE') else 'stage.load_raw_message_guid'
+    COPY_CHUNK_ROWS             = int(config.get(CUSTOM_SECTION,'COPY_CHUNK_ROWS')) if config.has_option(CUSTOM_SECTION,'COPY_CHUNK_ROWS') else DEFAULT_CHUNK_ROWS
+    DB_CONNECT_RETRIES          = int(config.get(DEFAULT_SECTION,'DB_CONNECT_RETRIES'))
+    DB_CONNECT_RETRY_DELAY      = int(config.get(DEFAULT_SECTION,'DB_CONNECT_RETRY_DELAY'))
 
 
     ### LOG FILE VARIABLES #######################################################################################################
@@ -101,8 +137,25 @@ def main(argv):
     LOGFILE.write('\n--------------------------------------------------------------------\n')
     add_log_entry('*** RUN START ***',os.path.basename(sys.argv[0]))
     LOGFILE.write('--------------------------------------------------------------------\n')
-    RAW_FILE_INDEX_NAME=RAW_MESSAGE_GUID_CSV_DIR + 'raw_message_guid.csv'
-    RAW_FILE_INDEX_LOGFILE = open(RAW_FILE_INDEX_NAME, 'wb')
+
+    ##############################################################################################################################
+    # Set up the COPY stream (copy backend) - the database is connected to when the first chunk is sent
+    ##############################################################################################################################
+    LOADER=None
+    if LOAD_BACKEND == 'copy':
+        if psycopg2 is None:
+            add_log_entry('LOAD BACKEND','psycopg2 is not installed, using gpload')
+        else:
+            CONN_STRING='host='+GP_HOST+' port='+GP_PORT+' dbname='+GP_DB+' user='+GP_USER
+            add_log_entry('CONNECTING TO DATABASE', 'Connecting to '+GP_HOST+' as '+GP_USER+' with the first '+str(COPY_CHUNK_ROWS)+' row(s)')
+            LOADER = CopyStreamLoader(lambda: connect_to_database(CONN_STRING, DB_CONNECT_RETRIES, DB_CONNECT_RETRY_DELAY),
+                                      GP_LOAD_TABLE, RAW_MESSAGE_GUID_COLUMNS, COPY_CHUNK_ROWS, truncate=True)
+    elif LOAD_BACKEND != 'gpload':
+        add_log_entry('LOAD BACKEND','Unknown LOAD_BACKEND ' + LOAD_BACKEND + ', using gpload')
+
+    RAW_FILE_INDEX_LOGFILE=None
+    if LOADER is None:
+        RAW_FILE_INDEX_LOGFILE = open_raw_file_index(RAW_MESSAGE_GUID_CSV_DIR)
 
     ##############################################################################################################################
     # Index RAW zip files
@@ -129,7 +182,20 @@ def main(argv):
                             if compressed_file.upper().endswith('.TXT'):
                                manifest_guid=re.split("_",os.path.basename(compressed_file))[1]
                                FILE_COUNT+=1
-                               add_raw_index_entry(RAW_FILE_INDEX_LOGFILE,filename,manifest_guid,'s4/raw/' + date_key_format + filename,compressed_file)
+                               if LOADER is not None:
+                                   try:
+                                       LOADER.add_row((manifest_guid,'s4/raw/' + date_key_format + filename,filename,compressed_file))
+                                   except Exception, e:
+                                       if LOADER.connected():
+                                           add_log_entry('COPY FAILED',str(e))
+                                           LOADER.rollback()
+                                           sys.exit(1)
+                                       # The database could not be reached - the rows buffered so far are written to the csv
+                                       add_log_entry('CONNECTING TO DATABASE', 'ERROR: ' + str(e) + ', using gpload')
+                                       RAW_FILE_INDEX_LOGFILE = open_raw_file_index(RAW_MESSAGE_GUID_CSV_DIR, LOADER)
+                                       LOADER = None
+                               else:
+                                   add_raw_index_entry(RAW_FILE_INDEX_LOGFILE,filename,manifest_guid,'s4/raw/' + date_key_format + filename,compressed_file)
                         add_log_entry('INDEXING','INDEXED ' + str(FILE_COUNT) + ' files from ' + filename )
                         zip.close()
                else:
@@ -139,113 +205,48 @@ def main(argv):
        add_log_entry('INDEXING','No source files')
 
     ##############################################################################################################################
-    # Run batch file
+    # Send the last chunk, then load GP_LOAD_TABLE with TRUNCATE and INSERT ... SELECT (copy backend)
+    ##############################################################################################################################
+    if LOADER is not None:
+        print '\n*** Commit the load of ' + GP_LOAD_TABLE
+        try:
+            LOADER.commit()
+        except Exception, e:
+            if LOADER.connected():
+                add_log_entry('COPY FAILED',str(e))
+                LOADER.rollback()
+                sys.exit(1)
+            # The database could not be reached - the rows are written to the csv
+            add_log_entry('CONNECTING TO DATABASE', 'ERROR: ' + str(e) + ', using gpload')
+            RAW_FILE_INDEX_LOGFILE = open_raw_file_index(RAW_MESSAGE_GUID_CSV_DIR, LOADER)
+            LOADER = None
+        else:
+            add_log_entry('COPY',str(LOADER.row_count) + ' row(s) loaded into ' + GP_LOAD_TABLE + ' in ' + str(LOADER.chunk_count) + ' chunk(s) (' + '%.3f' % LOADER.copy_secs + ' sec(s))')
+            LOADER.close()
+
+    ##############################################################################################################################
+    # Run batch file (gpload backend)
     ##############################################################################################################################
-    print '\n*** Run the batch file: ' + DOS_BATCH_FILE
-    add_log_entry('GPLOAD',DOS_BATCH_FILE)
-    LAST_RUN_LOGFILE_NAME=os.path.join(LOG_DIR,'gpload_raw_msg_guid_ext_ctrl_doc_last_run.log')
-
-    RAW_FILE_INDEX_LOGFILE.close()
-    os.system("cd " + SCRIPTS_DIR)
-
-
-    ATTEMPT_NO=1
-    GPLOAD_SUCCEEDED=False
-    GPLOAD_FAILED=False
-
-    for i in range(GPLOAD_RETRIES):
-
-      add_log_entry('GPLOAD (Run ' + str(ATTEMPT_NO)+')','Starting GPLOAD')
-      open(LAST_RUN_LOGFILE_NAME,'wb').close() # open and clear the last run log file
-      PROCESS_STARTTIME=datetime.datetime.now()
-
-      # Start the GPLOAD process
-      try:
-          s=subprocess.Popen(DOS_BATCH_FILE, shell=False, stderr=False, stdout=False)
-      except Exception, e:
-          add_log_entry('ERROR RUNNING BATCH FILE',str(e))
-          sys.exit(1)
-
-      PID=s.pid
-
-      add_log_entry('','PID ('+str(PID)+') has been started')
-
-      ELAPSED_TIME=None
-      COUNTER=0
-
-      # Loop until:
-      # - The script succeeds
-      # - The script fails
-      # - The script exceeds the max threshold parameter
-      while True:
-
-            if process_is_running(PID, GPLOAD_PROCESS_NAME) and COUNTER % LOG_FREQUENCY == 0:
-                add_log_entry('','PID ('+str(PID)+') is running')
-
-            ########################################################
-            # Handle over-running jobs
-            ########################################################
-            ELAPSED_TIME = datetime.datetime.now() - PROCESS_STARTTIME
-
-            if ELAPSED_TIME.seconds > GPLOAD_MAX_RUNTIME_SECS:
-                add_log_entry('', 'Threshold exceeded (' + str(ELAPSED_TIME.seconds) + ' sec(s))')
-
-                if process_is_running(PID, GPLOAD_PROCESS_NAME):
-                    SUCCESSFULLY_KILLED_PROCESS=False
-                    try:
-                        TASKKILL_RETURN_CODE=subprocess.call(['taskkill', '/F', '/T', '/PID', str(s.pid)])
-                    except:
-                        add_log_entry('TASKKILL','Failed to kill process ('+str(TASKKILL_RETURN_CODE)+')')
-                        pass
-
-                    if TASKKILL_RETURN_CODE == 0:
-                        add_log_entry('TASKKILL','Successfully killed process ('+str(TASKKILL_RETURN_CODE)+')')
-                        break # The script has OVERRAN and we have successfully killed the process
-                else:
-                    add_log_entry('TASKKILL','PID is not running')
-
-            if not process_is_running(PID, GPLOAD_PROCESS_NAME):
-                add_log_entry('','PID ('+str(PID)+') is not running')
-                shutil.copy(LAST_RUN_LOGFILE_NAME,LAST_RUN_LOGFILE_NAME + '.tmp')
-
-                LAST_RUN_LOGFILE=open(LAST_RUN_LOGFILE_NAME + '.tmp','rb')
-                LAST_RUN_LOGFILE_LINES=LAST_RUN_LOGFILE.readlines()
-                LAST_RUN_LOGFILE.close()
-                LAST_RUN_LOGFILE_LENGTH=len(LAST_RUN_LOGFILE_LINES)
-                LAST_LINE=''
-
-                if LAST_RUN_LOGFILE_LENGTH > 1:
-                    LAST_LINE = LAST_RUN_LOGFILE_LINES[LAST_RUN_LOGFILE_LENGTH-1]
-
-                    if re.search('\|INFO\|gpload succeeded',LAST_LINE):
-                        GPLOAD_SUCCEEDED=True
-                        break # The script has SUCCEEDED
-                    elif re.search('\|INFO\|gpload failed',LAST_LINE):
-                        GPLOAD_FAILED=True
-                        break # The script has FAILED
-
-            time.sleep(SLEEPTIME)
-            COUNTER+=1
-
-      # END WHILE LOOP
-
-      if GPLOAD_SUCCEEDED:
-          add_log_entry('','gpload.py completed successfully')
-          break
-      elif GPLOAD_FAILED:
-          add_log_entry('','gpload failed')
-          for line in LAST_RUN_LOGFILE_LINES:
-              if re.search('\|ERROR\|',line):
-                  add_log_entry('',line.replace('\n',''))
-
-      if ATTEMPT_NO>=GPLOAD_RETRIES:
-          add_log_entry('FAILED',DOS_BATCH_FILE + ' failed after ' + str(ATTEMPT_NO) + ' attempt(s)')
-          ENDTIME = datetime.datetime.now()
-          delta = ENDTIME - STARTTIME
-          add_log_entry('SCRIPT FAILED','ELAPSED TIME: ' + str(delta.seconds) + '.' + str(delta.microseconds) + ' sec(s)')
-          sys.exit(1)
-
-      ATTEMPT_NO+=1
+    if LOADER is None:
+        print '\n*** Run the batch file: ' + DOS_BATCH_FILE
+        add_log_entry('GPLOAD',DOS_BATCH_FILE)
+        LAST_RUN_LOGFILE_NAME=os.path.join(LOG_DIR,'gpload_raw_msg_guid_ext_ctrl_doc_last_run.log')
+
+        RAW_FILE_INDEX_LOGFILE.close()
+
+        RESULT = DQ_IL2_Loader_Supervisor.run_loader_with_retries(DOS_BATCH_FILE, attempts=GPLOAD_RETRIES, retry_delay_secs=SLEEPTIME,
+                                                                 log=add_log_entry, max_runtime_secs=GPLOAD_MAX_RUNTIME_SECS,
+                                                                 log_filename=LAST_RUN_LOGFILE_NAME, cwd=SCRIPTS_DIR,
+                                                                 heartbeat_secs=SLEEPTIME * LOG_FREQUENCY)
+
+        if RESULT.succeeded():
+            add_log_entry('','gpload.py completed successfully (' + str(RESULT.attempt) + ' attempt(s), ' + '%.3f' % RESULT.duration_secs + ' sec(s))')
+        else:
+            add_log_entry('FAILED',DOS_BATCH_FILE + ' failed after ' + str(RESULT.attempt) + ' attempt(s): ' + RESULT.summary())
+            ENDTIME = datetime.datetime.now()
+            delta = ENDTIME - STARTTIME
+            add_log_entry('SCRIPT FAILED','ELAPSED TIME: ' + str(delta.seconds) + '.' + str(delta.microseconds) + ' sec(s)')
+            sys.exit(1)
 
     ##############################################################################################################################
     # Move files to local 'done' folder
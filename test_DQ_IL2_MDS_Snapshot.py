@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""
+test_DQ_IL2_MDS_Snapshot.py
+
+DESCRIPTION:
+
+Tests for DQ_IL2_MDS_Snapshot.py - the MDS database is replaced by a fake pyodbc module, so the tests run without SQL Server:
+
+    python -m unittest discover -p "test_*.py"
+"""
+
+import os
+import sys
+import time
+import types
+import shutil
+import tempfile
+import threading
+import unittest
+
+from DQ_IL2_MDS_Snapshot import MDSSnapshot, MDSSnapshotStore, pyodbc_source
+
+ROWS = [('IATA', 'G1'), ('ICAO', 'GAA'), ('COMMERCIAL_IATA', 'BA'), ('COMMERCIAL_ICAO', 'BAW')]
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql):
+        self.connection.executed.append(sql)
+
+    def fetchall(self):
+        return self.connection.rows
+
+
+class FakeConnection(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakePyodbc(object):
+    """
+    Stands in for the pyodbc module - connect() returns a FakeConnection serving the current rows, or raises the current error
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.error = None
+        self.connections = []
+        self.module = types.ModuleType('pyodbc')
+        self.module.connect = self.connect
+
+    def connect(self, **kwargs):
+        if self.error is not None:
+            raise self.error
+        connection = FakeConnection(list(self.rows))
+        connection.kwargs = kwargs
+        self.connections.append(connection)
+        return connection
+
+
+class RecordingLogger(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(('info', message))
+
+    def warn(self, message):
+        self.messages.append(('warn', message))
+
+
+class MDSSnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.tmp_dir, 'MDS_snapshot.pkl')
+        self.mds_extract = os.path.join(self.tmp_dir, 'MDS_extract.csv')
+        self.pyodbc = FakePyodbc(ROWS)
+        self.saved_pyodbc = sys.modules.get('pyodbc')
+        sys.modules['pyodbc'] = self.pyodbc.module
+        self.source = pyodbc_source('host', 'database', 'user', 'password', 'select code_standard, carrier_code from carriers')
+        self.logger = RecordingLogger()
+
+    def tearDown(self):
+        if self.saved_pyodbc is None:
+            del sys.modules['pyodbc']
+        else:
+            sys.modules['pyodbc'] = self.saved_pyodbc
+        shutil.rmtree(self.tmp_dir)
+
+    def create_store(self, refresh_secs=3600):
+        return MDSSnapshotStore(self.snapshot_file, self.source, refresh_secs, self.logger, mds_extract=self.mds_extract)
+
+
+class PyodbcSourceTest(MDSSnapshotTestCase):
+
+    def test_reads_rows_and_closes_connection(self):
+        self.assertEqual(self.source(), ROWS)
+        connection = self.pyodbc.connections[0]
+        self.assertEqual(connection.executed, ['select code_standard, carrier_code from carriers'])
+        self.assertEqual(connection.kwargs['server'], 'host')
+        self.assertTrue(connection.closed)
+
+
+class SnapshotTest(MDSSnapshotTestCase):
+
+    def test_from_rows(self):
+        snapshot = MDSSnapshot.from_rows([(' IATA ', ' G1 '), ('IATA', 'G1'), ('OTHER', 'XX')] + ROWS[1:])
+        self.assertEqual(snapshot.carriers['IATA'], ('G1',))
+        self.assertEqual(snapshot.code_count(), 4)
+        self.assertEqual(snapshot.flight_router().classify('BA0123'), 'COMMERCIAL')
+
+    def test_save_and_load(self):
+        snapshot = MDSSnapshot.from_rows(ROWS)
+        snapshot.save(self.snapshot_file)
+        self.assertFalse(os.path.exists(self.snapshot_file + '.part'))
+        loaded = MDSSnapshot.load(self.snapshot_file)
+        self.assertEqual(loaded.carriers, snapshot.carriers)
+        self.assertEqual(loaded.content_hash, snapshot.content_hash)
+        self.assertEqual(loaded.loaded_at, snapshot.loaded_at)
+
+    def test_content_hash(self):
+        snapshot = MDSSnapshot.from_rows(ROWS)
+        self.assertEqual(MDSSnapshot.from_rows(reversed(ROWS)).content_hash, snapshot.content_hash)
+        self.assertNotEqual(MDSSnapshot.from_rows(ROWS + [('IATA', 'G2')]).content_hash, snapshot.content_hash)
+        self.assertNotEqual(MDSSnapshot.from_rows([('ICAO', 'G1')] + ROWS[1:]).content_hash, snapshot.content_hash)
+
+    def test_load_detects_corrupt_snapshot(self):
+        snapshot = MDSSnapshot.from_rows(ROWS)
+        snapshot.content_hash = '0' * 40
+        snapshot.save(self.snapshot_file)
+        self.assertRaises(ValueError, MDSSnapshot.load, self.snapshot_file)
+
+
+class SnapshotStoreTest(MDSSnapshotTestCase):
+
+    def test_get_refreshes_when_nothing_saved(self):
+        store = self.create_store()
+        snapshot = store.get()
+        self.assertEqual(snapshot.code_count(), 4)
+        self.assertEqual(MDSSnapshot.load(self.snapshot_file).content_hash, snapshot.content_hash)
+        with open(self.mds_extract, 'rb') as f:
+            self.assertEqual(len(f.read().splitlines()), 4)
+
+    def test_get_uses_saved_snapshot_until_expired(self):
+        self.create_store().get()
+        self.pyodbc.rows = ROWS + [('IATA', 'G2')]
+
+        store = self.create_store()
+        self.assertEqual(store.get().code_count(), 4)
+        self.assertEqual(len(self.pyodbc.connections), 1)
+
+        store.refresh_secs = 0
+        self.assertEqual(store.get().code_count(), 5)
+        self.assertEqual(len(self.pyodbc.connections), 2)
+
+    def test_get_builds_snapshot_from_csv_extract(self):
+        with open(self.mds_extract, 'wb') as f:
+            f.write(''.join(['%s,%s\r\n' % row for row in ROWS]))
+        self.pyodbc.error = RuntimeError('unreachable')
+        store = self.create_store()
+        self.assertEqual(store.get().content_hash, MDSSnapshot.from_rows(ROWS).content_hash)
+        self.assertTrue(os.path.exists(self.snapshot_file))
+
+    def test_refresh_detects_change(self):
+        store = self.create_store()
+        first = store.get()
+        self.assertTrue(store.refresh())
+        self.assertEqual(store.current().content_hash, first.content_hash)
+        self.assertIn('unchanged', self.logger.messages[-1][1])
+
+        self.pyodbc.rows = ROWS + [('COMMERCIAL_IATA', 'VS')]
+        self.assertTrue(store.refresh())
+        self.assertNotEqual(store.current().content_hash, first.content_hash)
+        self.assertIn('version %s' % (store.current().content_hash[:12]), self.logger.messages[-1][1])
+
+    def test_refresh_keeps_last_good_snapshot(self):
+        store = self.create_store()
+        first = store.get()
+
+        self.pyodbc.error = RuntimeError('unreachable')
+        self.assertFalse(store.refresh())
+        self.assertIs(store.current(), first)
+
+        self.pyodbc.error = None
+        self.pyodbc.rows = [('OTHER', 'XX')]
+        self.assertFalse(store.refresh())
+        self.assertIs(store.current(), first)
+        self.assertEqual(MDSSnapshot.load(self.snapshot_file).content_hash, first.content_hash)
+
+    def test_get_without_any_snapshot(self):
+        self.pyodbc.error = RuntimeError('unreachable')
+        self.assertRaises(RuntimeError, self.create_store().get)
+
+    def test_background_refresh(self):
+        store = self.create_store(refresh_secs=0)
+        store.get()
+        self.pyodbc.rows = ROWS + [('IATA', 'G2')]
+        store.start_background_refresh(poll_secs=0.01)
+        try:
+            deadline = time.time() + 5
+            while store.current().code_count() != 5 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            self.assertTrue(store.stop_background_refresh())
+        self.assertEqual(store.current().code_count(), 5)
+        self.assertFalse(store.refresh_thread.is_alive())
+
+    def test_stop_background_refresh_does_not_wait_for_hung_refresh(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def hung_source():
+            started.set()
+            release.wait(5)
+            return ROWS
+
+        store = MDSSnapshotStore(self.snapshot_file, hung_source, 0, self.logger)
+        store.start_background_refresh(poll_secs=0.01)
+        try:
+            self.assertTrue(started.wait(5))
+            start_time = time.time()
+            self.assertFalse(store.stop_background_refresh(timeout_secs=0.1))
+            self.assertLess(time.time() - start_time, 2)
+            self.assertTrue(store.refresh_thread.daemon)
+        finally:
+            release.set()
+            store.refresh_thread.join(5)
+
+
+if __name__ == '__main__':
+    unittest.main()